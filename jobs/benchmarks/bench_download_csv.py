@@ -0,0 +1,142 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Measure how long it takes to download and decompress the CSV files of an
+inventory manifest from a fake S3 client, with the files not downloaded
+yet ("download", at 100 MB/s) and already downloaded ("cached").
+
+Usage:
+
+    $ LOG_METRICS=void python benchmarks/bench_download_csv.py \\
+        [number-of-files] [entries-per-file]
+
+"before" writes each file to disk and then reads it back chunk by chunk
+with ``aiofiles``, "after" is ``download_csv``, which decompresses the
+files as they are received and maps the downloaded files in memory.
+"""
+import asyncio
+import gzip
+import hashlib
+import sys
+import tempfile
+import time
+import zlib
+
+import aiofiles
+
+from buildhub.download_cache import DownloadCache
+from buildhub.s3_inventory_to_kinto import (
+    download_csv, download_file, CHUNK_SIZE
+)
+
+
+# Bandwidth of the fake S3, shared by the concurrent downloads.
+BANDWIDTH = 100 * 1024 * 1024  # 100 MB/s
+
+
+class FakeBody:
+    def __init__(self, content, link):
+        self.content = content
+        self.position = 0
+        self.link = link
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def read(self, size):
+        chunk = self.content[self.position:self.position + size]
+        self.position += size
+        async with self.link:
+            await asyncio.sleep(len(chunk) / BANDWIDTH)
+        return chunk
+
+
+class FakeClient:
+    def __init__(self, objects):
+        self.objects = objects
+        self.link = asyncio.Lock()
+
+    async def get_object(self, Bucket, Key):
+        return {'Body': FakeBody(self.objects[Key], self.link)}
+
+
+def generate(files, entries):
+    objects = {}
+    manifest = []
+    for i in range(files):
+        content = gzip.compress(b''.join(
+            b'"net-mozaws-prod-delivery-firefox","pub/firefox/releases/'
+            b'51.0/win64/x%d/Firefox Setup 51.0.exe","45678",'
+            b'"2017-06-16T03:02:07.000Z","%s"\n' % (
+                j, hashlib.md5(b'%d-%d' % (i, j)).hexdigest().encode()
+            )
+            for j in range(entries)
+        ))
+        key = 'inventory/data/{}.csv.gz'.format(i)
+        objects['public/' + key] = content
+        manifest.append({
+            'key': key,
+            'size': len(content),
+            'MD5checksum': hashlib.md5(content).hexdigest(),
+        })
+    return FakeClient(objects), manifest
+
+
+async def before(loop, client, manifest, folder):
+    for files in manifest:
+        file_path = await download_file(client, files, DownloadCache(folder))
+        gzip_ = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        async with aiofiles.open(file_path, 'rb') as stream:
+            while 'there are chunks to read':
+                gzip_chunk = await stream.read(CHUNK_SIZE)
+                if not gzip_chunk:
+                    break
+                csv_chunk = gzip_.decompress(gzip_chunk)
+                if csv_chunk:
+                    yield csv_chunk
+
+
+async def after(loop, client, manifest, folder):
+    async def files_stream():
+        for files in manifest:
+            yield files
+
+    async for csv_chunk in download_csv(
+        loop, client, files_stream(), download_directory=folder
+    ):
+        yield csv_chunk
+
+
+async def consume(csv_chunks):
+    size = 0
+    async for csv_chunk in csv_chunks:
+        size += len(csv_chunk)
+    return size
+
+
+def run():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    entries = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    loop = asyncio.get_event_loop()
+    client, manifest = generate(files, entries)
+    for name, function in (('before', before), ('after', after)):
+        with tempfile.TemporaryDirectory() as folder:
+            for cache in ('download', 'cached'):
+                t0 = time.time()
+                size = loop.run_until_complete(
+                    consume(function(loop, client, manifest, folder))
+                )
+                elapsed = time.time() - t0
+                print('{:<7} {:<9} {:>6.2f}s  ({:,.0f} MB/s of CSV)'.format(
+                    name, cache, elapsed, size / elapsed / 1024 / 1024
+                ))
+    loop.close()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,111 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Measure how long it takes to fetch all the records of a collection, when
+``fetch_existing`` has no previous run to start from.
+
+Usage:
+
+    $ ./testkinto/run.sh start &
+    $ LOG_METRICS=void SERVER_URL=http://localhost:9999/v1 \\
+        python benchmarks/bench_fetch_existing.py [number-of-records]
+
+The records are created in the ``bench`` collection of the ``build-hub``
+bucket first if needed. "before" follows the ``Next-Page`` links one page
+at a time, like ``fetch_existing`` used to do, the others use
+``fetch_all_records`` with that many threads.
+
+When the server runs on the same machine, it competes with the benchmark
+for the CPU. With ``SERVER_DELAY=<seconds>``, every request takes that much
+longer, like the time spent by a remote server and its database to return
+a page.
+"""
+import os
+import sys
+import time
+
+from kinto_http import Client
+
+from buildhub.to_kinto import fetch_all_records, FETCH_EXISTING_PAGE_SIZE
+
+
+SERVER_URL = os.getenv('SERVER_URL', 'http://localhost:9999/v1')
+SERVER_DELAY = float(os.getenv('SERVER_DELAY', 0))
+
+
+def populate(client, count):
+    client.create_bucket(if_not_exists=True)
+    client.create_collection(if_not_exists=True)
+    existing = len(client.get_records(_fields='id'))
+    with client.batch() as batch:
+        for i in range(existing, count):
+            batch.create_record(data={
+                'id': 'firefox_nightly_55-0a1_linux-x86_64_x{}'.format(i),
+                'target': {'locale': 'x{}'.format(i), 'channel': 'nightly'},
+                'download': {'size': 55876236 + i},
+            })
+
+
+def before(client):
+    """What ``fetch_existing`` used to do."""
+    params = {'_since': None}
+    endpoint = client.get_endpoint('records')
+    while True:
+        record_resp, headers = client.session.request(
+            'get',
+            endpoint,
+            params=params
+        )
+        yield record_resp['data']
+        try:
+            endpoint = headers['Next-Page']
+            if not endpoint:
+                raise KeyError('exists but empty value')
+        except KeyError:
+            break
+        params.pop('_since', None)
+
+
+def run():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    client = Client(
+        server_url=SERVER_URL,
+        auth=('user', 'pass'),
+        bucket='build-hub',
+        collection='bench',
+    )
+    populate(client, count)
+
+    request = client.session.request
+
+    def delayed_request(*args, **kwargs):
+        time.sleep(SERVER_DELAY)
+        return request(*args, **kwargs)
+
+    client.session.request = delayed_request
+
+    runs = [('before', lambda: before(client))]
+    for parallel in (1, 2, 4, 8):
+        runs.append((
+            'parallel={}'.format(parallel),
+            lambda parallel=parallel: fetch_all_records(
+                client, parallel=parallel
+            )
+        ))
+    print('{} records, pages of {}, {}s per request'.format(
+        count, FETCH_EXISTING_PAGE_SIZE, SERVER_DELAY
+    ))
+    for name, fetch in runs:
+        t0 = time.time()
+        fetched = sum(len(page) for page in fetch())
+        elapsed = time.time() - t0
+        assert fetched == count, fetched
+        print('{:<11} {:>6.2f}s  {:>9,.0f} records/sec'.format(
+            name, elapsed, fetched / elapsed
+        ))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,136 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Measure the latency of ``fetch_json`` against a local fake archive server,
+where a few responses are very slow, with and without hedged requests.
+
+Usage:
+
+    $ LOG_METRICS=void python benchmarks/bench_hedged_requests.py \\
+        [number-of-requests] [concurrency]
+
+"before" fetches without hedging, "after" sends a duplicate of the
+requests slower than ``HEDGE_PERCENTILE`` of the recent ones.
+"""
+import asyncio
+import os
+import random
+import socket
+import sys
+import time
+
+import aiohttp
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+PORT = free_port()
+os.environ['ARCHIVE_URL'] = 'http://127.0.0.1:{}/'.format(PORT)
+
+from buildhub import inventory_to_records  # noqa
+from buildhub.hedging import Hedger, percentile  # noqa
+from buildhub.utils import ARCHIVE_URL  # noqa
+
+
+FAST_LATENCY = 0.005
+SLOW_LATENCY = 0.2
+SLOW_RATIO = 0.02
+
+
+BODY = b'{"buildid": "20170616030207"}'
+RESPONSE = (
+    b'HTTP/1.1 200 OK\r\n'
+    b'Content-Type: application/json\r\n'
+    b'Content-Length: ' + str(len(BODY)).encode('ascii') + b'\r\n'
+    b'\r\n' + BODY
+)
+
+
+class FakeArchive:
+    """Minimal keep-alive HTTP server answering every GET with some
+    metadata, after a random latency."""
+    def __init__(self, seed=42):
+        self.random = random.Random(seed)
+
+    async def handle(self, reader, writer):
+        while True:
+            request = await reader.readuntil(b'\r\n\r\n')
+            if not request:
+                break
+            if self.random.random() < SLOW_RATIO:
+                await asyncio.sleep(SLOW_LATENCY)
+            else:
+                await asyncio.sleep(FAST_LATENCY * self.random.uniform(1, 2))
+            writer.write(RESPONSE)
+
+    async def serve(self, reader, writer):
+        try:
+            await self.handle(reader, writer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+
+async def fetch_all(session, count, concurrency):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(i):
+        url = ARCHIVE_URL + 'pub/firefox/nightly/{}.json'.format(i)
+        async with semaphore:
+            t0 = time.time()
+            await inventory_to_records.fetch_json(session, url)
+            latencies.append(time.time() - t0)
+
+    await asyncio.gather(*[fetch(i) for i in range(count)])
+    return latencies
+
+
+async def bench(loop, count, concurrency):
+    archive = FakeArchive()
+    server = await asyncio.start_server(
+        archive.serve, '127.0.0.1', PORT, loop=loop
+    )
+
+    async with aiohttp.ClientSession(loop=loop) as session:
+        for name, enabled in (('before', False), ('after', True)):
+            hedger = Hedger(enabled=enabled)
+            inventory_to_records._hedger = hedger
+            archive.random.seed(42)
+            t0 = time.time()
+            latencies = await fetch_all(session, count, concurrency)
+            elapsed = time.time() - t0
+            print(
+                '{:<8} p50 {:>6.1f}ms  p99 {:>6.1f}ms  '
+                'total {:>5.2f}s  hedged {:>4}'.format(
+                    name,
+                    percentile(latencies, 50) * 1000,
+                    percentile(latencies, 99) * 1000,
+                    elapsed,
+                    hedger.hedged,
+                )
+            )
+
+    # Let the server answer the cancelled requests, and notice that the
+    # connections were closed.
+    await asyncio.sleep(SLOW_LATENCY + 0.1)
+    server.close()
+    await server.wait_closed()
+
+
+def run():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(bench(loop, count, concurrency))
+    loop.close()
+
+
+if __name__ == '__main__':
+    run()
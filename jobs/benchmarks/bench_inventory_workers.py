@@ -0,0 +1,128 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Measure how many inventory entries per second are turned into records
+(decompression, CSV parsing, filtering and ``record_from_url``), from
+several generated ``*.csv.gz`` files.
+
+Usage:
+
+    $ LOG_METRICS=void python benchmarks/bench_inventory_workers.py \\
+        [number-of-files] [entries-per-file]
+
+"loop" parses the files in the event loop, like ``csv_to_records``,
+"N workers" parses them in a pool of N processes, like
+``s3_inventory_to_kinto`` with ``INVENTORY_WORKERS``.
+"""
+import asyncio
+import csv
+import gzip
+import os
+import sys
+import tempfile
+import time
+import zlib
+
+from buildhub.inventory_to_records import (
+    inventory_entry_to_record, read_csv, PRODUCTS
+)
+from buildhub.inventory_workers import parse_inventory_files
+from buildhub.utils import KeyClassifier
+
+
+KEYS = (
+    'pub/firefox/releases/51.0/win64/{locale}/Firefox Setup 51.0.exe',
+    'pub/firefox/releases/51.0/win64/{locale}/Firefox Setup 51.0.exe.asc',
+    'pub/firefox/releases/51.0/linux-x86_64/{locale}/firefox-51.0.tar.bz2',
+    'pub/firefox/nightly/2017/06/2017-06-16-03-02-07-mozilla-central-l10n/'
+    'firefox-56.0a1.{locale}.win32.installer.exe',
+    'pub/firefox/nightly/2017/06/2017-06-16-03-02-07-mozilla-central-l10n/'
+    'firefox-56.0a1.{locale}.win32.checksums',
+    'pub/devedition/releases/56.0b1/mac/{locale}/Firefox 56.0b1.dmg',
+    'pub/thunderbird/candidates/52.0-candidates/build1/win32/{locale}/'
+    'Thunderbird Setup 52.0.exe',
+    'pub/firefox/tinderbox-builds/mozilla-central-linux/1500000000/'
+    'firefox-56.0a1.en-US.linux-i686.tar.bz2',
+)
+
+
+def generate(folder, files, entries):
+    paths = []
+    for i in range(files):
+        file_path = os.path.join(folder, '{}.csv.gz'.format(i))
+        with gzip.open(file_path, 'wt', newline='') as f:
+            writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+            for j in range(entries):
+                key = KEYS[j % len(KEYS)].format(
+                    locale='x{}{}'.format(i, j // len(KEYS))
+                )
+                writer.writerow((
+                    'net-mozaws-prod-delivery-firefox', key, '45678',
+                    '2017-06-16T03:02:07.000Z', 'f1aa742ef0973db098947bd6'
+                ))
+        paths.append(file_path)
+    return paths
+
+
+async def csv_chunks(paths, chunk_size=1024 * 256):
+    for file_path in paths:
+        gzip_ = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        with open(file_path, 'rb') as stream:
+            while 'there are chunks to read':
+                gzip_chunk = stream.read(chunk_size)
+                if not gzip_chunk:
+                    break
+                csv_chunk = gzip_.decompress(gzip_chunk)
+                if csv_chunk:
+                    yield csv_chunk
+
+
+async def in_loop(loop, paths):
+    classifier = KeyClassifier(PRODUCTS)
+    count = 0
+    columns = ('Key', 'Size', 'LastModifiedDate')
+    async for entry in read_csv(csv_chunks(paths), columns=columns):
+        if inventory_entry_to_record(classifier, *entry) is not None:
+            count += 1
+    return count
+
+
+async def in_workers(loop, paths, workers):
+    async def file_paths():
+        for file_path in paths:
+            yield file_path
+
+    count = 0
+    async for _ in parse_inventory_files(loop, file_paths(), workers):  # noqa
+        count += 1
+    return count
+
+
+def run():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    entries = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+    loop = asyncio.get_event_loop()
+    print('{} CPUs'.format(os.cpu_count()))
+    with tempfile.TemporaryDirectory() as folder:
+        paths = generate(folder, files, entries)
+        runs = [('loop', lambda: in_loop(loop, paths))] + [
+            (
+                '{} workers'.format(n),
+                lambda n=n: in_workers(loop, paths, n),
+            )
+            for n in (1, 2, 4, 8)
+        ]
+        for name, function in runs:
+            t0 = time.time()
+            count = loop.run_until_complete(function())
+            elapsed = time.time() - t0
+            print('{:<10} {:>8,.0f} entries/sec  ({:,} records)'.format(
+                name, files * entries / elapsed, count
+            ))
+    loop.close()
+
+
+if __name__ == '__main__':
+    run()
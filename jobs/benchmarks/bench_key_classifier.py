@@ -0,0 +1,112 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Measure how many inventory keys per second can be classified.
+
+Usage:
+
+    $ python benchmarks/bench_key_classifier.py [number-of-keys]
+
+"before" replays what the inventory loop used to do (a regular expression
+built on every call), "after" uses a single ``KeyClassifier``.
+"""
+import os
+import re
+import sys
+import time
+
+from buildhub.utils import (
+    KeyClassifier, key_to_archive_url,
+    _build_url_exclude_names_regex, _build_url_exclude_suffixes_regex,
+    FILE_EXTENSIONS, ALL_PRODUCTS,
+)
+
+
+KEYS = [
+    'pub/firefox/releases/51.0/win64/fy-NL/Firefox Setup 51.0.exe',
+    'pub/firefox/releases/52.0b6/linux-x86_64/en-US/firefox-52.0b6.tar.bz2',
+    'pub/firefox/releases/52.0b6/linux-x86_64/en-US/firefox-52.0b6.tar.bz2.asc',
+    'pub/firefox/candidates/50.0-candidates/build1/linux-x86_64/fr/'
+    'firefox-50.0.tar.bz2',
+    'pub/firefox/candidates/56.0b1-candidates/build4/linux-x86_64/en-US/'
+    'firefox-56.0b1.json',
+    'pub/firefox/nightly/2017/06/2017-06-16-03-02-07-mozilla-central-l10n/'
+    'firefox-56.0a1.ach.win32.installer.exe',
+    'pub/firefox/nightly/2017/06/2017-06-16-03-02-07-mozilla-central-l10n/'
+    'firefox-56.0a1.ach.win32.zip',
+    'pub/firefox/nightly/2017/12/2017-12-19-10-02-03-mozilla-central/'
+    'firefox-59.0a1.en-US.win32.json',
+    'pub/mobile/nightly/2017/08/2017-08-09-10-03-39-mozilla-central-'
+    'android-api-15-l10n/fennec-57.0a1.hi-IN.android-arm.apk',
+    'pub/thunderbird/releases/52.0/win32/fr/Thunderbird Setup 52.0.exe',
+    'pub/firefox/try-builds/jg@m.com-e/try-win64/firefox-56.0a1.en-US.win64.zip',
+    'pub/devedition/releases/54.0b11/mac/en-US/Firefox 54.0b11.dmg',
+]
+
+
+def legacy_is_build_url(product, url):
+    if (
+        'nightly' in url and
+        'mozilla-central' not in url and
+        'comm-central' not in url
+    ):
+        return False
+    if _build_url_exclude_names_regex.match(url):
+        return False
+    extensions = FILE_EXTENSIONS
+    if 'win' in url:
+        extensions = [x for x in extensions if x != 'zip']
+    if product == 'devedition':
+        product = 'firefox'
+    if product == 'mobile':
+        product = 'fennec'
+    filename = os.path.basename(url)
+    match_filename = filename.replace(' ', '-').lower()
+    if _build_url_exclude_suffixes_regex.match(match_filename):
+        return False
+    re_filename = re.compile(
+        '{}-(.+)({})$'.format(product, '|'.join(extensions))
+    )
+    return re_filename.match(match_filename)
+
+
+def before(keys):
+    count = 0
+    for key in keys:
+        product = key.split('/')[1]
+        if product not in ALL_PRODUCTS:
+            continue
+        if legacy_is_build_url(product, key_to_archive_url(key)):
+            count += 1
+    return count
+
+
+def after(keys):
+    classifier = KeyClassifier(ALL_PRODUCTS)
+    count = 0
+    for key in keys:
+        product = key.split('/')[1]
+        kind = classifier.classify(product, key_to_archive_url(key))
+        if kind == KeyClassifier.BUILD:
+            count += 1
+    return count
+
+
+def run():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    keys = (KEYS * (total // len(KEYS) + 1))[:total]
+    results = []
+    for name, func in (('before', before), ('after', after)):
+        start = time.perf_counter()
+        builds = func(keys)
+        elapsed = time.perf_counter() - start
+        results.append(builds)
+        print(f'{name:>7}: {total / elapsed:12,.0f} keys/sec '
+              f'({builds} build archives)')
+    assert results[0] == results[1], 'Classifiers disagree'
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,162 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Measure how many records per second get their metadata fetched from a
+local fake archive server, where one response out of ten is slow.
+
+Usage:
+
+    $ LOG_METRICS=void python benchmarks/bench_metadata_fetcher.py \\
+        [number-of-records] [concurrency]
+
+"before" replays what ``csv_to_records`` used to do (fetch batches of
+``concurrency`` records and wait for the whole batch), "after" uses a
+``MetadataFetcher``, ordered and unordered.
+"""
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import time
+
+import aiohttp
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+PORT = free_port()
+os.environ['ARCHIVE_URL'] = 'http://127.0.0.1:{}/'.format(PORT)
+
+from buildhub import inventory_to_records  # noqa
+from buildhub.utils import chunked, key_to_archive_url, record_from_url  # noqa
+
+
+FAST_LATENCY = 0.005
+SLOW_LATENCY = 0.1
+SLOW_RATIO = 0.1
+
+
+BODY = json.dumps({
+    'buildid': '20170616030207',
+    'moz_source_repo': 'https://hg.mozilla.org/mozilla-central',
+    'moz_source_stamp': 'abcdef',
+}).encode('utf-8')
+RESPONSE = (
+    b'HTTP/1.1 200 OK\r\n'
+    b'Content-Type: application/json\r\n'
+    b'Content-Length: ' + str(len(BODY)).encode('ascii') + b'\r\n'
+    b'\r\n' + BODY
+)
+
+
+class FakeArchive:
+    """Minimal keep-alive HTTP server answering every GET with some
+    metadata, after a random latency."""
+    def __init__(self, seed=42):
+        self.random = random.Random(seed)
+
+    async def handle(self, reader, writer):
+        while True:
+            request = await reader.readuntil(b'\r\n\r\n')
+            if not request:
+                break
+            if self.random.random() < SLOW_RATIO:
+                await asyncio.sleep(SLOW_LATENCY)
+            else:
+                await asyncio.sleep(FAST_LATENCY)
+            writer.write(RESPONSE)
+
+    async def serve(self, reader, writer):
+        try:
+            await self.handle(reader, writer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+
+def make_records(count):
+    records = []
+    for i in range(count):
+        key = (
+            'pub/firefox/nightly/2017/06/2017-06-16-03-{:02d}-{:02d}-'
+            'mozilla-central/firefox-56.0a1.en-US.linux-x86_64.tar.bz2'
+        ).format(i // 60 % 60, i % 60)
+        if i >= 3600:
+            key = key.replace('2017-06-16', '2017-06-{:02d}'.format(
+                17 + i // 3600
+            ))
+        records.append(record_from_url(key_to_archive_url(key)))
+    return records
+
+
+async def before(session, records, concurrency):
+    count = 0
+    for batch in chunked(records, concurrency):
+        futures = [
+            inventory_to_records.fetch_metadata(session, record)
+            for record in batch
+        ]
+        count += len(await asyncio.gather(*futures))
+    return count
+
+
+async def after(session, records, concurrency, ordered):
+    fetcher = inventory_to_records.MetadataFetcher(
+        session, concurrency=concurrency, ordered=ordered
+    )
+    count = 0
+    for record in records:
+        count += len(await fetcher.submit(record))
+    count += len(await fetcher.drain())
+    return count
+
+
+async def bench(loop, count, concurrency):
+    archive = FakeArchive()
+    server = await asyncio.start_server(
+        archive.serve, '127.0.0.1', PORT, loop=loop
+    )
+
+    records = make_records(count)
+    runs = (
+        ('before', lambda s: before(s, records, concurrency)),
+        ('ordered', lambda s: after(s, records, concurrency, True)),
+        ('unordered', lambda s: after(s, records, concurrency, False)),
+    )
+    async with aiohttp.ClientSession(loop=loop) as session:
+        for name, function in runs:
+            # Start from an empty metadata cache.
+            inventory_to_records._nightly_metadata.clear()
+            archive.random.seed(42)
+            t0 = time.time()
+            fetched = await function(session)
+            elapsed = time.time() - t0
+            assert fetched == count
+            print('{:<10} {:>8,.0f} records/sec'.format(
+                name, count / elapsed
+            ))
+
+    # Let the server notice that the connections were closed.
+    await asyncio.sleep(0.1)
+    server.close()
+    await server.wait_closed()
+
+
+def run():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(bench(loop, count, concurrency))
+    loop.close()
+
+
+if __name__ == '__main__':
+    run()
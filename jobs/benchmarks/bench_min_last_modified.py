@@ -0,0 +1,81 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Measure how many inventory rows per second go through the
+``min_last_modified`` filter.
+
+Usage:
+
+    $ python benchmarks/bench_min_last_modified.py [number-of-rows]
+
+"before" parses every date with ciso8601 and compares datetimes, "after"
+compares the raw strings against the watermark and only parses the few
+rows that are recent enough. 99% of the rows are older than the limit,
+like in a daily run with ``MIN_AGE_LAST_MODIFIED_HOURS=24``.
+"""
+import datetime
+import sys
+import time
+
+import ciso8601
+
+from buildhub.inventory_to_records import last_modified_watermark
+
+
+def make_dates(count):
+    now = datetime.datetime(2018, 3, 1, tzinfo=datetime.timezone.utc)
+    dates = []
+    for i in range(count):
+        if i % 100:
+            age = datetime.timedelta(days=2 + i % 700, seconds=i % 86400)
+        else:
+            age = datetime.timedelta(seconds=i % 86400)
+        dates.append((now - age).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-5] + 'Z')
+    return now - datetime.timedelta(days=1), dates
+
+
+def before(dates, min_last_modified):
+    kept = 0
+    for last_modified_date in dates:
+        lastmodified = ciso8601.parse_datetime(last_modified_date)
+        if lastmodified < min_last_modified:
+            continue
+        kept += 1
+    return kept
+
+
+def after(dates, min_last_modified):
+    watermark = last_modified_watermark(min_last_modified)
+    kept = 0
+    for last_modified_date in dates:
+        if (
+            last_modified_date < watermark and
+            last_modified_date.endswith('Z')
+        ):
+            continue
+        lastmodified = ciso8601.parse_datetime(last_modified_date)
+        if lastmodified < min_last_modified:
+            continue
+        kept += 1
+    return kept
+
+
+def run():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    min_last_modified, dates = make_dates(count)
+
+    results = {}
+    for name, function in (('before', before), ('after', after)):
+        t0 = time.time()
+        results[name] = function(dates, min_last_modified)
+        elapsed = time.time() - t0
+        print('{:<8} {:>12,.0f} rows/sec ({} kept)'.format(
+            name, count / elapsed, results[name]
+        ))
+    assert results['before'] == results['after']
+
+
+if __name__ == '__main__':
+    run()
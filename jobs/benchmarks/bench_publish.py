@@ -0,0 +1,117 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Measure how many records per second ``to_kinto`` publishes.
+
+Usage:
+
+    $ ./testkinto/run.sh start &
+    $ LOG_METRICS=void SERVER_URL=http://localhost:9999/v1 \\
+        python benchmarks/bench_publish.py [number-of-records]
+
+The records are written in the ``publish-bench`` collection of the
+``build-hub`` bucket. "before" replays what ``to_kinto`` used to do (three
+threads sending batches with ``kinto_http``), the "parallel" ones send the
+batches from the event loop with ``BatchPublisher``, that many at a time and
+as large as the server accepts, and "adaptive" lets ``BatchPublisher`` adapt
+both to the server.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import os
+import sys
+import time
+
+from kinto_http import Client
+
+from buildhub import to_kinto
+from buildhub.kinto_publisher import BatchPublisher
+
+
+SERVER_URL = os.getenv('SERVER_URL', 'http://localhost:9999/v1')
+
+
+def generate(count):
+    for i in range(count):
+        locale = 'x{}'.format(i)
+        yield {'data': {
+            'id': 'firefox_nightly_55-0a1_linux-x86_64_{}'.format(locale),
+            'target': {'locale': locale, 'channel': 'nightly'},
+            'download': {'size': 55876236 + i},
+        }}
+
+
+def publish_records(client, records):
+    with client.batch() as batch:
+        for record in records:
+            batch.update_record(**record)
+    return batch.results()
+
+
+def before(loop, client, count, batch_size):
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=3)
+    records = list(generate(count))
+    futures = [
+        loop.run_in_executor(
+            executor, publish_records, client, records[i:i + batch_size]
+        )
+        for i in range(0, count, batch_size)
+    ]
+    loop.run_until_complete(asyncio.gather(*futures))
+
+
+def after(loop, client, count, **options):
+    async def records():
+        for record in generate(count):
+            yield record
+
+    to_kinto.BatchPublisher = functools.partial(BatchPublisher, **options)
+    loop.run_until_complete(to_kinto.main(
+        loop, records(), client, skip_existing=False
+    ))
+
+
+def run():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    client = Client(
+        server_url=SERVER_URL,
+        auth=('user', 'pass'),
+        bucket='build-hub',
+        collection='publish-bench',
+        retry=to_kinto.NB_RETRY_REQUEST,
+    )
+    client.create_bucket(if_not_exists=True)
+    client.create_collection(if_not_exists=True)
+    batch_size = client.server_info()['settings']['batch_max_requests']
+    # Keep the output readable.
+    logging.getLogger('kinto_http').setLevel(logging.ERROR)
+
+    loop = asyncio.get_event_loop()
+    runs = [('before', lambda: before(loop, client, count, batch_size))]
+    for parallel in (1, 2, 4, 8):
+        runs.append((
+            'parallel={}'.format(parallel),
+            lambda parallel=parallel: after(
+                loop, client, count,
+                parallel=parallel,
+                max_parallel=parallel,
+                target_seconds=float('inf'),
+            )
+        ))
+    runs.append(('adaptive', lambda: after(loop, client, count)))
+    print('{} records, batches of {}'.format(count, batch_size))
+    for name, publish in runs:
+        t0 = time.time()
+        publish()
+        elapsed = time.time() - t0
+        print('{:<11} {:>6.2f}s  {:>9,.0f} records/sec'.format(
+            name, elapsed, count / elapsed
+        ))
+
+
+if __name__ == '__main__':
+    run()
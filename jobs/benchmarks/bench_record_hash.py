@@ -0,0 +1,110 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Measure how many records per second are hashed to tell whether they
+changed, as returned by Kinto (with ``last_modified`` and ``schema``).
+
+Usage:
+
+    $ LOG_METRICS=void python benchmarks/bench_record_hash.py \\
+        [number-of-records]
+
+"before" replays what ``to_kinto`` used to do (``copy.deepcopy()`` of the
+record, then MD5 of ``json.dumps(sort_keys=True)``), "after" uses
+``hash_record``.
+"""
+import copy
+import hashlib
+import json
+import sys
+import time
+
+from buildhub.utils import hash_record
+
+
+BATCH_SIZE = 10000
+
+
+def generate(start, count):
+    """Records like the ones of the nightly builds."""
+    records = []
+    for i in range(start, start + count):
+        locale = 'x{}'.format(i)
+        url = (
+            'https://archive.mozilla.org/pub/firefox/nightly/2017/05/'
+            '2017-05-15-10-02-38-mozilla-central-l10n/'
+            'firefox-55.0a1.{}.linux-x86_64.tar.bz2'.format(locale)
+        )
+        record_id = (
+            'firefox_nightly_2017-05-15-10-02-38_55-0a1_linux-x86_64_{}'
+        ).format(locale)
+        records.append({
+            'id': record_id,
+            'last_modified': 1494867758000 + i,
+            'schema': 1494800000000,
+            'build': {
+                'as': '$(CC)',
+                'cc': ['/usr/bin/ccache', '/builds/gcc/bin/gcc', '-m64'],
+                'cxx': ['/usr/bin/ccache', '/builds/gcc/bin/g++', '-m64'],
+                'date': '2017-05-15T10:02:38Z',
+                'host': 'x86_64-pc-linux-gnu',
+                'id': '20170515100238',
+                'ld': 'ld',
+                'target': 'x86_64-pc-linux-gnu',
+            },
+            'download': {
+                'date': '2017-05-15T16:48:49Z',
+                'mimetype': 'application/x-bzip2',
+                'size': 55876236 + i,
+                'url': url,
+            },
+            'source': {
+                'product': 'firefox',
+                'repository': 'https://hg.mozilla.org/mozilla-central',
+                'revision': '8e9e2e6e5ac0a6e0f1c9c2bfd4c7d8c4e7e5b0a2',
+                'tree': 'mozilla-central',
+            },
+            'target': {
+                'channel': 'nightly',
+                'locale': locale,
+                'os': 'linux',
+                'platform': 'linux-x86_64',
+                'version': '55.0a1',
+            },
+        })
+    return records
+
+
+def before(record):
+    record = copy.deepcopy(record)
+    record.pop('last_modified', None)
+    record.pop('schema', None)
+    return hashlib.md5(
+       json.dumps(record, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+
+
+def run():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    functions = (
+        ('before', before),
+        ('after', hash_record),
+    )
+    elapsed = {name: 0 for name, _ in functions}
+    for start in range(0, count, BATCH_SIZE):
+        records = generate(start, min(BATCH_SIZE, count - start))
+        for name, function in functions:
+            t0 = time.time()
+            for record in records:
+                function(record)
+            elapsed[name] += time.time() - t0
+    for name, _ in functions:
+        print('{:<8} {:>6.2f}s  {:>9,.0f} records/sec'.format(
+            name, elapsed[name], count / elapsed[name]
+        ))
+
+
+if __name__ == '__main__':
+    run()
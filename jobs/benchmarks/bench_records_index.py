@@ -0,0 +1,104 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Measure how long it takes, and how much memory it uses, to load the
+records of a previous run and look them up, on a second run of
+``fetch_existing``.
+
+Usage:
+
+    $ LOG_METRICS=void python benchmarks/bench_records_index.py \\
+        [number-of-records]
+
+"json" replays what ``fetch_existing`` used to do (load the indented JSON
+dump in a dict and find the highest timestamp), "index" opens a
+``RecordsIndex``. Both are run in a new process, to measure their peak
+memory.
+"""
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from buildhub.records_index import RecordsIndex
+
+
+def record_id(i):
+    return 'firefox_nightly_2017-05-15-10-02-38_55-0a1_linux-x86_64_x{}'.format(
+        i
+    )
+
+
+def record_hash(i):
+    return '%032x' % (i * 2654435761)
+
+
+def load_json(path, count):
+    with open(path) as f:
+        records = json.load(f)
+    high_water = max([r[0] for r in records.values()])
+    return records, high_water
+
+
+def load_index(path, count):
+    records = RecordsIndex(path)
+    return records, records.high_water
+
+
+def measure(load, path, count, results):
+    t0 = time.time()
+    records, _ = load(path, count)
+    loaded = time.time() - t0
+    t0 = time.time()
+    for i in range(0, count, 7):
+        assert records.get(record_id(i))[1] == record_hash(i)
+    lookups = (time.time() - t0) / len(range(0, count, 7))
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((loaded, lookups, peak))
+
+
+def run():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, 'records.json')
+        index_path = os.path.join(tmp, 'records.bin')
+
+        records = {
+            record_id(i): [1494867758000 + i, record_hash(i)]
+            for i in range(count)
+        }
+        with open(json_path, 'w') as f:
+            json.dump(records, f, sort_keys=True, indent=2)
+        index = RecordsIndex(index_path)
+        index.import_dict(records)
+        index.close()
+        del records
+
+        for name, load, path in (
+            ('json', load_json, json_path),
+            ('index', load_index, index_path),
+        ):
+            context = multiprocessing.get_context('spawn')
+            results = context.Queue()
+            child = context.Process(
+                target=measure, args=(load, path, count, results)
+            )
+            child.start()
+            loaded, lookups, peak = results.get()
+            child.join()
+            print(
+                '{:<6} {:>6.1f} MB on disk  load {:>6.3f}s  '
+                'lookup {:>5.1f}us  peak RSS {:>6.0f} MB'.format(
+                    name, os.path.getsize(path) / 1024 / 1024, loaded,
+                    lookups * 1e6, peak / 1024
+                )
+            )
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,90 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Measure the throughput of ``split_lines()`` on a synthetic inventory.
+
+Usage:
+
+    $ python benchmarks/bench_split_lines.py [size-in-GB]
+
+The inventory is generated on the fly (nothing is written on disk) and
+cut in chunks of the same size as ``download_csv()`` yields them. "before"
+is the previous str based implementation.
+"""
+import asyncio
+import sys
+import time
+
+from buildhub.s3_inventory_to_kinto import CHUNK_SIZE
+from buildhub.utils import split_lines
+
+
+ROWS = [
+    '"net-mozaws-delivery-firefox","pub/firefox/nightly/2017/06/'
+    '2017-06-02-03-02-04-mozilla-central-l10n/firefox-55.0a1.ach.win32'
+    '.complete.mar","50000","2017-06-02T12:20:10.2Z",'
+    '"a7fa24fe01973db09894bd6d7875f391"\n',
+    '"net-mozaws-delivery-firefox","pub/firefox/releases/52.0/linux-x86_64/'
+    'fr/firefox-52.0.tar.bz2","60000","2017-06-02T15:20:10.4Z",'
+    '"1afa742ef0973db098947bd6d8759f13"\n',
+    '"net-mozaws-delivery-archive","pub/thunderbird/releases/52.0/win32/'
+    'fr/Thunderbird Setup 52.0.exe","60000","2017-06-02T15:20:10.4Z",'
+    '"1afa742ef0973db098947bd6d8759f13"\n',
+]
+
+
+async def synthetic_inventory(size):
+    # Lines overlap chunks differently every time since the block
+    # size is not a multiple of the chunk size.
+    block = (''.join(ROWS) * 1000).encode('utf-8')
+    ring = block * (CHUNK_SIZE // len(block) + 2)
+    offset = 0
+    sent = 0
+    while sent < size:
+        yield ring[offset:offset + CHUNK_SIZE]
+        offset = (offset + CHUNK_SIZE) % len(block)
+        sent += CHUNK_SIZE
+
+
+async def legacy_split_lines(stream):
+    leftover = ''
+    async for chunk in stream:
+        chunk_str = chunk.decode('utf-8')
+        chunk_str = leftover + chunk_str
+        chunk_str = chunk_str.lstrip('\n')
+        lines = chunk_str.split('\n')
+        leftover = lines.pop()
+        if lines:
+            yield lines
+
+
+async def count_lines(splitter, size):
+    count = 0
+    async for lines in splitter(synthetic_inventory(size)):
+        count += len(lines)
+    return count
+
+
+def run():
+    gigabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    size = int(gigabytes * 1024 ** 3)
+    loop = asyncio.get_event_loop()
+    counts = []
+    for name, splitter in (
+        ('before', legacy_split_lines),
+        ('after', split_lines),
+    ):
+        start = time.perf_counter()
+        count = loop.run_until_complete(count_lines(splitter, size))
+        elapsed = time.perf_counter() - start
+        counts.append(count)
+        print(f'{name:>7}: {size / elapsed / 1024 ** 2:8,.0f} MB/s '
+              f'({count:,} lines in {elapsed:.1f}s)')
+    assert counts[0] == counts[1], 'Splitters disagree'
+    loop.close()
+
+
+if __name__ == '__main__':
+    run()
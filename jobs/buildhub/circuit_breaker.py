@@ -0,0 +1,177 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+import time
+from collections import deque
+
+from decouple import config
+
+from buildhub.concurrency import overload_reason
+from buildhub.configure_markus import get_metrics
+
+
+# Requests fail fast for CIRCUIT_BREAKER_OPEN_SECONDS once this rate of
+# the last CIRCUIT_BREAKER_WINDOW requests failed (on timeouts, connection
+# errors, 429 and 5xx responses).
+CIRCUIT_BREAKER_ERROR_RATE = config(
+    'CIRCUIT_BREAKER_ERROR_RATE', default=0.5, cast=float
+)
+CIRCUIT_BREAKER_WINDOW = config('CIRCUIT_BREAKER_WINDOW', default=50, cast=int)
+CIRCUIT_BREAKER_MIN_REQUESTS = config(
+    'CIRCUIT_BREAKER_MIN_REQUESTS', default=20, cast=int
+)
+CIRCUIT_BREAKER_OPEN_SECONDS = config(
+    'CIRCUIT_BREAKER_OPEN_SECONDS', default=60, cast=float
+)
+# Every request adds this ratio of a retry to the budget of the run.
+RETRY_BUDGET_RATIO = config('RETRY_BUDGET_RATIO', default=0.2, cast=float)
+# Number of retries allowed before any request was made.
+RETRY_BUDGET_RESERVE = config('RETRY_BUDGET_RESERVE', default=50, cast=int)
+
+metrics = get_metrics('buildhub')
+
+
+class CircuitOpenError(Exception):
+    """Happens when a request is not made because the circuit breaker is
+    open."""
+
+
+class CircuitBreaker:
+    """Make requests fail fast while the server is failing.
+
+    The breaker opens once ``error_rate`` of the last ``window`` requests
+    failed. While open, requests raise ``CircuitOpenError`` without being
+    made. After ``open_seconds``, it half-opens: a single request is let
+    through, and the breaker closes if it succeeds, or opens again.
+
+    Usage::
+
+        async with breaker.call():
+            ...
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(
+        self,
+        error_rate=CIRCUIT_BREAKER_ERROR_RATE,
+        window=CIRCUIT_BREAKER_WINDOW,
+        min_requests=CIRCUIT_BREAKER_MIN_REQUESTS,
+        open_seconds=CIRCUIT_BREAKER_OPEN_SECONDS,
+    ):
+        self.error_rate = error_rate
+        self.min_requests = min(min_requests, window)
+        self.open_seconds = open_seconds
+        # Whether each of the last requests failed.
+        self._failures = deque(maxlen=window)
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if (
+            self._state == self.OPEN and
+            time.monotonic() >= self._opened_at + self.open_seconds
+        ):
+            self._state = self.HALF_OPEN
+        return self._state
+
+    def call(self):
+        """Return an async context manager that raises ``CircuitOpenError``
+        if the request can't be made, and records its outcome otherwise.
+        """
+        return _Call(self)
+
+    def check(self):
+        """Raise ``CircuitOpenError`` unless a request can be made.
+
+        :rtype: True if the request is the one let through to probe the
+        server, False otherwise.
+        """
+        state = self.state
+        if state == self.OPEN or (state == self.HALF_OPEN and self._probing):
+            metrics.incr('circuit_breaker_rejected')
+            raise CircuitOpenError()
+        if state == self.HALF_OPEN:
+            self._probing = True
+            return True
+        return False
+
+    def record(self, exception, probe=False):
+        if probe:
+            self._probing = False
+        if isinstance(exception, asyncio.CancelledError):
+            # Tells nothing about the server.
+            return
+        failed = overload_reason(exception) is not None
+        if probe:
+            if failed:
+                self._open()
+            else:
+                self._close()
+            return
+        if self._state != self.CLOSED:
+            # Made before the breaker opened.
+            return
+        self._failures.append(failed)
+        if (
+            len(self._failures) >= self.min_requests and
+            sum(self._failures) >= self.error_rate * len(self._failures)
+        ):
+            self._open()
+
+    async def wait(self):
+        """Wait until the breaker lets a request through again."""
+        if self.state == self.OPEN:
+            remaining = self._opened_at + self.open_seconds - time.monotonic()
+            await asyncio.sleep(max(0, remaining))
+
+    def _open(self):
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._failures.clear()
+        metrics.incr('circuit_breaker_opened')
+
+    def _close(self):
+        self._state = self.CLOSED
+        self._failures.clear()
+        metrics.incr('circuit_breaker_closed')
+
+
+class _Call:
+    def __init__(self, breaker):
+        self.breaker = breaker
+
+    async def __aenter__(self):
+        self.probe = self.breaker.check()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.breaker.record(exc, self.probe)
+
+
+class RetryBudget:
+    """Run-wide budget of retries, so that a failing server doesn't make
+    every request retry as many times as possible.
+
+    Every request adds ``ratio`` of a retry to the budget, and every retry
+    takes one. ``reserve`` retries are always allowed.
+    """
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, reserve=RETRY_BUDGET_RESERVE):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.requests = 0
+        self.retries = 0
+
+    def deposit(self):
+        self.requests += 1
+
+    def can_retry(self):
+        return self.retries + 1 <= self.reserve + self.ratio * self.requests
+
+    def withdraw(self):
+        self.retries += 1
@@ -0,0 +1,220 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+import time
+from collections import deque
+
+import aiohttp
+from decouple import config, Csv
+
+from buildhub.configure_markus import get_metrics
+from buildhub.http_session import HTTP_LIMIT_PER_HOST
+
+
+MIN_PARALLEL_REQUESTS = config('MIN_PARALLEL_REQUESTS', default=1, cast=int)
+MAX_PARALLEL_REQUESTS = config(
+    'MAX_PARALLEL_REQUESTS', default=HTTP_LIMIT_PER_HOST, cast=int
+)
+# The limit is raised as long as the average latency stays below this
+# factor of the lowest latency observed.
+PARALLEL_REQUESTS_LATENCY_TOLERANCE = config(
+    'PARALLEL_REQUESTS_LATENCY_TOLERANCE', default=2.0, cast=float
+)
+# Weights of the inventories processed at the same time, in the requests
+# to the archives, e.g. ``firefox:3, archive:1``. The default weight is 1.
+INVENTORY_SHARES = config('INVENTORY_SHARES', default='', cast=Csv())
+
+metrics = get_metrics('buildhub')
+
+
+def overload_reason(exception):
+    """Return why the server is considered overloaded when a request fails
+    with this exception, or None.
+    """
+    if isinstance(exception, asyncio.TimeoutError):
+        return 'timeout'
+    if isinstance(exception, aiohttp.ClientResponseError):
+        if exception.code == 429 or exception.code >= 500:
+            return str(exception.code)
+    elif isinstance(exception, aiohttp.ClientConnectionError):
+        return 'connection'
+    return None
+
+
+class AdaptiveLimiter:
+    """Limit the number of concurrent requests, adapting the limit to how
+    the server copes with them (AIMD).
+
+    While the limit is reached and the latency stays flat, it is raised by
+    one for every ``limit`` successful requests. It is cut by
+    ``decrease_factor`` when requests time out, or are answered with a 429
+    or 5xx status, but only once for all the requests that were started
+    before the previous cut.
+
+    The limit is reported in the ``<metric>_limit`` gauge, and the cuts
+    in the ``<metric>_overload`` counter.
+
+    Usage::
+
+        async with limiter.slot():
+            ...
+    """
+    def __init__(
+        self,
+        initial,
+        minimum=MIN_PARALLEL_REQUESTS,
+        maximum=MAX_PARALLEL_REQUESTS,
+        decrease_factor=0.5,
+        latency_tolerance=PARALLEL_REQUESTS_LATENCY_TOLERANCE,
+        smoothing=0.2,
+        metric='http_concurrency',
+    ):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.metric = metric
+        self.in_flight = 0
+        self._waiters = deque()
+        # Incremented at every cut of the limit.
+        self._epoch = 0
+        self._latency = None
+        self._min_latency = None
+
+    def slot(self):
+        """Return an async context manager that holds a slot while the
+        request is made, and adapts the limit to its outcome.
+        """
+        return _Slot(self)
+
+    async def acquire(self):
+        """Wait for a free slot.
+
+        :rtype: tuple ``(epoch, saturated)``, to be passed to
+        ``succeeded()`` or ``overloaded()``.
+        """
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Woken up, but give the slot to someone else.
+                    self._wake()
+                raise
+        self.in_flight += 1
+        return self._epoch, self.in_flight >= int(self.limit)
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def succeeded(self, latency, saturated):
+        if self._min_latency is None or latency < self._min_latency:
+            self._min_latency = latency
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency += self.smoothing * (latency - self._latency)
+        flat = self._latency <= self._min_latency * self.latency_tolerance
+        # Don't raise a limit that isn't reached.
+        if saturated and flat:
+            self._set_limit(self.limit + 1 / self.limit)
+
+    def overloaded(self, epoch, reason):
+        """Cut the limit, and return whether it was cut."""
+        metrics.incr(f'{self.metric}_overload', tags=['reason:' + reason])
+        if epoch != self._epoch:
+            # The limit was already cut since this request started.
+            return False
+        self._epoch += 1
+        self._set_limit(self.limit * self.decrease_factor)
+        return True
+
+    def _set_limit(self, limit):
+        limit = min(max(limit, self.minimum), self.maximum)
+        changed = int(limit) != int(self.limit)
+        self.limit = limit
+        if changed:
+            metrics.gauge(f'{self.metric}_limit', int(limit))
+            self._wake()
+
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+
+class _Slot:
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    async def __aenter__(self):
+        self.epoch, self.saturated = await self.limiter.acquire()
+        self.started = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        reason = overload_reason(exc)
+        if reason is not None:
+            self.limiter.overloaded(self.epoch, reason)
+        elif exc is None:
+            latency = time.monotonic() - self.started
+            self.limiter.succeeded(latency, self.saturated)
+        self.limiter.release()
+
+
+def parse_weights(values):
+    """Parse ``name:weight`` values into a dict."""
+    weights = {}
+    for value in values:
+        name, _, weight = value.partition(':')
+        weight = float(weight) if weight else 1.0
+        if weight <= 0:
+            raise ValueError(f'Invalid weight {value!r}')
+        weights[name.strip()] = weight
+    return weights
+
+
+class Shares:
+    """Split a number of concurrent requests between the consumers that
+    are running, according to their weights.
+
+    The share of each consumer is set to its ``concurrency`` attribute
+    (e.g. a ``MetadataFetcher``), and updated when a consumer joins or
+    leaves.
+    """
+    def __init__(self, total=MAX_PARALLEL_REQUESTS, weights=INVENTORY_SHARES):
+        self.total = total
+        if not isinstance(weights, dict):
+            weights = parse_weights(weights)
+        self.weights = weights
+        self._consumers = {}
+
+    def join(self, name, consumer):
+        self._consumers[name] = consumer
+        self._rebalance()
+
+    def leave(self, name):
+        self._consumers.pop(name, None)
+        self._rebalance()
+
+    def _rebalance(self):
+        total_weight = sum(
+            self.weights.get(name, 1.0) for name in self._consumers
+        )
+        for name, consumer in self._consumers.items():
+            weight = self.weights.get(name, 1.0)
+            share = max(1, round(self.total * weight / total_weight))
+            consumer.concurrency = share
+            metrics.gauge('inventory_concurrency_share', share, tags=[
+                f'inventory:{name}'
+            ])
@@ -0,0 +1,195 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import glob
+import hashlib
+import logging
+import os
+import tempfile
+import time
+
+from decouple import config
+
+from buildhub.configure_markus import get_metrics
+
+
+# The least recently used files are deleted when the downloaded files
+# exceed this size...
+CSV_DOWNLOAD_MAX_BYTES = config(
+    'CSV_DOWNLOAD_MAX_BYTES', default=10 * 1024 * 1024 * 1024, cast=int
+)
+# ...or when they were not used for this long.
+CSV_DOWNLOAD_MAX_AGE_HOURS = config(
+    'CSV_DOWNLOAD_MAX_AGE_HOURS', default=48, cast=float
+)
+
+logger = logging.getLogger()  # root logger.
+metrics = get_metrics('buildhub')
+
+
+class ChecksumError(Exception):
+    """The content of a download doesn't match its checksum."""
+
+
+class DownloadCache:
+    """Files of the inventories, stored in a directory under the name of
+    their MD5 checksum.
+
+    Files are written to a temporary file and moved in place once their
+    checksum was verified, so that a truncated download is never reused.
+    """
+    SUFFIX = '.csv.gz'
+    PARTIAL_SUFFIX = '.part'
+
+    def __init__(
+        self,
+        directory,
+        max_bytes=CSV_DOWNLOAD_MAX_BYTES,
+        max_age=CSV_DOWNLOAD_MAX_AGE_HOURS * 60 * 60,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def path(self, files):
+        """Return the local path of the file of this manifest entry."""
+        return os.path.join(self.directory, files['MD5checksum'] + self.SUFFIX)
+
+    def get(self, files):
+        """Return the local path of the file of this manifest entry if it
+        was downloaded, or None.
+        """
+        file_path = self.path(files)
+        try:
+            size = os.stat(file_path).st_size
+        except FileNotFoundError:
+            metrics.incr('download_cache_miss')
+            return None
+        # Mark it as recently used.
+        os.utime(file_path)
+        metrics.incr('download_cache_hit')
+        metrics.incr('download_cache_bytes_saved', size)
+        return file_path
+
+    def download(self, files):
+        """Return a ``Download`` for the file of this manifest entry."""
+        os.makedirs(self.directory, exist_ok=True)
+        return Download(self, files)
+
+    def entries(self):
+        """Return the (path, size, last use) of the downloaded files."""
+        entries = []
+        pattern = os.path.join(self.directory, '*' + self.SUFFIX)
+        for file_path in glob.glob(pattern):
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            entries.append((file_path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def clean(self):
+        """Delete the partial downloads, and the files that were not used
+        for ``max_age`` seconds.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        pattern = os.path.join(self.directory, '*' + self.PARTIAL_SUFFIX)
+        for file_path in glob.glob(pattern):
+            logger.info(f'Delete partial download file {file_path}')
+            os.remove(file_path)
+
+        now = time.time()
+        for file_path, size, last_use in self.entries():
+            age = now - last_use
+            if age > self.max_age:
+                logger.info(
+                    f'Delete old download file {file_path} '
+                    f'({age} seconds old)'
+                )
+                self._evict(file_path, size)
+        self.evict()
+
+    def evict(self, keep=None):
+        """Delete the least recently used files until the downloaded files
+        don't exceed ``max_bytes``.
+
+        :param keep: path of a file that is never deleted.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for file_path, size, _ in sorted(entries, key=lambda e: e[2]):
+            if total <= self.max_bytes:
+                break
+            if file_path == keep:
+                continue
+            logger.info(f'Evict download file {file_path} ({size} bytes)')
+            self._evict(file_path, size)
+            total -= size
+        metrics.gauge('download_cache_size', total)
+
+    def _evict(self, file_path, size):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            return
+        metrics.incr('download_cache_evicted')
+        metrics.incr('download_cache_evicted_bytes', size)
+
+
+class Download:
+    """Temporary file that becomes a cached file once completely written.
+
+    Used as a context manager: the file is verified and moved in place if
+    the block succeeds, and deleted otherwise.
+    """
+    def __init__(self, cache, files):
+        self.cache = cache
+        self.path = cache.path(files)
+        self.checksum = files['MD5checksum']
+        fd, self.partial_path = tempfile.mkstemp(
+            dir=cache.directory,
+            prefix=files['MD5checksum'] + '-',
+            suffix=cache.PARTIAL_SUFFIX,
+        )
+        self.destination = os.fdopen(fd, 'wb')
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, chunk):
+        # Writes are buffered, they don't need to be done in a thread.
+        self.destination.write(chunk)
+        self.md5.update(chunk)
+        self.size += len(chunk)
+
+    def flush(self):
+        """Make the chunks written so far readable from ``partial_path``."""
+        self.destination.flush()
+
+    def commit(self):
+        self.destination.close()
+        if self.md5.hexdigest() != self.checksum:
+            metrics.incr('download_cache_corrupted')
+            raise ChecksumError(
+                f'{self.path} has checksum {self.md5.hexdigest()} '
+                f'instead of {self.checksum} ({self.size} bytes)'
+            )
+        os.replace(self.partial_path, self.path)
+        self.cache.evict(keep=self.path)
+
+    def abort(self):
+        self.destination.close()
+        if os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            try:
+                self.commit()
+            finally:
+                self.abort()
+        else:
+            self.abort()
@@ -0,0 +1,116 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+import math
+from collections import deque
+
+from decouple import config
+
+from buildhub.configure_markus import get_metrics
+
+
+HEDGE_REQUESTS = config('HEDGE_REQUESTS', default=False, cast=bool)
+# A duplicate request is sent when a response takes longer than this
+# percentile of the latencies recently observed...
+HEDGE_PERCENTILE = config('HEDGE_PERCENTILE', default=95, cast=float)
+# ...unless this ratio of the requests were already duplicated.
+HEDGE_MAX_RATE = config('HEDGE_MAX_RATE', default=0.05, cast=float)
+HEDGE_WINDOW = config('HEDGE_WINDOW', default=200, cast=int)
+HEDGE_MIN_SAMPLES = config('HEDGE_MIN_SAMPLES', default=20, cast=int)
+
+metrics = get_metrics('buildhub')
+
+
+def percentile(values, p):
+    """Return the ``p``-th percentile (nearest-rank) of ``values``."""
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class Hedger:
+    """Send a duplicate of the requests that are slower than most, and use
+    whichever response comes first. The other request is cancelled.
+
+    Usage::
+
+        result = await hedger.run(lambda: make_request(...))
+
+    ``make_request()`` reports how long its responses take with
+    ``observe()``, from when the request is sent: the time spent waiting
+    for a slot doesn't count, or a saturated limiter would trigger hedges,
+    which would wait for a slot too.
+    """
+    def __init__(
+        self,
+        enabled=HEDGE_REQUESTS,
+        percentile=HEDGE_PERCENTILE,
+        max_rate=HEDGE_MAX_RATE,
+        window=HEDGE_WINDOW,
+        min_samples=HEDGE_MIN_SAMPLES,
+    ):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self.requests = 0
+        self.hedged = 0
+        self._latencies = deque(maxlen=window)
+
+    def delay(self):
+        """Return how long to wait for a response before sending a
+        duplicate request, or None if not enough latencies were observed.
+        """
+        if len(self._latencies) < max(1, self.min_samples):
+            return None
+        return percentile(self._latencies, self.percentile)
+
+    def observe(self, latency):
+        """Record the latency of a successful response."""
+        if self.enabled:
+            self._latencies.append(latency)
+
+    def can_hedge(self):
+        return self.hedged + 1 <= self.max_rate * self.requests
+
+    async def run(self, request):
+        """Return the result of the coroutine made by ``request()``,
+        or of its duplicate.
+        """
+        if not self.enabled:
+            return await request()
+        self.requests += 1
+        first = asyncio.ensure_future(request())
+        tasks = [first]
+        try:
+            delay = self.delay()
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self.can_hedge():
+                    self.hedged += 1
+                    metrics.incr('http_hedge_sent')
+                    tasks.append(asyncio.ensure_future(request()))
+            done, pending = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED
+            )
+            succeeded = [task for task in done if task.exception() is None]
+            if succeeded:
+                task = succeeded[0]
+            elif pending:
+                # The other request may still succeed.
+                task = pending.pop()
+                await asyncio.wait([task])
+            else:
+                task = done.pop()
+            if task is not first:
+                metrics.incr('http_hedge_won')
+            return task.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    # Don't warn about exceptions of the discarded task.
+                    task.exception()
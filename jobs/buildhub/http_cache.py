@@ -0,0 +1,101 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import re
+from collections import namedtuple
+
+from decouple import config
+
+from buildhub.configure_markus import get_metrics
+
+
+# JSON files that never change once published (the metadata of nightly
+# and candidates builds) are not cached: their content is kept by the
+# ``MetadataCache`` of their namespace already. Other URLs (e.g. the
+# listings of candidates folders) are cached and revalidated.
+HTTP_CACHE_IMMUTABLE_URLS = config(
+    'HTTP_CACHE_IMMUTABLE_URLS',
+    default=r'(/nightly/\d{4}/\d{2}/|-candidates/build\d+/).+\.json$'
+)
+
+metrics = get_metrics('buildhub')
+
+
+CachedResponse = namedtuple(
+    'CachedResponse', ('etag', 'last_modified', 'body', 'size')
+)
+
+
+class HTTPCache:
+    """Cache of the JSON responses of the archives, stored in an attached
+    ``MetadataStore``.
+
+    Responses are revalidated with ``If-None-Match`` and
+    ``If-Modified-Since``. Those whose URL matches the ``immutable_urls``
+    pattern are not cached. Without a store, nothing is cached.
+    """
+    def __init__(self, immutable_urls=HTTP_CACHE_IMMUTABLE_URLS):
+        self.immutable_urls = re.compile(immutable_urls)
+        self.store = None
+
+    def attach(self, store):
+        self.store = store
+
+    def detach(self):
+        self.store = None
+
+    def cacheable(self, url):
+        return self.immutable_urls.search(url) is None
+
+    def get(self, url):
+        """
+        :rtype: a ``CachedResponse``, or None.
+        """
+        if self.store is None or not self.cacheable(url):
+            return None
+        row = self.store.get_response(url)
+        if row is None:
+            return None
+        return CachedResponse(*row)
+
+    def put(self, url, headers, data, size):
+        """Cache the response data if it can be reused later."""
+        if self.store is None or not self.cacheable(url):
+            return
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not (etag or last_modified):
+            return
+        self.store.put_response(
+            url, etag, last_modified, json.dumps(data), size
+        )
+
+    @staticmethod
+    def conditional_headers(cached):
+        headers = {}
+        if cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+        return headers
+
+    @staticmethod
+    def load(cached, status, elapsed):
+        """Return the data of a cached response that was used instead of
+        downloading it again, and report it in the metrics.
+        """
+        metrics.incr('http_cache_{}'.format(status))
+        metrics.incr('http_cache_bytes_saved', cached.size)
+        metrics.timing(
+            'http_cache_fetch', elapsed * 1000, tags=['cache:' + status]
+        )
+        return json.loads(cached.body)
+
+    @staticmethod
+    def miss(elapsed):
+        metrics.incr('http_cache_miss')
+        metrics.timing(
+            'http_cache_fetch', elapsed * 1000, tags=['cache:miss']
+        )
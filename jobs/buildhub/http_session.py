@@ -0,0 +1,83 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import aiohttp
+from decouple import config
+
+from buildhub.configure_markus import get_metrics
+
+
+# Max. number of simultaneous connections to a single host.
+HTTP_LIMIT_PER_HOST = config('HTTP_LIMIT_PER_HOST', default=16, cast=int)
+# How long to keep idle connections open, to be reused.
+HTTP_KEEPALIVE_SECONDS = config(
+    'HTTP_KEEPALIVE_SECONDS', default=30, cast=float
+)
+HTTP_DNS_CACHE_SECONDS = config(
+    'HTTP_DNS_CACHE_SECONDS', default=300, cast=int
+)
+HTTP_CONNECT_TIMEOUT_SECONDS = config(
+    'HTTP_CONNECT_TIMEOUT_SECONDS', default=10, cast=float
+)
+TIMEOUT_SECONDS = config('TIMEOUT_SECONDS', default=5 * 60, cast=int)
+
+USER_AGENT = 'BuildHub;storage-team@mozilla.com'
+
+metrics = get_metrics('buildhub')
+
+
+class MeteredTCPConnector(aiohttp.TCPConnector):
+    """TCP connector that reports how long it takes to open connections,
+    and how many requests reuse an open one.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.acquired = 0
+        self.created = 0
+
+    async def connect(self, req):
+        connection = await super().connect(req)
+        self.acquired += 1
+        metrics.incr('http_connection_acquired')
+        return connection
+
+    async def _create_connection(self, req):
+        with metrics.timer('http_connection_connect'):
+            protocol = await super()._create_connection(req)
+        self.created += 1
+        metrics.incr('http_connection_created')
+        return protocol
+
+    @property
+    def reuse_ratio(self):
+        if not self.acquired:
+            return 0
+        return 1 - self.created / self.acquired
+
+    def close(self):
+        if self.acquired:
+            metrics.gauge('http_connection_reuse_ratio', self.reuse_ratio)
+        return super().close()
+
+
+def create_session(loop):
+    """Return the ``aiohttp.ClientSession`` to use for archive requests.
+
+    Connections are kept alive to be reused, host names are resolved
+    once for a while, and requests time out.
+    """
+    connector = MeteredTCPConnector(
+        limit_per_host=HTTP_LIMIT_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_SECONDS,
+        use_dns_cache=True,
+        ttl_dns_cache=HTTP_DNS_CACHE_SECONDS,
+        loop=loop,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers={'User-Agent': USER_AGENT},
+        conn_timeout=HTTP_CONNECT_TIMEOUT_SECONDS,
+        read_timeout=TIMEOUT_SECONDS,
+        loop=loop,
+    )
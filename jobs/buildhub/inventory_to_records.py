@@ -5,14 +5,19 @@
 import argparse
 import asyncio
 import async_timeout
+import contextlib
 import csv
+import datetime
+import functools
 import json
 import logging
+import operator
 import os
 import pkg_resources
 import re
 import sys
-from collections import defaultdict
+import time
+from collections import deque
 
 import aiohttp
 import backoff
@@ -20,12 +25,23 @@ import ciso8601
 from decouple import config
 
 from buildhub.utils import (
-    archive_url, chunked, is_release_build_metadata, is_build_url,
-    record_from_url, localize_nightly_url, merge_metadata, check_record,
+    archive_url, is_release_build_metadata, record_from_url,
+    localize_nightly_url, merge_metadata, check_record,
     localize_release_candidate_url, stream_as_generator, split_lines,
-    key_to_archive_url,
+    key_to_archive_url, hash_record, KeyClassifier,
     FILE_EXTENSIONS, DATETIME_FORMAT, ALL_PRODUCTS
 )
+from buildhub.circuit_breaker import (
+    CircuitBreaker, CircuitOpenError, RetryBudget
+)
+from buildhub.concurrency import AdaptiveLimiter, overload_reason
+from buildhub.configure_markus import get_metrics
+from buildhub.hedging import Hedger
+from buildhub.http_cache import HTTPCache
+from buildhub.http_session import create_session, USER_AGENT
+from buildhub.metadata_store import (
+    MetadataCache, MetadataStore, import_json_cache, STORE_FILENAME
+)
 
 
 NB_PARALLEL_REQUESTS = config('NB_PARALLEL_REQUESTS', default=8, cast=int)
@@ -36,8 +52,24 @@ PRODUCTS = config(
     cast=lambda v: [s.strip() for s in v.split()]
 )
 CACHE_FOLDER = config('CACHE_FOLDER', default='.')
+# The latest build folder of the candidates of versions released in the
+# last CANDIDATES_RECENT_DAYS is looked up again after
+# CANDIDATES_REFRESH_TTL_HOURS. Older ones don't change anymore.
+CANDIDATES_RECENT_DAYS = config(
+    'CANDIDATES_RECENT_DAYS', default=7, cast=float
+)
+CANDIDATES_REFRESH_TTL_HOURS = config(
+    'CANDIDATES_REFRESH_TTL_HOURS', default=1, cast=float
+)
+ORDERED_RECORDS = config('ORDERED_RECORDS', default=True, cast=bool)
+# How many times the records whose metadata could not be fetched while the
+# circuit breaker was open are tried again, at the end of the run.
+DEFERRED_RECORDS_ROUNDS = config(
+    'DEFERRED_RECORDS_ROUNDS', default=3, cast=int
+)
 
 logger = logging.getLogger()  # root logger.
+metrics = get_metrics('buildhub')
 
 # Module version, as defined in PEP-0396.
 try:
@@ -46,24 +78,133 @@ except pkg_resources.DistributionNotFound:
     __version__ = '0.1.dev'
 
 
+_http_cache = HTTPCache()
+# Requests to the archives are limited to the concurrency they can cope
+# with, starting at NB_PARALLEL_REQUESTS.
+_request_limiter = AdaptiveLimiter(NB_PARALLEL_REQUESTS)
+# Requests fail fast while the archives are failing, and retries are
+# limited for the whole run.
+_circuit_breaker = CircuitBreaker()
+_retry_budget = RetryBudget()
+# Optionally, slow requests are sent twice.
+_hedger = Hedger()
+
+
 class JSONFileNotFound(Exception):
     """Happens when we try to fetch a JSON URL and the response is a 404"""
 
 
-async def read_csv(input_generator):
+INVENTORY_FIELDNAMES = ('Bucket', 'Key', 'Size', 'LastModifiedDate', 'md5')
+
+
+class _LinesFeed:
+    """Iterator of decoded lines that can be refilled once exhausted.
+
+    Lets a single ``csv.reader`` consume the whole inventory, one batch of
+    lines at a time.
+    """
+    def __init__(self):
+        self._lines = iter(())
+
+    def feed(self, lines):
+        self._lines = map(bytes.decode, lines)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._lines)
+
+
+async def read_csv(input_generator, columns=None):
     """
     :param input_generator: async generator of raw bytes
+    :param columns: optional list of field names. If specified, rows are
+    yielded as tuples of these columns' values instead of dicts.
     """
-    fieldnames = ['Bucket', 'Key', 'Size', 'LastModifiedDate', 'md5']
+    if columns is None:
+        async for lines in split_lines(input_generator):
+            reader = csv.DictReader(
+                (line.decode('utf-8') for line in lines),
+                fieldnames=INVENTORY_FIELDNAMES
+            )
+            for row in reader:
+                yield row
+        return
+
+    indices = [INVENTORY_FIELDNAMES.index(column) for column in columns]
+    min_length = max(indices) + 1
+    if len(indices) == 1:
+        def project(row, index=indices[0]):
+            return (row[index],)
+    else:
+        project = operator.itemgetter(*indices)
+    lines_feed = _LinesFeed()
+    reader = csv.reader(lines_feed)
     async for lines in split_lines(input_generator):
-        reader = csv.DictReader(lines, fieldnames=fieldnames)
+        lines_feed.feed(lines)
         for row in reader:
-            yield row
+            # Skip blank (or truncated) lines.
+            if len(row) < min_length:
+                continue
+            yield project(row)
+
+
+_in_flight_fetches = {}
 
 
+def single_flight(fetch):
+    """Decorator so that concurrent calls for the same URL (and the same
+    arguments) share a single fetch, instead of issuing the same request
+    several times (e.g. the en-US metadata of several locales).
+    Callers get the same result object.
+    """
+    @functools.wraps(fetch)
+    async def wrapper(session, url, *args, **kwargs):
+        key = (session, url, args, tuple(sorted(kwargs.items())))
+        future = _in_flight_fetches.get(key)
+        if future is not None:
+            metrics.incr('inventory_to_records_fetch_coalesced')
+        else:
+            future = asyncio.ensure_future(
+                fetch(session, url, *args, **kwargs)
+            )
+            _in_flight_fetches[key] = future
+            future.add_done_callback(
+                lambda f: _in_flight_fetches.pop(key, None)
+            )
+        # Cancelling one of the callers doesn't cancel the others.
+        return await asyncio.shield(future)
+
+    return wrapper
+
+
+def _giveup(exception):
+    """Don't retry once the circuit breaker is open, or the retry budget is
+    spent."""
+    if _circuit_breaker.state == CircuitBreaker.OPEN:
+        return True
+    if not _retry_budget.can_retry():
+        metrics.incr('retry_budget_exhausted')
+        return True
+    return False
+
+
+def _overloaded(exception):
+    """Return whether the archives answered that they are overloaded (429
+    or 5xx), didn't answer in time or dropped the connection, rather than
+    the file being missing. The metadata of the record is then not
+    recorded as missing.
+    """
+    return overload_reason(exception) is not None
+
+
+@single_flight
 @backoff.on_exception(backoff.expo,
                       (aiohttp.ClientResponseError, asyncio.TimeoutError),
-                      max_tries=NB_RETRY_REQUEST)
+                      max_tries=NB_RETRY_REQUEST,
+                      giveup=_giveup,
+                      on_backoff=lambda details: _retry_budget.withdraw())
 async def fetch_json(
     session,
     url,
@@ -82,37 +223,91 @@ async def fetch_json(
     happen due to the latency of a slow update in
     archive.mozilla.org so if you just back off and try again
     in a couple of seconds it will work.
+
+    Raises ``CircuitOpenError`` without making the request while the
+    circuit breaker is open.
+
+    With ``HEDGE_REQUESTS``, a duplicate request is sent if the response
+    is slower than most, and the first response is used.
     """
     headers = {
         'Accept': 'application/json',
         'Cache': 'no-cache',
-        'User-Agent': 'BuildHub;storage-team@mozilla.com'
+        'User-Agent': USER_AGENT
     }
+    started = time.time()
+    cached = _http_cache.get(url)
+    if cached is not None:
+        # Let intermediaries answer with 304 too.
+        del headers['Cache']
+        headers.update(_http_cache.conditional_headers(cached))
+    _retry_budget.deposit()
+
+    async def get():
+        async with _circuit_breaker.call(), _request_limiter.slot():
+            with async_timeout.timeout(timeout):
+                logger.debug("GET '{}'".format(url))
+                # Without the wait for a slot.
+                sent = time.monotonic()
+                async with session.get(
+                    url,
+                    headers=headers,
+                    timeout=None
+                ) as response:
+                    if response.status == 304 and cached is not None:
+                        _hedger.observe(time.monotonic() - sent)
+                        return _http_cache.load(
+                            cached, 'revalidated', time.time() - started
+                        )
+
+                    if response.status == 404 and not retry_on_notfound:
+                        raise JSONFileNotFound(url)
+
+                    response.raise_for_status()
+                    try:
+                        data = await response.json()
+                    except aiohttp.ClientResponseError as e:
+                        # Some JSON files are served with wrong content-type.
+                        data = await response.json(
+                            content_type='application/octet-stream'
+                        )
+                    if _http_cache.cacheable(url):
+                        _http_cache.miss(time.time() - started)
+                        body = await response.read()
+                        _http_cache.put(
+                            url, response.headers, data, len(body)
+                        )
+                    _hedger.observe(time.monotonic() - sent)
+                    return data
+
     try:
+        return await _hedger.run(get)
+    except asyncio.TimeoutError:
+        logger.error("Timeout on GET '{}'".format(url))
+        raise
+
+
+async def fetch_text(session, url, timeout=TIMEOUT_SECONDS):
+    """Return response text by the URL."""
+    async with _circuit_breaker.call(), _request_limiter.slot():
         with async_timeout.timeout(timeout):
             logger.debug("GET '{}'".format(url))
             async with session.get(
                 url,
-                headers=headers,
+                headers={'User-Agent': USER_AGENT},
                 timeout=None
             ) as response:
-                if response.status == 404 and not retry_on_notfound:
-                    raise JSONFileNotFound(url)
-
                 response.raise_for_status()
-                try:
-                    return await response.json()
-                except aiohttp.ClientResponseError as e:
-                    # Some JSON files are served with wrong content-type.
-                    return await response.json(
-                        content_type='application/octet-stream'
-                    )
-    except asyncio.TimeoutError:
-        logger.error("Timeout on GET '{}'".format(url))
-        raise
+                return await response.text()
 
 
 async def fetch_listing(session, url, retry_on_notfound=False):
+    """Return the folders and files listed at this URL.
+
+    Raises ``ValueError`` if the listing can't be fetched, except when the
+    archives are overloaded (429 or 5xx) or the connection fails, so that
+    callers don't mistake an outage for a missing folder.
+    """
     try:
         data = await fetch_json(
             session,
@@ -121,6 +316,8 @@ async def fetch_listing(session, url, retry_on_notfound=False):
         )
         return data['prefixes'], data['files']
     except (aiohttp.ClientError, KeyError, ValueError) as e:
+        if _overloaded(e):
+            raise
         raise ValueError("Could not fetch '{}': {}".format(url, e))
 
 
@@ -138,7 +335,7 @@ async def fetch_metadata(session, record):
     return None
 
 
-_nightly_metadata = {}
+_nightly_metadata = MetadataCache('nightly')
 
 
 async def fetch_nightly_metadata(session, record):
@@ -152,8 +349,9 @@ async def fetch_nightly_metadata(session, record):
     # Make sure the nightly_url is turned into a en-US one.
     nightly_url = localize_nightly_url(url)
 
-    if nightly_url in _nightly_metadata:
-        return _nightly_metadata[nightly_url]
+    found, metadata = _nightly_metadata.lookup(nightly_url)
+    if found:
+        return metadata
 
     extensions = '|'.join(FILE_EXTENSIONS)
 
@@ -177,42 +375,43 @@ async def fetch_nightly_metadata(session, record):
                 '.txt',
                 nightly_url
             )
-            async with session.get(old_metadata_url) as response:
-                old_metadata = await response.text()
-                m = re.search('^(\d+)\n(http.+)/rev/(.+)$', old_metadata)
-                if m:
-                    metadata = {
-                        'buildid': m.group(1),
-                        'moz_source_repo': m.group(2),
-                        'moz_source_stamp': m.group(3),
-                    }
-                    _nightly_metadata[nightly_url] = metadata
-                    return metadata
-                # e.g.
-                # https://archive.mozilla.org/pub/firefox/nightly/2010/07/2010-07-04-05-mozilla-central/firefox-4.0b2pre.en-US.win64-x86_64.txt
-                m = re.search('^(\d+) (.+)$', old_metadata)
-                if m:
-                    metadata = {
-                        'buildid': m.group(1),
-                        'moz_source_stamp': m.group(2),
-                        'moz_source_repo': (
-                            'http://hg.mozilla.org/mozilla-central'
-                        ),
-                    }
-                    _nightly_metadata[nightly_url] = metadata
-                    return metadata
-        except aiohttp.ClientError as e:
-            pass
+            old_metadata = await fetch_text(session, old_metadata_url)
+            m = re.search('^(\d+)\n(http.+)/rev/(.+)$', old_metadata)
+            if m:
+                metadata = {
+                    'buildid': m.group(1),
+                    'moz_source_repo': m.group(2),
+                    'moz_source_stamp': m.group(3),
+                }
+                _nightly_metadata[nightly_url] = metadata
+                return metadata
+            # e.g.
+            # https://archive.mozilla.org/pub/firefox/nightly/2010/07/2010-07-04-05-mozilla-central/firefox-4.0b2pre.en-US.win64-x86_64.txt
+            m = re.search('^(\d+) (.+)$', old_metadata)
+            if m:
+                metadata = {
+                    'buildid': m.group(1),
+                    'moz_source_stamp': m.group(2),
+                    'moz_source_repo': (
+                        'http://hg.mozilla.org/mozilla-central'
+                    ),
+                }
+                _nightly_metadata[nightly_url] = metadata
+                return metadata
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if _overloaded(e):
+                raise
 
         logger.warning(
             f"Could not fetch metadata for '{record['id']}' "
             f"from '{metadata_url}'"
         )
-        _nightly_metadata[url] = None  # Don't try it anymore.
+        # Don't try it again until the TTL of missing metadata expires.
+        _nightly_metadata[nightly_url] = None
         return None
 
 
-_rc_metadata = {}
+_rc_metadata = MetadataCache('rc')
 
 
 async def fetch_release_candidate_metadata(session, record):
@@ -226,8 +425,9 @@ async def fetch_release_candidate_metadata(session, record):
     # Make sure the rc URL is turned into a en-US one.
     rc_url = localize_release_candidate_url(url)
 
-    if rc_url in _rc_metadata:
-        return _rc_metadata[rc_url]
+    found, metadata = _rc_metadata.lookup(rc_url)
+    if found:
+        return metadata
 
     product = record['source']['product']
     if product == 'devedition':
@@ -246,13 +446,16 @@ async def fetch_release_candidate_metadata(session, record):
     try:
         metadata = await fetch_json(session, metadata_url)
     except aiohttp.ClientError as e:
+        if _overloaded(e):
+            raise
         # Old RC like https://archive.mozilla.org/pub/firefox/releases/1.0rc1/
         # don't have metadata.
         logger.warning(
             f"Could not fetch metadata for '{record['id']}' "
             f"from '{metadata_url}'"
         )
-        _rc_metadata[rc_url] = None  # Don't try it anymore.
+        # Don't try it again until the TTL of missing metadata expires.
+        _rc_metadata[rc_url] = None
         return None
 
     m = re.search('/build(\d+)/', url)
@@ -262,63 +465,90 @@ async def fetch_release_candidate_metadata(session, record):
     return metadata
 
 
-_candidates_build_folder = defaultdict(dict)
+# Entries like ``{'build_folder': 'build3/', 'refresh_after': None}``
+# indexed by ``'{product}/{version}'``.
+_candidates_build_folder = MetadataCache('candidates')
 
 
-async def scan_candidates(session, product):
-    # For each version take the latest build.
-    global _candidates_build_folder
+async def fetch_latest_build_folder(session, product, version, recent=True):
+    """Return the latest build folder of the candidates of this version
+    (e.g. ``'build3/'``), or None if the version is not listed in
+    candidates.
 
+    The result is kept in the candidates index. If the version is
+    ``recent``, a new build may still show up, so it is looked up
+    again after ``CANDIDATES_REFRESH_TTL_HOURS``. Overload and connection
+    errors are raised, and nothing is kept.
+    """
     if product == 'mobile':
         product = 'fennec'
 
-    if product in _candidates_build_folder:
-        return
+    key = '{}/{}'.format(product, version)
+    found, entry = _candidates_build_folder.lookup(key)
+    if found:
+        if entry is None:
+            return None
+        refresh_after = entry['refresh_after']
+        if refresh_after is None or time.time() < refresh_after:
+            return entry['build_folder']
 
-    logger.info(
-        f"Scan '{product}' candidates to get their latest build folder..."
-    )
-    candidates_url = archive_url(product, candidate='/')
-    candidates_folders, _ = await fetch_listing(session, candidates_url)
-
-    for chunk in chunked(candidates_folders, NB_PARALLEL_REQUESTS):
-        futures = []
-        versions = []
-        for folder in chunk:
-            if '-candidates' not in folder:
-                continue
-            version = folder.replace('-candidates/', '')
-            versions.append(version)
-            builds_url = archive_url(product, version, candidate='/')
-            future = fetch_listing(session, builds_url)
-            futures.append(future)
-        listings = await asyncio.gather(*futures)
+    builds_url = archive_url(product, version, candidate='/')
+    try:
+        build_folders, _ = await fetch_listing(session, builds_url)
+    except JSONFileNotFound as e:
+        logger.info(f"No candidates for {product} {version}: {e}")
+        build_folders = []
+    except ValueError as e:
+        # Not kept, it may be listed next time.
+        logger.warning(e)
+        return None
+    if not build_folders:
+        _candidates_build_folder[key] = None
+        return None
 
-        for version, (build_folders, _) in zip(versions, listings):
-            latest_build_folder = sorted(
-                build_folders,
-                key=lambda x: re.sub("[^0-9]", "", x).zfill(3)
-            )[-1]
-            _candidates_build_folder[product][version] = latest_build_folder
+    latest_build_folder = sorted(
+        build_folders,
+        key=lambda x: re.sub("[^0-9]", "", x).zfill(3)
+    )[-1]
+    refresh_after = None
+    if recent:
+        refresh_after = time.time() + CANDIDATES_REFRESH_TTL_HOURS * 3600
+    _candidates_build_folder[key] = {
+        'build_folder': latest_build_folder,
+        'refresh_after': refresh_after,
+    }
+    return latest_build_folder
+
+
+def is_recent(record):
+    """Return whether the archive of this record was published in the
+    last ``CANDIDATES_RECENT_DAYS``.
+    """
+    date = record.get('download', {}).get('date')
+    if date is None:
+        return True
+    age = datetime.datetime.now(datetime.timezone.utc) - (
+        ciso8601.parse_datetime(date)
+    )
+    return age < datetime.timedelta(days=CANDIDATES_RECENT_DAYS)
 
 
-_release_metadata = {}
+_release_metadata = MetadataCache('release')
 
 
 async def fetch_release_metadata(session, record):
     """The `candidates` folder contains build info about recent
     released versions.
     """
-    global _candidates_build_folder
-
     product = record['source']['product']
     version = record['target']['version']
     platform = record['target']['platform']
     locale = 'en-US'
 
-    try:
-        latest_build_folder = _candidates_build_folder[product][version]
-    except KeyError:
+    latest_build_folder = await fetch_latest_build_folder(
+        session, product, version, recent=is_recent(record)
+    )
+    if latest_build_folder is None:
         # Version is not listed in candidates. Give up.
         return None
 
@@ -332,12 +562,13 @@ async def fetch_release_metadata(session, record):
     )
 
     # We already have the metadata for this platform and version.
-    if url in _release_metadata:
-        return _release_metadata[url]
+    found, metadata = _release_metadata.lookup(url)
+    if found:
+        return metadata
 
     try:
         _, files = await fetch_listing(session, url)
-    except ValueError:
+    except (JSONFileNotFound, ValueError):
         # Some partial update don't have metadata. eg. /47.0.1-candidates/
         _release_metadata[url] = None
         return None
@@ -351,22 +582,164 @@ async def fetch_release_metadata(session, record):
                 _release_metadata[url] = metadata
                 return metadata
             except aiohttp.ClientError as e:
+                if _overloaded(e):
+                    raise
                 # Sometimes, some XML comes out \o/ (see #259)
-                pass
 
     # Version exists in candidates but has no metadata!
-    _release_metadata[url] = None  # Don't try it anymore.
+    # Don't try it again until the TTL of missing metadata expires.
+    _release_metadata[url] = None
     raise ValueError('Missing metadata for candidate {}'.format(url))
 
 
-async def process_batch(session, batch, skip_incomplete):
-    # Parallel fetch of metadata for each item of the batch.
-    logger.debug('Fetch metadata for {} releases...'.format(len(batch)))
-    futures = [fetch_metadata(session, record) for record in batch]
-    metadatas = await asyncio.gather(*futures)
-    results = [merge_metadata(record, metadata)
-               for record, metadata in zip(batch, metadatas)]
-    for result in results:
+_DEFERRED = object()
+
+
+class MetadataFetcher:
+    """Fetch the metadata of records while keeping up to ``concurrency``
+    requests in flight.
+
+    A new fetch starts as soon as a slot is free, so one slow response
+    doesn't hold back the others (nor the reading of the inventory).
+    With ``ordered``, results come out in the order the records were
+    submitted, and at most ``max_pending`` of them (by default, four times
+    the ``concurrency``, which ``Shares`` may change) are held back behind
+    a slow one. Otherwise, they come out as soon as they are fetched.
+
+    Records whose metadata can't be fetched because the circuit breaker
+    is open, or because the archives are overloaded (timeouts, 429 or 5xx
+    responses, connection errors), are deferred: they are tried again by
+    ``drain()``, once requests are let through again.
+    """
+    def __init__(
+        self,
+        session,
+        concurrency=NB_PARALLEL_REQUESTS,
+        ordered=ORDERED_RECORDS,
+        max_pending=None,
+    ):
+        self.session = session
+        self.concurrency = max(1, concurrency)
+        self.ordered = ordered
+        self._max_pending = max_pending
+        # (record, future) tuples, in submission order.
+        self._pending = deque()
+        self._in_flight = set()
+        self.deferred = []
+
+    @property
+    def max_pending(self):
+        return self._max_pending or self.concurrency * 4
+
+    async def submit(self, record):
+        """Start fetching the metadata of ``record``, once there is a free
+        slot.
+
+        :rtype: list of ``(record, metadata)`` tuples that are now ready.
+        """
+        ready = []
+        while (
+            len(self._in_flight) >= self.concurrency or
+            len(self._pending) >= self.max_pending
+        ):
+            await self._wait()
+            ready.extend(self._ready())
+        future = asyncio.ensure_future(self._fetch(record))
+        self._in_flight.add(future)
+        self._pending.append((record, future))
+        self._report()
+        ready.extend(self._ready())
+        return ready
+
+    async def drain(self, rounds=DEFERRED_RECORDS_ROUNDS):
+        """Wait for all the submitted fetches, and try the deferred records
+        again, up to ``rounds`` times. The metadata of those that are still
+        deferred is None.
+
+        :rtype: list of the remaining ``(record, metadata)`` tuples.
+        """
+        ready = await self._wait_all()
+        for _ in range(rounds):
+            if not self.deferred:
+                break
+            deferred, self.deferred = self.deferred, []
+            logger.warning(f'Fetch metadata of {len(deferred)} deferred records')
+            await _circuit_breaker.wait()
+            for record in deferred:
+                ready.extend(await self.submit(record))
+            ready.extend(await self._wait_all())
+        if self.deferred:
+            logger.error(
+                f'Could not fetch metadata of {len(self.deferred)} records'
+            )
+            ready.extend((record, None) for record in self.deferred)
+            self.deferred = []
+        self._report()
+        return ready
+
+    async def _fetch(self, record):
+        try:
+            return await fetch_metadata(self.session, record)
+        except Exception as e:
+            if isinstance(e, CircuitOpenError) or overload_reason(e):
+                return _DEFERRED
+            raise
+
+    async def _wait_all(self):
+        ready = []
+        while self._pending:
+            await self._wait()
+            ready.extend(self._ready())
+        return ready
+
+    async def _wait(self):
+        done, self._in_flight = await asyncio.wait(
+            self._in_flight, return_when=asyncio.FIRST_COMPLETED
+        )
+
+    def _ready(self):
+        done = []
+        if self.ordered:
+            while self._pending and self._pending[0][1].done():
+                done.append(self._pending.popleft())
+        else:
+            waiting = deque()
+            for record, future in self._pending:
+                if future.done():
+                    done.append((record, future))
+                else:
+                    waiting.append((record, future))
+            self._pending = waiting
+        ready = []
+        for record, future in done:
+            metadata = future.result()
+            if metadata is _DEFERRED:
+                self.deferred.append(record)
+            else:
+                ready.append((record, metadata))
+        return ready
+
+    def _report(self):
+        in_flight = len(self._in_flight)
+        metrics.gauge('inventory_to_records_fetch_in_flight', in_flight)
+        metrics.gauge(
+            'inventory_to_records_fetch_queue_depth',
+            len(self._pending) - in_flight
+        )
+        metrics.gauge(
+            'inventory_to_records_deferred_records', len(self.deferred)
+        )
+
+
+def process_fetched(fetched, skip_incomplete, with_hash=False):
+    """Merge the fetched metadata into their records.
+
+    :param fetched: iterable of ``(record, metadata)`` tuples.
+    :param with_hash: whether to add the ``hash`` of the records, so that
+    ``to_kinto`` doesn't have to compute it.
+    """
+    for record, metadata in fetched:
+        result = merge_metadata(record, metadata)
         try:
             check_record(result)
         except ValueError as e:
@@ -374,7 +747,92 @@ async def process_batch(session, batch, skip_incomplete):
             if skip_incomplete:
                 logger.warning(e)
                 continue
-        yield {'data': result}
+        if with_hash:
+            yield {'data': result, 'hash': hash_record(result)}
+        else:
+            yield {'data': result}
+
+
+def last_modified_watermark(min_last_modified):
+    """Return ``min_last_modified`` as an ISO-8601 UTC string, truncated to
+    the second.
+
+    Dates of the inventory (e.g. ``2017-06-11T12:20:10.2Z``) sort
+    lexicographically, so those comparing lower than the watermark are
+    older than ``min_last_modified`` and don't need to be parsed. Those
+    in the same second compare higher, and are compared exactly later.
+    """
+    min_last_modified = min_last_modified.astimezone(datetime.timezone.utc)
+    return min_last_modified.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def inventory_entry_to_record(
+    classifier,
+    object_key,
+    size,
+    last_modified_date,
+    watermark=None,
+    min_last_modified=None,
+):
+    """Return the record (without metadata) of the build listed in this
+    inventory entry, or None if the entry should be skipped.
+
+    :param classifier: a ``KeyClassifier`` of the products to keep.
+    :param watermark: ``last_modified_watermark(min_last_modified)``.
+    """
+    # This is the lowest barrier of entry (no pun intended).
+    # If the entry's 'Key" value doesn't end on any of the
+    # known FILE_EXTENSIONS it will never pass a build URL
+    # later in the loop.
+    if not object_key.endswith(FILE_EXTENSIONS):
+        # Actually, eventually that FILE_EXTENSION check will
+        # be done again more detailed inside the
+        # KeyClassifier.
+        # This step was just to weed out some easy ones.
+        return None
+
+    # When you have a 'min_last_modified' set, and it's something
+    # like 24 hours, then probably 99% of records can be skipped
+    # with this little string comparison. So do this check
+    # for a skip as early as possible.
+    # See https://github.com/mozilla-services/buildhub/issues/427
+    if (
+        watermark and
+        last_modified_date < watermark and
+        last_modified_date.endswith('Z')
+    ):
+        return None
+
+    try:
+        # /pub/thunderbird/nightly/...
+        product = object_key.split('/')[1]
+    except IndexError:
+        return None  # e.g. https://archive.mozilla.org/favicon.ico
+
+    url = key_to_archive_url(object_key)
+
+    # Also takes care of skipping products not in PRODUCTS.
+    if classifier.classify(product, url) != KeyClassifier.BUILD:
+        return None
+
+    # Note! ciso8601.parse_datetime will always return a timezone
+    # aware datetime.datetime instance with tzinfo=UTC.
+    lastmodified = ciso8601.parse_datetime(last_modified_date)
+    if min_last_modified and lastmodified < min_last_modified:
+        return None
+
+    try:
+        record = record_from_url(url)
+    except Exception as e:
+        logger.exception(e)
+        return None
+
+    # Complete with info that can't be obtained from the URL.
+    filesize = int(float(size))  # e.g. 2E+10
+    lastmodified = lastmodified.strftime(DATETIME_FORMAT)
+    record['download']['size'] = filesize
+    record['download']['date'] = lastmodified
+    return record
 
 
 async def csv_to_records(
@@ -383,16 +841,21 @@ async def csv_to_records(
     skip_incomplete=True,
     min_last_modified=None,
     cache_folder=CACHE_FOLDER,
+    fetcher=None,
+    with_hash=False,
 ):
     """
+    :param fetcher: see ``fetch_records``.
+    :param with_hash: see ``process_fetched``.
     :rtype: async generator of records (dict-like)
     """
 
     async def inventory_by_folder(stdin):
         previous = None
         result = []
-        async for entry in read_csv(stdin):
-            object_key = entry['Key']
+        columns = ('Key', 'Size', 'LastModifiedDate')
+        async for entry in read_csv(stdin, columns=columns):
+            object_key = entry[0]
             folder = os.path.dirname(object_key)
             if previous is None:
                 previous = folder
@@ -406,106 +869,114 @@ async def csv_to_records(
         if result:
             yield result
 
-    # Read metadata of previous run, and warm up cache.
+    async def inventory_records(stdin):
+        classifier = KeyClassifier(PRODUCTS)
+        watermark = None
+        if min_last_modified:
+            watermark = last_modified_watermark(min_last_modified)
+
+        async for entries in inventory_by_folder(stdin):
+            for object_key, size, last_modified_date in entries:
+                record = inventory_entry_to_record(
+                    classifier,
+                    object_key,
+                    size,
+                    last_modified_date,
+                    watermark=watermark,
+                    min_last_modified=min_last_modified,
+                )
+                if record is not None:
+                    yield record
+
+    async for result in fetch_records(
+        loop,
+        inventory_records(stdin),
+        skip_incomplete=skip_incomplete,
+        cache_folder=cache_folder,
+        fetcher=fetcher,
+        with_hash=with_hash,
+    ):
+        yield result
+
+
+@contextlib.contextmanager
+def metadata_cache(cache_folder=CACHE_FOLDER):
+    """Attach the metadata caches to the store of this folder.
+    """
+    # Metadata fetched by previous runs is looked up in this store, and
+    # new metadata is written to it as soon as it is fetched.
     # Will save a lot of hits to archive.mozilla.org.
-    metadata_cache_file = os.path.join(
+    store = MetadataStore(os.path.join(cache_folder, STORE_FILENAME))
+    legacy_cache_file = os.path.join(
         cache_folder,
         '.metadata-{}.json'.format(__version__)
     )
-    if os.path.exists(metadata_cache_file):
-        with open(metadata_cache_file) as f:
-            metadata = json.load(f)
-        _rc_metadata.update(metadata['rc'])
-        _release_metadata.update(metadata['release'])
-        _nightly_metadata.update(metadata['nightly'])
+    if os.path.exists(legacy_cache_file):
+        import_json_cache(store, legacy_cache_file)
+    metadata_caches = (
+        _rc_metadata,
+        _release_metadata,
+        _nightly_metadata,
+        _candidates_build_folder,
+    )
+    for cache in metadata_caches:
+        cache.attach(store)
+    _http_cache.attach(store)
 
-    async with aiohttp.ClientSession(loop=loop) as session:
-        batch = []
+    try:
+        yield store
+    finally:
+        for cache in metadata_caches:
+            cache.detach()
+        _http_cache.detach()
+        store.close()
 
-        async for entries in inventory_by_folder(stdin):
-            for entry in entries:
-                object_key = entry['Key']
-
-                # This is the lowest barrier of entry (no pun intended).
-                # If the entry's 'Key" value doesn't end on any of the
-                # known FILE_EXTENSIONS it will never pass a build URL
-                # later in the loop.
-                if not any(
-                    object_key.endswith(ext) for ext in FILE_EXTENSIONS
-                ):
-                    # Actually, eventually that FILE_EXTENSION check will
-                    # be done again more detailed inside the is_build_url
-                    # function.
-                    # This step was just to weed out some easy ones.
-                    continue
-
-                # When you have a 'min_last_modified' set, and it's something
-                # like 24 hours, then probably 99% of records can be skipped
-                # with this little date comparison. So do this check
-                # for a skip as early as possible.
-                # See https://github.com/mozilla-services/buildhub/issues/427
-                # Note! ciso8601.parse_datetime will always return a timezone
-                # aware datetime.datetime instance with tzinfo=UTC.
-                lastmodified = ciso8601.parse_datetime(
-                    entry['LastModifiedDate']
+
+async def fetch_records(
+    loop,
+    records,
+    skip_incomplete=True,
+    cache_folder=CACHE_FOLDER,
+    fetcher=None,
+    with_hash=False,
+):
+    """Fetch the metadata of the records obtained from the inventory.
+
+    :param records: async iterable of records (without metadata).
+    :param fetcher: ``MetadataFetcher`` to use, if several inventories
+    share the same session and the same ``metadata_cache``.
+    :param with_hash: see ``process_fetched``.
+    :rtype: async generator of records (dict-like)
+    """
+    if fetcher is None:
+        with metadata_cache(cache_folder):
+            async with create_session(loop) as session:
+                # Enough records are fetched at once to make as many
+                # requests as the limiter allows.
+                fetcher = MetadataFetcher(
+                    session, concurrency=_request_limiter.maximum
                 )
-                if min_last_modified and lastmodified < min_last_modified:
-                    continue
-
-                try:
-                    # /pub/thunderbird/nightly/...
-                    product = object_key.split('/')[1]
-                except IndexError:
-                    continue  # e.g. https://archive.mozilla.org/favicon.ico
-
-                if product not in PRODUCTS:
-                    continue
-
-                url = key_to_archive_url(object_key)
-
-                if not is_build_url(product, url):
-                    continue
-                try:
-                    record = record_from_url(url)
-                except Exception as e:
-                    logger.exception(e)
-                    continue
-
-                # Scan the list of candidates metadata (no-op if
-                # already initialized).
-                await scan_candidates(session, product)
-
-                # Complete with info that can't be obtained from the URL.
-                filesize = int(float(entry['Size']))  # e.g. 2E+10
-                lastmodified = lastmodified.strftime(DATETIME_FORMAT)
-                record['download']['size'] = filesize
-                record['download']['date'] = lastmodified
-
-                batch.append(record)
-
-                if len(batch) == NB_PARALLEL_REQUESTS:
-                    async for result in process_batch(
-                        session,
-                        batch,
-                        skip_incomplete
-                    ):
-                        yield result
-
-                    batch = []  # Go on.
-
-        # Last loop iteration.
-        async for result in process_batch(session, batch, skip_incomplete):
+                async for result in fetch_records(
+                    loop,
+                    records,
+                    skip_incomplete,
+                    fetcher=fetcher,
+                    with_hash=with_hash,
+                ):
+                    yield result
+        return
+
+    async for record in records:
+        # Fetch metadata in the background, and yield the
+        # records whose metadata was obtained meanwhile.
+        fetched = await fetcher.submit(record)
+        for result in process_fetched(fetched, skip_incomplete, with_hash):
             yield result
 
-    # Save accumulated metadata for next runs.
-    tmpfilename = metadata_cache_file + '.tmp'
-    metadata = {
-        'rc': _rc_metadata,
-        'release': _release_metadata,
-        'nightly': _nightly_metadata,
-    }
-    json.dump(metadata, open(tmpfilename, 'w'))
-    os.rename(tmpfilename, metadata_cache_file)
+    # Last loop iteration.
+    fetched = await fetcher.drain()
+    for result in process_fetched(fetched, skip_incomplete, with_hash):
+        yield result
 
 
 async def main(loop, cache_folder=CACHE_FOLDER):
@@ -0,0 +1,192 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+import csv
+import gzip
+import logging
+import multiprocessing
+import queue
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from decouple import config
+
+from buildhub.configure_markus import get_metrics
+from buildhub.inventory_to_records import (
+    inventory_entry_to_record, last_modified_watermark, PRODUCTS,
+    INVENTORY_FIELDNAMES,
+)
+from buildhub.utils import KeyClassifier
+
+
+# Number of processes that parse the inventory files. With 0, they are
+# parsed in the event loop.
+INVENTORY_WORKERS = config('INVENTORY_WORKERS', default=0, cast=int)
+# Number of records sent at once by the workers.
+INVENTORY_WORKERS_BATCH_SIZE = config(
+    'INVENTORY_WORKERS_BATCH_SIZE', default=1000, cast=int
+)
+
+logger = logging.getLogger()  # root logger.
+metrics = get_metrics('buildhub')
+
+KEY = INVENTORY_FIELDNAMES.index('Key')
+SIZE = INVENTORY_FIELDNAMES.index('Size')
+LAST_MODIFIED_DATE = INVENTORY_FIELDNAMES.index('LastModifiedDate')
+
+
+def parse_inventory_file(file_path, min_last_modified=None):
+    """Yield the records (without metadata) of the builds listed in this
+    ``*.csv.gz`` inventory file.
+    """
+    classifier = KeyClassifier(PRODUCTS)
+    watermark = None
+    if min_last_modified:
+        watermark = last_modified_watermark(min_last_modified)
+    min_length = max(KEY, SIZE, LAST_MODIFIED_DATE) + 1
+    with gzip.open(file_path, 'rt', encoding='utf-8', newline='') as f:
+        for row in csv.reader(f):
+            # Skip blank (or truncated) lines.
+            if len(row) < min_length:
+                continue
+            record = inventory_entry_to_record(
+                classifier,
+                row[KEY],
+                row[SIZE],
+                row[LAST_MODIFIED_DATE],
+                watermark=watermark,
+                min_last_modified=min_last_modified,
+            )
+            if record is not None:
+                yield record
+
+
+# Messages sent to the parent process.
+RECORDS = 'records'
+PARSED = 'parsed'
+FAILED = 'failed'
+
+
+def work(tasks, results, min_last_modified, batch_size):
+    """Parse the inventory files received in ``tasks`` until None is
+    received, and send batches of records in ``results``.
+
+    Once a file is parsed, its path is sent along with the time spent
+    parsing it, without the time spent waiting for the records to be
+    consumed.
+    """
+    def send(batch):
+        started = time.time()
+        results.put((RECORDS, batch))
+        return time.time() - started
+
+    for file_path in iter(tasks.get, None):
+        try:
+            started = time.time()
+            waiting = 0
+            batch = []
+            for record in parse_inventory_file(file_path, min_last_modified):
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    waiting += send(batch)
+                    batch = []
+            if batch:
+                waiting += send(batch)
+            parsing = time.time() - started - waiting
+            results.put((PARSED, (file_path, parsing)))
+        except Exception:
+            results.put((FAILED, (file_path, traceback.format_exc())))
+
+
+async def parse_inventory_files(
+    loop,
+    file_paths,
+    workers=INVENTORY_WORKERS,
+    min_last_modified=None,
+    batch_size=INVENTORY_WORKERS_BATCH_SIZE,
+):
+    """Parse inventory files in a pool of processes.
+
+    :param file_paths: async iterable of paths of ``*.csv.gz`` files. They
+    are parsed as soon as they are obtained.
+    :rtype: async generator of records (without metadata), in no
+    particular order.
+    """
+    # Don't fork the threads of the event loop.
+    context = multiprocessing.get_context('spawn')
+    tasks = context.Queue()
+    # Workers wait when the records are not consumed quickly enough.
+    results = context.Queue(maxsize=workers * 4)
+    processes = [
+        context.Process(
+            target=work,
+            args=(tasks, results, min_last_modified, batch_size),
+            daemon=True,
+        )
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    # Used to wait for the results without blocking the loop.
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    def receive():
+        try:
+            return results.get(timeout=0.1)
+        except queue.Empty:
+            return None
+
+    submitted = 0
+
+    async def submit():
+        nonlocal submitted
+        async for file_path in file_paths:
+            tasks.put(file_path)
+            submitted += 1
+
+    submitter = asyncio.ensure_future(submit())
+    try:
+        parsed = 0
+        while not (submitter.done() and parsed == submitted):
+            if submitter.done():
+                # Raise the error of the submission, if any.
+                submitter.result()
+            message = await loop.run_in_executor(executor, receive)
+            if message is None:
+                # A worker killed (e.g. out of memory) would never report
+                # the files it was parsing.
+                for process in processes:
+                    if not process.is_alive():
+                        raise RuntimeError(
+                            f'Inventory worker {process.pid} died '
+                            f'(exit code {process.exitcode})'
+                        )
+                continue
+            kind, content = message
+            if kind == RECORDS:
+                metrics.incr('inventory_workers_records', len(content))
+                for record in content:
+                    yield record
+            elif kind == PARSED:
+                parsed += 1
+                file_path, parsing = content
+                metrics.timing('s3_inventory_to_kinto_parse', parsing * 1000)
+                logger.info(f'Parsed inventory file {file_path}')
+            else:
+                file_path, error = content
+                raise RuntimeError(f'Could not parse {file_path}:\n{error}')
+    finally:
+        submitter.cancel()
+        for _ in processes:
+            tasks.put(None)
+        for process in processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        # Don't wait for the messages that were not consumed.
+        tasks.cancel_join_thread()
+        results.cancel_join_thread()
+        executor.shutdown()
@@ -0,0 +1,280 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+
+import requests
+from decouple import config
+from kinto_http import utils as kinto_utils
+from kinto_http.exceptions import KintoException
+
+from buildhub.concurrency import AdaptiveLimiter, overload_reason
+from buildhub.configure_markus import get_metrics
+
+
+# Number of batch requests sent to Kinto at the same time, at first...
+PUBLISH_PARALLEL = config('PUBLISH_PARALLEL', default=3, cast=int)
+# ...and at most, while the server copes with them.
+PUBLISH_MAX_PARALLEL = config('PUBLISH_MAX_PARALLEL', default=8, cast=int)
+# The size of the batches is adapted so that they take this long.
+PUBLISH_TARGET_SECONDS = config(
+    'PUBLISH_TARGET_SECONDS', default=2.0, cast=float
+)
+# Max. size of the body of a batch request (nginx accepts 1MB by default).
+PUBLISH_MAX_BYTES = config('PUBLISH_MAX_BYTES', default=1000000, cast=int)
+
+logger = logging.getLogger()  # root logger.
+metrics = get_metrics('buildhub')
+
+
+def auth_headers(auth, url):
+    """Return the headers that the ``requests`` authentication of a
+    ``kinto_http`` client adds to its requests.
+    """
+    if auth is None:
+        return {}
+    if isinstance(auth, tuple):
+        auth = requests.auth.HTTPBasicAuth(*auth)
+    request = auth(requests.Request('POST', url).prepare())
+    return {'Authorization': request.headers['Authorization']}
+
+
+class BatchPublisher:
+    """Push records to the collection of a ``kinto_http`` client, with
+    ``/batch`` requests sent from the event loop.
+
+    Several batches are sent at the same time, on the connections of an
+    ``aiohttp`` session, which are kept alive. How many is adapted with an
+    ``AdaptiveLimiter``, from the time the server takes per record, and
+    the size of the batches so that they take about ``target_seconds``,
+    within ``max_batch_size`` records and ``max_bytes``. Both are cut when
+    the server is overloaded, and no batch is sent for as long as the
+    server asks with its ``Backoff`` and ``Retry-After`` headers.
+    """
+    def __init__(
+        self,
+        client,
+        session,
+        max_batch_size,
+        parallel=PUBLISH_PARALLEL,
+        max_parallel=PUBLISH_MAX_PARALLEL,
+        target_seconds=PUBLISH_TARGET_SECONDS,
+        max_bytes=PUBLISH_MAX_BYTES,
+    ):
+        self.session = session
+        self.url = client.session.server_url.rstrip('/') + '/batch'
+        self.records_path = client.get_endpoint('records')
+        self.headers = {
+            'Content-Type': 'application/json',
+            **auth_headers(client.session.auth, self.url),
+        }
+        # Retried like kinto_http does.
+        self.nb_retry = client.session.nb_retry
+        self.retry_after = client.session.retry_after
+        self.max_batch_size = max_batch_size
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        self.limiter = AdaptiveLimiter(
+            parallel,
+            minimum=1,
+            maximum=max_parallel,
+            metric='to_kinto_publish_parallel',
+        )
+        # Start with the largest batches allowed.
+        self._batch_size = float(max_batch_size)
+        self._paused_until = 0
+
+    @property
+    def batch_size(self):
+        """Number of records to put in the next batch."""
+        return int(self._batch_size)
+
+    def encode(self, record):
+        """Return the request of the batch that stores this record, like
+        ``kinto_http`` ``update_record()`` and ``create_record()`` do,
+        encoded in JSON so that its size is known.
+        """
+        data = record['data']
+        body = {'data': data}
+        if record.get('permissions') is not None:
+            body['permissions'] = record['permissions']
+        request = {'method': 'PUT', 'body': body}
+        if 'id' in data:
+            metrics.incr('to_kinto_update_record')
+            record_id = data['id']
+            if data.get('last_modified'):
+                request['headers'] = {
+                    'If-Match': kinto_utils.quote(data['last_modified'])
+                }
+        else:
+            metrics.incr('to_kinto_create_record')
+            record_id = str(uuid.uuid4())
+            request['headers'] = {'If-None-Match': '*'}
+        request['path'] = f'{self.records_path}/{record_id}'
+        return json.dumps(request)
+
+    def payload_size(self, subrequests):
+        """Size of the body of the batch request of these subrequests."""
+        separators = 2 * max(len(subrequests) - 1, 0)
+        return (
+            len('{"requests": []}') +
+            sum(len(s) for s in subrequests) +
+            separators
+        )
+
+    def pause(self, seconds, reason):
+        """Don't send any batch for that many seconds."""
+        until = time.monotonic() + seconds
+        if until <= self._paused_until:
+            return
+        logger.warning(f'Kinto asks to wait {seconds}s ({reason})')
+        self._paused_until = until
+        metrics.incr('to_kinto_publish_pause', tags=['reason:' + reason])
+        metrics.gauge('to_kinto_publish_pause_seconds', seconds)
+
+    async def _wait_pause(self):
+        delay = self._paused_until - time.monotonic()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            # It may have been extended meanwhile.
+            delay = self._paused_until - time.monotonic()
+
+    def _set_batch_size(self, size):
+        size = min(max(size, 1), self.max_batch_size)
+        changed = int(size) != self.batch_size
+        self._batch_size = size
+        if changed:
+            metrics.gauge('to_kinto_publish_batch_size', self.batch_size)
+
+    def _succeeded(self, count, latency, saturated):
+        self.limiter.succeeded(latency / count, saturated)
+        # Aim for the target latency, changing at most twofold at once.
+        ideal = count * self.target_seconds / max(latency, 0.001)
+        self._set_batch_size(
+            min(max(ideal, self._batch_size / 2), self._batch_size * 2)
+        )
+
+    def _overloaded(self, epoch, reason):
+        if self.limiter.overloaded(epoch, reason):
+            self._set_batch_size(self._batch_size / 2)
+
+    async def _post(self, subrequests, epoch):
+        """Send a batch request, and return its response and how long the
+        server took to answer it.
+        """
+        body = '{"requests": [' + ', '.join(subrequests) + ']}'
+        retry = self.nb_retry
+        while True:
+            await self._wait_pause()
+            started = time.monotonic()
+            async with self.session.post(
+                self.url, data=body, headers=self.headers
+            ) as response:
+                backoff = response.headers.get('Backoff')
+                if backoff:
+                    self.pause(int(backoff), 'backoff')
+                if 200 <= response.status < 400:
+                    resp = await response.json()
+                    return resp, time.monotonic() - started
+                if response.status == 429 or response.status >= 500:
+                    self._overloaded(epoch, str(response.status))
+                if retry > 0 and (
+                    response.status >= 500 or response.status in (409, 429)
+                ):
+                    retry -= 1
+                    retry_after = self.retry_after
+                    if retry_after is None:
+                        retry_after = int(
+                            response.headers.get('Retry-After', 0)
+                        )
+                    if retry_after:
+                        self.pause(retry_after, 'retry-after')
+                    continue
+                text = await response.text()
+                raise KintoException(
+                    f'POST {self.url} - {response.status} {text}'
+                )
+
+    async def _publish(self, subrequests, epoch, saturated):
+        try:
+            responses = [None] * len(subrequests)
+            # Concurrent writes in the same collection can conflict, the
+            # conflicting records are sent again.
+            pending = list(range(len(subrequests)))
+            retry = self.nb_retry
+            while True:
+                with metrics.timer('to_kinto_publish_records'):
+                    resp, latency = await self._post(
+                        [subrequests[i] for i in pending], epoch
+                    )
+                self._succeeded(len(pending), latency, saturated)
+                for i, response in zip(pending, resp['responses']):
+                    responses[i] = response
+                pending = [
+                    i for i in pending if responses[i]['status'] == 409
+                ]
+                if not pending or not retry:
+                    break
+                retry -= 1
+                metrics.incr('to_kinto_publish_conflict', len(pending))
+        except Exception as e:
+            reason = overload_reason(e)
+            if reason is not None:
+                self._overloaded(epoch, reason)
+            raise
+        finally:
+            self.limiter.release()
+
+        results = []
+        for request, response in zip(subrequests, responses):
+            status_code = response['status']
+            if status_code >= 500:
+                exception = KintoException(
+                    f"{status_code} - {response['body']}"
+                )
+                exception.request = json.loads(request)
+                exception.response = response
+                raise exception
+            results.append(response['body'])
+
+        # Batch don't fail with 4XX errors. Make sure we output a
+        # comprehensive error here when we encounter them.
+        error_msgs = []
+        for result in results:
+            error_status = result.get('code')
+            if error_status == 412:
+                error_msg = (
+                    "Record '{details[existing][id]}' already exists: "
+                    '{details[existing]}'
+                ).format_map(result)
+                error_msgs.append(error_msg)
+            elif error_status == 400:
+                error_msg = 'Invalid record: {}'.format(result)
+                error_msgs.append(error_msg)
+            elif error_status is not None:
+                error_msgs.append('Error: {}'.format(result))
+        if error_msgs:
+            raise ValueError('\n'.join(error_msgs))
+
+        return results
+
+    async def publish(self, subrequests):
+        """Send these requests, returned by ``encode()``, in one batch
+        request, and return the body of the response of every one.
+        """
+        epoch, saturated = await self.limiter.acquire()
+        return await self._publish(subrequests, epoch, saturated)
+
+    async def submit(self, subrequests):
+        """Start publishing these requests once the server can take one
+        more batch, and return the task.
+        """
+        epoch, saturated = await self.limiter.acquire()
+        return asyncio.ensure_future(
+            self._publish(subrequests, epoch, saturated)
+        )
@@ -21,9 +21,9 @@ from buildhub.inventory_to_records import (
     fetch_json,
     fetch_listing,
     fetch_metadata,
-    scan_candidates
 )
 from buildhub.configure_markus import get_metrics
+from buildhub.http_session import create_session
 
 
 # Optional Sentry with synchronuous client.
@@ -36,6 +36,9 @@ sentry = LambdaClient(
 logger = logging.getLogger()  # root logger.
 metrics = get_metrics('buildhub')
 
+# Survives across invocations of a warm Lambda container.
+key_classifier = utils.KeyClassifier(utils.ALL_PRODUCTS)
+
 
 async def main(loop, event):
     """
@@ -57,7 +60,7 @@ async def main(loop, event):
         else:
             records.append(record)
 
-    async with aiohttp.ClientSession(loop=loop) as session:
+    async with create_session(loop) as session:
         for event_record in records:
             metrics.incr('s3_event_event')
             records_to_create = []
@@ -82,8 +85,10 @@ async def main(loop, event):
                 logger.info('Skip product {}'.format(product))
                 continue
 
+            kind = key_classifier.classify(product, url)
+
             # Release / Nightly / RC archive.
-            if utils.is_build_url(product, url):
+            if kind == utils.KeyClassifier.BUILD:
                 logger.info('Processing {} archive: {}'.format(product, key))
 
                 record = utils.record_from_url(url)
@@ -92,10 +97,14 @@ async def main(loop, event):
                 record['download']['date'] = event_time
 
                 # Fetch release metadata.
-                await scan_candidates(session, product)
                 logger.debug("Fetch record metadata")
-                # metadata = await fetch_metadata(session, record)
-                metadata = await fetch_metadata(session, record)
+                try:
+                    metadata = await fetch_metadata(session, record)
+                except aiohttp.ClientConnectionError as e:
+                    # Not fetched this time, but the archive is handled
+                    # again when its metadata is published (below).
+                    logger.warning(f'Could not fetch metadata: {e}')
+                    metadata = None
                 # If JSON metadata not available, archive will be
                 # handled when JSON is delivered.
                 if metadata is None:
@@ -109,7 +118,7 @@ async def main(loop, event):
                 records_to_create.append(record)
 
             # RC metadata
-            elif utils.is_rc_build_metadata(product, url):
+            elif kind == utils.KeyClassifier.RC_METADATA:
                 logger.info(f'Processing {product} RC metadata: {key}')
 
                 # pub/firefox/candidates/55.0b12-candidates/build1/mac/en-US/
@@ -143,7 +152,7 @@ async def main(loop, event):
                     )
                     for f in files:
                         rc_url = parent_folder + f['name']
-                        if utils.is_build_url(product, rc_url):
+                        if key_classifier.is_build_url(product, rc_url):
                             archives.append((
                                 rc_url,
                                 f['size'],
@@ -168,7 +177,7 @@ async def main(loop, event):
                         )
                         for f in files:
                             rc_url = l10n_parent_url + locale + f['name']
-                            if utils.is_build_url(product, rc_url):
+                            if key_classifier.is_build_url(product, rc_url):
                                 archives.append((
                                     rc_url,
                                     f['size'],
@@ -189,7 +198,7 @@ async def main(loop, event):
             # pub/firefox/nightly/2017/08/2017-08-08-11-40-32-mozilla-central/
             # firefox-57.0a1.en-US.linux-i686.json
             # -l10n/...
-            elif utils.is_nightly_build_metadata(product, url):
+            elif kind == utils.KeyClassifier.NIGHTLY_METADATA:
                 logger.info(
                     f'Processing {product} nightly metadata: {key}'
                 )
@@ -214,7 +223,7 @@ async def main(loop, event):
                         # metadata are by platform.
                         continue
                     en_nightly_url = parent_url + f['name']
-                    if utils.is_build_url(product, en_nightly_url):
+                    if key_classifier.is_build_url(product, en_nightly_url):
                         record = utils.record_from_url(en_nightly_url)
                         record['download']['size'] = f['size']
                         record['download']['date'] = f['last_modified']
@@ -233,7 +242,7 @@ async def main(loop, event):
                         l10n_folder_url,
                         retry_on_notfound=True,
                     )
-                except ValueError:
+                except (ValueError, aiohttp.ClientConnectionError):
                     files = []  # No -l10/ folder published yet.
                 for f in files:
                     if (
@@ -244,7 +253,7 @@ async def main(loop, event):
                         # (mobile platforms are contained by folder)
                         continue
                     nightly_url = l10n_folder_url + f['name']
-                    if utils.is_build_url(product, nightly_url):
+                    if key_classifier.is_build_url(product, nightly_url):
                         record = utils.record_from_url(nightly_url)
                         record['download']['size'] = f['size']
                         record['download']['date'] = f['last_modified']
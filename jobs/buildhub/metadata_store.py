@@ -0,0 +1,411 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from collections import defaultdict
+from collections.abc import MutableMapping
+
+from decouple import config
+
+from buildhub.configure_markus import get_metrics
+
+
+CACHE_FOLDER = config('CACHE_FOLDER', default='.')
+STORE_FILENAME = '.metadata.sqlite'
+# How long to wait before trying to fetch missing metadata again. This
+# delay is multiplied by the backoff factor after each failed attempt.
+MISSING_METADATA_TTL_HOURS = config(
+    'MISSING_METADATA_TTL_HOURS', default=6, cast=float
+)
+MISSING_METADATA_BACKOFF_FACTOR = config(
+    'MISSING_METADATA_BACKOFF_FACTOR', default=2, cast=float
+)
+MISSING_METADATA_MAX_TTL_HOURS = config(
+    'MISSING_METADATA_MAX_TTL_HOURS', default=24 * 30, cast=float
+)
+
+# Version of the format of the values stored in each namespace.
+# Bump it when the format changes: entries stored with another version
+# are ignored (and removed on compaction).
+SCHEMA_VERSIONS = {
+    'nightly': 1,
+    'rc': 1,
+    'release': 1,
+    'candidates': 1,
+}
+
+metrics = get_metrics('buildhub')
+
+
+def missing_metadata_ttl(failures):
+    """Return how many seconds to wait before trying again to fetch some
+    metadata that was missing ``failures`` times in a row.
+    """
+    hours = min(
+        MISSING_METADATA_TTL_HOURS *
+        MISSING_METADATA_BACKOFF_FACTOR ** (failures - 1),
+        MISSING_METADATA_MAX_TTL_HOURS
+    )
+    return hours * 3600
+
+
+class MetadataStore:
+    """On-disk key-value store of the metadata fetched from the archives.
+
+    Missing metadata is stored apart, along with the number of failed
+    attempts and when to try again. So are the HTTP responses used by
+    ``buildhub.http_cache.HTTPCache``.
+
+    Every write is committed right away, so that a run that crashes
+    keeps everything that was fetched so far.
+    """
+    def __init__(self, path):
+        self.path = path
+        # Autocommit mode.
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute("""
+        CREATE TABLE IF NOT EXISTS entries (
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            schema INTEGER NOT NULL,
+            value TEXT,
+            modified REAL NOT NULL,
+            PRIMARY KEY (namespace, key)
+        ) WITHOUT ROWID
+        """)
+        self.connection.execute("""
+        CREATE TABLE IF NOT EXISTS misses (
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            failures INTEGER NOT NULL,
+            retry_after REAL NOT NULL,
+            PRIMARY KEY (namespace, key)
+        ) WITHOUT ROWID
+        """)
+        self.connection.execute("""
+        CREATE TABLE IF NOT EXISTS responses (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            body TEXT NOT NULL,
+            size INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """)
+
+    def get(self, namespace, key):
+        """
+        :rtype: tuple ``(found, value)``
+        """
+        row = self.connection.execute(
+            'SELECT value FROM entries '
+            'WHERE namespace = ? AND key = ? AND schema = ?',
+            (namespace, key, SCHEMA_VERSIONS[namespace])
+        ).fetchone()
+        if row is None:
+            return False, None
+        return True, json.loads(row[0])
+
+    def put(self, namespace, key, value):
+        self.put_many(namespace, [(key, value)])
+
+    def put_many(self, namespace, items):
+        schema = SCHEMA_VERSIONS[namespace]
+        now = time.time()
+        items = list(items)
+        with self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO entries '
+                '(namespace, key, schema, value, modified) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (
+                    (namespace, key, schema, json.dumps(value), now)
+                    for key, value in items
+                )
+            )
+            self.connection.executemany(
+                'DELETE FROM misses WHERE namespace = ? AND key = ?',
+                ((namespace, key) for key, _ in items)
+            )
+
+    def get_miss(self, namespace, key):
+        """
+        :rtype: tuple ``(failures, retry_after)``, or None if the
+        metadata isn't known to be missing.
+        """
+        return self.connection.execute(
+            'SELECT failures, retry_after FROM misses '
+            'WHERE namespace = ? AND key = ?',
+            (namespace, key)
+        ).fetchone()
+
+    def put_miss(self, namespace, key, failures, retry_after):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO misses '
+            '(namespace, key, failures, retry_after) VALUES (?, ?, ?, ?)',
+            (namespace, key, failures, retry_after)
+        )
+
+    def get_response(self, url):
+        """
+        :rtype: tuple ``(etag, last_modified, body, size)``, or None.
+        """
+        return self.connection.execute(
+            'SELECT etag, last_modified, body, size FROM responses '
+            'WHERE url = ?',
+            (url,)
+        ).fetchone()
+
+    def put_response(self, url, etag, last_modified, body, size):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO responses '
+            '(url, etag, last_modified, body, size) VALUES (?, ?, ?, ?, ?)',
+            (url, etag, last_modified, body, size)
+        )
+
+    def delete(self, namespace, key):
+        with self.connection:
+            self.connection.execute('BEGIN')
+            for table in ('entries', 'misses'):
+                self.connection.execute(
+                    'DELETE FROM {} WHERE namespace = ? AND key = ?'.format(
+                        table
+                    ),
+                    (namespace, key)
+                )
+
+    def stats(self):
+        """
+        :rtype: dict with the size on disk, the number of entries per
+        namespace, of obsolete ones, of missing metadata and of HTTP
+        responses.
+        """
+        size = 0
+        for suffix in ('', '-wal'):
+            if os.path.exists(self.path + suffix):
+                size += os.path.getsize(self.path + suffix)
+        entries = defaultdict(int)
+        obsolete = 0
+        rows = self.connection.execute(
+            'SELECT namespace, schema, COUNT(*) FROM entries '
+            'GROUP BY namespace, schema'
+        )
+        for namespace, schema, count in rows:
+            if SCHEMA_VERSIONS.get(namespace) == schema:
+                entries[namespace] += count
+            else:
+                obsolete += count
+        missing, = self.connection.execute(
+            'SELECT COUNT(*) FROM misses'
+        ).fetchone()
+        responses, = self.connection.execute(
+            'SELECT COUNT(*) FROM responses'
+        ).fetchone()
+        return {
+            'size': size,
+            'entries': dict(entries),
+            'obsolete': obsolete,
+            'missing': missing,
+            'responses': responses,
+        }
+
+    def compact(self):
+        """Remove the obsolete entries and reclaim the unused space."""
+        for namespace, schema in SCHEMA_VERSIONS.items():
+            self.connection.execute(
+                'DELETE FROM entries WHERE namespace = ? AND schema != ?',
+                (namespace, schema)
+            )
+        for table in ('entries', 'misses'):
+            self.connection.execute(
+                'DELETE FROM {} WHERE namespace NOT IN ({})'.format(
+                    table, ','.join('?' * len(SCHEMA_VERSIONS))
+                ),
+                tuple(SCHEMA_VERSIONS)
+            )
+        self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.connection.execute('VACUUM')
+
+    def close(self):
+        self.connection.close()
+
+
+class MetadataCache(MutableMapping):
+    """In-memory cache of the metadata of a namespace.
+
+    Setting a key to ``None`` records that its metadata is missing. It is
+    then looked up as ``None`` until its TTL expires (see
+    ``missing_metadata_ttl()``), and as unknown afterwards, so that it
+    gets fetched again.
+
+    When a store is attached, lookups of keys that aren't in memory fall
+    back to it, and writes go through it. Iterating and ``len()`` only
+    cover the metadata found and in memory.
+    """
+    HIT = 'hit'
+    NEGATIVE_HIT = 'negative_hit'
+    MISS = 'miss'
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.store = None
+        self._data = {}
+        # Missing metadata: (failures, retry_after) tuples.
+        self._misses = {}
+
+    def attach(self, store):
+        self.store = store
+
+    def detach(self):
+        self.store = None
+
+    def lookup(self, key):
+        """Like ``_lookup()``, but reporting hits and misses in the metrics.
+
+        :rtype: tuple ``(found, value)``
+        """
+        status, value = self._lookup(key)
+        metrics.incr(
+            'metadata_cache_{}'.format(status),
+            tags=['namespace:{}'.format(self.namespace)]
+        )
+        return status != self.MISS, value
+
+    def _lookup(self, key):
+        try:
+            return self.HIT, self._data[key]
+        except KeyError:
+            pass
+        miss = self._misses.get(key)
+        if miss is None and self.store is not None:
+            found, value = self.store.get(self.namespace, key)
+            if found:
+                self._data[key] = value
+                return self.HIT, value
+            miss = self.store.get_miss(self.namespace, key)
+            if miss is not None:
+                self._misses[key] = miss
+        if miss is not None and time.time() < miss[1]:
+            return self.NEGATIVE_HIT, None
+        return self.MISS, None
+
+    def __getitem__(self, key):
+        status, value = self._lookup(key)
+        if status == self.MISS:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._lookup(key)[0] != self.MISS
+
+    def __setitem__(self, key, value):
+        if value is None:
+            self._set_missing(key)
+            return
+        self._data[key] = value
+        self._misses.pop(key, None)
+        if self.store is not None:
+            self.store.put(self.namespace, key, value)
+
+    def _set_missing(self, key):
+        self._data.pop(key, None)
+        # Look up the previous failures, even if expired.
+        self._lookup(key)
+        failures, _ = self._misses.get(key, (0, None))
+        failures += 1
+        retry_after = time.time() + missing_metadata_ttl(failures)
+        self._misses[key] = (failures, retry_after)
+        if self.store is not None:
+            self.store.put_miss(self.namespace, key, failures, retry_after)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._data.pop(key, None)
+        self._misses.pop(key, None)
+        if self.store is not None:
+            self.store.delete(self.namespace, key)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        """Empty the in-memory cache (the store is left untouched)."""
+        self._data.clear()
+        self._misses.clear()
+
+
+def import_json_cache(store, filename):
+    """Import the metadata cached in a JSON file by previous versions, and
+    remove the file.
+
+    Metadata that was missing is left out, so that it is fetched again.
+    """
+    with open(filename) as f:
+        metadata = json.load(f)
+    for namespace, entries in metadata.items():
+        if namespace in SCHEMA_VERSIONS:
+            store.put_many(namespace, (
+                (key, value) for key, value in entries.items()
+                if value is not None
+            ))
+    os.remove(filename)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Report the size of the metadata cache, or compact it.',
+    )
+    parser.add_argument(
+        'command',
+        choices=('stats', 'compact'),
+        help='What to do with the metadata cache.'
+    )
+    parser.add_argument(
+        '--cache-folder',
+        default=CACHE_FOLDER,
+        help='Folder of the metadata cache (default: %(default)s).'
+    )
+    args = parser.parse_args(argv)
+
+    path = os.path.join(args.cache_folder, STORE_FILENAME)
+    if not os.path.exists(path):
+        parser.error('{} does not exist'.format(path))
+
+    store = MetadataStore(path)
+    try:
+        if args.command == 'compact':
+            before = store.stats()['size']
+            store.compact()
+            print('Compacted {}: {:,} -> {:,} bytes'.format(
+                path, before, store.stats()['size']
+            ))
+        else:
+            stats = store.stats()
+            print('{}: {:,} bytes'.format(path, stats['size']))
+            for namespace, count in sorted(stats['entries'].items()):
+                print('  {}: {:,} entries'.format(namespace, count))
+            print('  obsolete: {:,} entries'.format(stats['obsolete']))
+            print('  missing: {:,} entries'.format(stats['missing']))
+            print('  HTTP responses: {:,}'.format(stats['responses']))
+    finally:
+        store.close()
+
+
+def run():
+    main(sys.argv[1:])
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,231 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import heapq
+import itertools
+import logging
+import mmap
+import os
+import struct
+
+
+logger = logging.getLogger()  # root logger.
+
+# Magic, version, number of entries, highest ``last_modified``.
+HEADER = struct.Struct('<4sIQQ')
+MAGIC = b'BHRI'
+VERSION = 1
+# Number of entries whose digest starts with each 2-byte prefix or a
+# lower one, to narrow down the binary search.
+FANOUT = struct.Struct('<65536I')
+# Digest of the record id, ``last_modified``, hash of the record.
+ENTRY = struct.Struct('<16sQ16s')
+ENTRIES_OFFSET = HEADER.size + FANOUT.size
+# The journal is merged into the index when it is flushed with at least
+# this many entries, or once it has as many entries as the index.
+JOURNAL_MERGE_MIN = 10000
+
+
+def id_digest(record_id):
+    return hashlib.md5(record_id.encode('utf-8')).digest()
+
+
+class RecordsIndex:
+    """The ``last_modified`` and hash of every record already stored on
+    the server, by record id.
+
+    The entries are stored in a file with fixed-width entries sorted by
+    digest of the record id, which is mapped in memory and looked up with
+    a binary search among the entries with the same 2-byte prefix. New
+    entries are appended to a journal file, and merged into the index once
+    the journal grows.
+
+    Like the dict it replaces, ``index.get(record_id)`` returns
+    ``(last_modified, hash)``. Use it as a context manager, or call
+    ``close()``, to release the files.
+    """
+    def __init__(self, path, journal_merge_min=JOURNAL_MERGE_MIN):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.journal_merge_min = journal_merge_min
+        self._data = None
+        self._count = 0
+        self._fanout = (0,) * 65536
+        self.high_water = 0
+        self._open()
+        # Entries of the journal, by digest.
+        self._journal = {}
+        self._journal_new = 0
+        self._read_journal()
+        self._journal_file = open(self.journal_path, 'ab')
+
+    def _open(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) == HEADER.size:
+                magic, version, count, high_water = HEADER.unpack(header)
+                size = ENTRIES_OFFSET + count * ENTRY.size
+                if (
+                    magic == MAGIC and version == VERSION and
+                    os.fstat(f.fileno()).st_size == size
+                ):
+                    self._data = mmap.mmap(
+                        f.fileno(), 0, access=mmap.ACCESS_READ
+                    )
+                    self._count = count
+                    self._fanout = FANOUT.unpack_from(
+                        self._data, HEADER.size
+                    )
+                    self.high_water = high_water
+                    return
+        logger.warning(f'Ignore invalid records index {self.path}')
+
+    def _read_journal(self):
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb') as f:
+            journal = f.read()
+        # A truncated last entry (e.g. after a crash) is ignored.
+        end = len(journal) - len(journal) % ENTRY.size
+        for entry in ENTRY.iter_unpack(journal[:end]):
+            self._add_to_journal(*entry)
+
+    def _add_to_journal(self, digest, last_modified, record_hash):
+        if digest not in self._journal and self._find(digest) is None:
+            self._journal_new += 1
+        self._journal[digest] = (last_modified, record_hash)
+        self.high_water = max(self.high_water, last_modified)
+
+    def _find(self, digest):
+        """Return the index entry of this digest, or None."""
+        prefix = digest[0] << 8 | digest[1]
+        lo = self._fanout[prefix - 1] if prefix else 0
+        hi = self._fanout[prefix]
+        while lo < hi:
+            middle = (lo + hi) // 2
+            offset = ENTRIES_OFFSET + middle * ENTRY.size
+            found = self._data[offset:offset + len(digest)]
+            if found < digest:
+                lo = middle + 1
+            elif found > digest:
+                hi = middle
+            else:
+                _, last_modified, record_hash = ENTRY.unpack_from(
+                    self._data, offset
+                )
+                return last_modified, record_hash
+        return None
+
+    def __len__(self):
+        return self._count + self._journal_new
+
+    def __contains__(self, record_id):
+        return self.get(record_id) is not None
+
+    def __getitem__(self, record_id):
+        entry = self.get(record_id)
+        if entry is None:
+            raise KeyError(record_id)
+        return entry
+
+    def get(self, record_id, default=None):
+        """Return the ``(last_modified, hash)`` of this record."""
+        if record_id is None:
+            return default
+        digest = id_digest(record_id)
+        entry = self._journal.get(digest) or self._find(digest)
+        if entry is None:
+            return default
+        last_modified, record_hash = entry
+        return last_modified, record_hash.hex()
+
+    def add(self, record_id, last_modified, record_hash):
+        """Add or replace the entry of this record."""
+        digest = id_digest(record_id)
+        record_hash = bytes.fromhex(record_hash)
+        self._journal_file.write(
+            ENTRY.pack(digest, last_modified, record_hash)
+        )
+        self._add_to_journal(digest, last_modified, record_hash)
+        # The index is rewritten once for as many entries as it has.
+        if len(self._journal) >= max(
+            self.journal_merge_min, self._count
+        ):
+            self.merge()
+
+    def flush(self):
+        """Write the journal, and merge it if it grew enough."""
+        if len(self._journal) >= self.journal_merge_min:
+            self.merge()
+        else:
+            self._journal_file.flush()
+
+    def merge(self):
+        """Merge the journal into the index."""
+        if not self._journal:
+            return
+        journal = sorted(
+            (digest, last_modified, record_hash)
+            for digest, (last_modified, record_hash) in self._journal.items()
+        )
+
+        def indexed():
+            for i in range(self._count):
+                offset = ENTRIES_OFFSET + i * ENTRY.size
+                yield ENTRY.unpack_from(self._data, offset)
+
+        count = 0
+        counts = [0] * 65536
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(b'\0' * ENTRIES_OFFSET)
+            previous = None
+            # The journal entries come first, and replace those of the
+            # index for the same record.
+            merged = heapq.merge(
+                ((entry[0], 0, entry) for entry in journal),
+                ((entry[0], 1, entry) for entry in indexed()),
+            )
+            for digest, _, entry in merged:
+                if digest == previous:
+                    continue
+                previous = digest
+                f.write(ENTRY.pack(*entry))
+                counts[digest[0] << 8 | digest[1]] += 1
+                count += 1
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, VERSION, count, self.high_water))
+            f.write(FANOUT.pack(*itertools.accumulate(counts)))
+        # Atomic write.
+        os.replace(tmp_path, self.path)
+
+        self.close()
+        self._open()
+        self._journal = {}
+        self._journal_new = 0
+        self._journal_file = open(self.journal_path, 'wb')
+        logger.info(f'Merged records index {self.path} ({count} entries)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._journal_file.close()
+        if self._data is not None:
+            self._data.close()
+            self._data = None
+            self._count = 0
+            self._fanout = (0,) * 65536
+
+    def import_dict(self, records):
+        """Add the entries of the former JSON dump of the records."""
+        for record_id, (last_modified, record_hash) in records.items():
+            self.add(record_id, last_modified, record_hash)
+        self.merge()
@@ -5,21 +5,20 @@
 import re
 import asyncio
 import datetime
-import glob
 import json
 import logging
+import mmap
 import os
 import pkgutil
 import tempfile
 import time
 import zlib
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
 
-import aiofiles
 import aiobotocore
 import botocore
 from decouple import config, Csv
-from aiohttp.client_exceptions import ClientPayloadError
 import kinto_http
 import raven
 from raven.handlers.logging import SentryHandler
@@ -27,12 +26,23 @@ from ruamel import yaml
 from kinto_wizard.async_kinto import AsyncKintoClient
 from kinto_wizard.yaml2kinto import initialize_server
 
+from buildhub.concurrency import Shares
+from buildhub.download_cache import DownloadCache
+from buildhub.http_session import create_session
 from buildhub.inventory_to_records import (
     __version__,
     NB_RETRY_REQUEST,
+    MetadataFetcher,
     csv_to_records,
+    fetch_records,
+    metadata_cache,
+)
+from buildhub.inventory_workers import (
+    INVENTORY_WORKERS,
+    parse_inventory_files,
 )
 from buildhub.to_kinto import fetch_existing, main as to_kinto_main
+from buildhub.utils import merge_streams
 from buildhub.configure_markus import get_metrics
 
 
@@ -43,7 +53,6 @@ FOLDER = (
     'delivery-{inventory}/'
 )
 CHUNK_SIZE = 1024 * 256  # 256 KB
-MAX_CSV_DOWNLOAD_AGE = 60 * 60 * 24 * 2  # two days
 
 INITIALIZE_SERVER = config('INITIALIZE_SERVER', default=True, cast=bool)
 
@@ -68,6 +77,13 @@ LOG_LEVEL = config('LOG_LEVEL', default='INFO')
 
 STORE_DAILY_MANIFEST = config('STORE_DAILY_MANIFEST', default=False, cast=bool)
 
+# Number of CSV files downloaded ahead of the one being read...
+CSV_PREFETCH_FILES = config('CSV_PREFETCH_FILES', default=2, cast=int)
+# ...as long as the files not read yet don't exceed this size.
+CSV_PREFETCH_MAX_BYTES = config(
+    'CSV_PREFETCH_MAX_BYTES', default=512 * 1024 * 1024, cast=int
+)
+
 # Optional Sentry with synchronuous client.
 SENTRY_DSN = config('SENTRY_DSN', default=None)
 sentry = raven.Client(
@@ -190,81 +206,371 @@ async def list_manifest_entries(loop, s3_client, inventory):
         yield f
 
 
-async def download_csv(
+async def download_file(
+    s3_client,
+    files,
+    cache,
+    chunk_size=CHUNK_SIZE,
+):
+    """
+    Download the S3 object of this manifest entry, unless it was already
+    downloaded, and return the path of the local file (csv.gz).
+    """
+    # If it doesn't exist on disk, download to disk.
+    file_path = cache.get(files)
+    if file_path is not None:
+        logger.debug(f'{file_path} was already downloaded locally')
+        return file_path
+
+    key = 'public/' + files['key']
+    logger.info('Fetching inventory piece {}'.format(key))
+    file_csv_gz = await s3_client.get_object(Bucket=BUCKET, Key=key)
+    with cache.download(files) as destination:
+        async with file_csv_gz['Body'] as source:
+            while 'there are chunks to read':
+                gzip_chunk = await source.read(chunk_size)
+                if not gzip_chunk:
+                    break  # End of response.
+                destination.write(gzip_chunk)
+    logger.info(
+        f'Downloaded {key} to {destination.path} ({destination.size} bytes)'
+    )
+    return destination.path
+
+
+async def prefetch_files(
+    s3_client,
+    files_stream,
+    cache,
+    chunk_size=CHUNK_SIZE,
+    prefetch=CSV_PREFETCH_FILES,
+    max_bytes=CSV_PREFETCH_MAX_BYTES,
+):
+    """
+    Yield the manifest entries, along with the download of their file.
+
+    While an entry is being processed, the files of the next ``prefetch``
+    entries are downloaded, as long as their size and the size of the
+    current one don't exceed ``max_bytes``. The download is None if it was
+    not started ahead.
+    """
+    files_stream = files_stream.__aiter__()
+    # (files, download) of the next entries, in the manifest order.
+    downloads = deque()
+    downloads_size = 0
+    upcoming = None
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(downloads) <= max(0, prefetch):
+                if upcoming is None:
+                    try:
+                        upcoming = await files_stream.__anext__()
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+                size = upcoming.get('size', 0)
+                if not downloads:
+                    # The current entry, which is always processed.
+                    download = None
+                elif downloads_size + size > max_bytes:
+                    break
+                else:
+                    download = asyncio.ensure_future(download_file(
+                        s3_client,
+                        upcoming,
+                        cache,
+                        chunk_size=chunk_size,
+                    ))
+                downloads.append((upcoming, download))
+                downloads_size += size
+                upcoming = None
+            if not downloads:
+                break
+
+            files, download = downloads[0]
+            yield files, download
+            downloads.popleft()
+            downloads_size -= files.get('size', 0)
+    finally:
+        for _, download in downloads:
+            if download is not None:
+                download.cancel()
+
+
+async def download_files(
     loop,
     s3_client,
     files_stream,
     chunk_size=CHUNK_SIZE,
     download_directory=CSV_DOWNLOAD_DIRECTORY,
+    prefetch=CSV_PREFETCH_FILES,
+    max_bytes=CSV_PREFETCH_MAX_BYTES,
 ):
     """
-    Download the S3 object of each key and return deflated data chunks (CSV).
+    Download the S3 object of each key, unless it was already downloaded,
+    and return the path of the local files (csv.gz).
+
+    While a file is being read, the next ``prefetch`` files are downloaded,
+    as long as the files downloaded and not read yet don't exceed
+    ``max_bytes``.
     :param loop: asyncio event loop.
     :param s3_client: Initialized S3 client.
     :param keys_stream async generator: List of object keys for
     the csv.gz manifests.
     """
+    cache = DownloadCache(download_directory)
+    cache.clean()
+
+    entries = prefetch_files(
+        s3_client,
+        files_stream,
+        cache,
+        chunk_size=chunk_size,
+        prefetch=prefetch,
+        max_bytes=max_bytes,
+    )
+    try:
+        async for files, download in entries:
+            with metrics.timer('s3_inventory_to_kinto_download_wait'):
+                if download is None:
+                    download = download_file(
+                        s3_client,
+                        files,
+                        cache,
+                        chunk_size=chunk_size,
+                    )
+                file_path = await download
+            # The time spent parsing is reported by the workers.
+            yield file_path
+    finally:
+        # Cancel the downloads started ahead.
+        await entries.aclose()
+
+
+def read_file(file_path, chunk_size=CHUNK_SIZE):
+    """
+    Return deflated data chunks (CSV) of a downloaded file.
+
+    The file is mapped in memory, instead of being read chunk by chunk.
+    """
+    if not os.stat(file_path).st_size:
+        return  # Can't map an empty file.
+    gzip = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    with open(file_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for start in range(0, len(data), chunk_size):
+                csv_chunk = gzip.decompress(data[start:start + chunk_size])
+                if csv_chunk:
+                    yield csv_chunk
+
+
+async def read_download(download, chunk_size=CHUNK_SIZE):
+    """
+    Wait for a download started ahead and return its deflated data chunks.
+    """
+    file_path = await download
+    for csv_chunk in read_file(file_path, chunk_size):
+        yield csv_chunk
 
-    # Make sure the directory exists if it wasn't already created.
-    if not os.path.isdir(download_directory):
-        os.makedirs(download_directory, exist_ok=True)
 
-    # Look for old download junk in the download directory.
-    too_old = MAX_CSV_DOWNLOAD_AGE
-    for file_path in glob.glob(os.path.join(download_directory, '*.csv.gz')):
-        age = time.time() - os.stat(file_path).st_mtime
-        if age > too_old:
+async def stream_file(
+    s3_client,
+    files,
+    cache,
+    chunk_size=CHUNK_SIZE,
+):
+    """
+    Return deflated data chunks (CSV) of the S3 object of this manifest
+    entry as they are received, while writing the object to the download
+    cache for the next runs.
+    """
+    file_path = cache.get(files)
+    if file_path is not None:
+        logger.debug(f'{file_path} was already downloaded locally')
+        for csv_chunk in read_file(file_path, chunk_size):
+            yield csv_chunk
+        return
+
+    key = 'public/' + files['key']
+    logger.info('Fetching inventory piece {}'.format(key))
+    file_csv_gz = await s3_client.get_object(Bucket=BUCKET, Key=key)
+    # The object is downloaded as fast as possible, and not as fast as the
+    # chunks are consumed, so that the connection doesn't stay idle. The
+    # chunks are read back from the file being written: only their sizes
+    # wait in memory.
+    destination = cache.download(files)
+    reader = open(destination.partial_path, 'rb')
+    received = asyncio.Queue()
+
+    async def tee():
+        try:
+            with destination:
+                async with file_csv_gz['Body'] as source:
+                    while 'there are chunks to read':
+                        gzip_chunk = await source.read(chunk_size)
+                        if not gzip_chunk:
+                            break  # End of response.
+                        destination.write(gzip_chunk)
+                        destination.flush()
+                        received.put_nowait(len(gzip_chunk))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            received.put_nowait(e)
+        else:
+            # Only once the checksum of the object was verified.
+            received.put_nowait(0)
             logger.info(
-                f'Delete old download file {file_path} '
-                f'({age} seconds old)'
+                f'Downloaded {key} to {destination.path} '
+                f'({destination.size} bytes)'
             )
-            os.remove(file_path)
 
-    async for files in files_stream:
-        # If it doesn't exist on disk, download to disk.
-        file_path = os.path.join(
-            download_directory,
-            files['MD5checksum'] + '.csv.gz'
-        )
-        # The file neither exists or has data.
-        if os.path.isfile(file_path) and os.stat(file_path).st_size:
-            logger.debug(f'{file_path} was already downloaded locally')
-        else:
-            key = 'public/' + files['key']
-            logger.info('Fetching inventory piece {}'.format(key))
-            file_csv_gz = await s3_client.get_object(Bucket=BUCKET, Key=key)
+    download = asyncio.ensure_future(tee())
+    gzip = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    try:
+        while 'there are chunks to read':
+            size = await received.get()
+            if isinstance(size, Exception):
+                raise size
+            if not size:
+                break  # End of response.
+            # Still open if the file was moved in the cache meanwhile.
+            gzip_chunk = reader.read(size)
+            csv_chunk = gzip.decompress(gzip_chunk)
+            if csv_chunk:
+                # If the received doesn't have enough data to complete
+                # at least one block, the decompressor returns an
+                # empty string.
+                # A later chunk added to the compressor will then
+                # complete the block, it'll be decompressed and we
+                # get data then.
+                # Thanks Martijn Pieters http://bit.ly/2vbgQ3x
+                yield csv_chunk
+        await download
+    finally:
+        # Stop the download if the chunks are not all consumed.
+        download.cancel()
+        reader.close()
+
+
+async def download_csv(
+    loop,
+    s3_client,
+    files_stream,
+    chunk_size=CHUNK_SIZE,
+    download_directory=CSV_DOWNLOAD_DIRECTORY,
+    prefetch=CSV_PREFETCH_FILES,
+    max_bytes=CSV_PREFETCH_MAX_BYTES,
+):
+    """
+    Download the S3 object of each key and return deflated data chunks (CSV).
+
+    The current object is decompressed as it is downloaded, while the next
+    ones are downloaded ahead (see ``download_files``).
+    :param loop: asyncio event loop.
+    :param s3_client: Initialized S3 client.
+    :param keys_stream async generator: List of object keys for
+    the csv.gz manifests.
+    """
+    cache = DownloadCache(download_directory)
+    cache.clean()
+
+    entries = prefetch_files(
+        s3_client,
+        files_stream,
+        cache,
+        chunk_size=chunk_size,
+        prefetch=prefetch,
+        max_bytes=max_bytes,
+    )
+    try:
+        async for files, download in entries:
+            if download is None:
+                csv_chunks = stream_file(
+                    s3_client,
+                    files,
+                    cache,
+                    chunk_size=chunk_size,
+                )
+            else:
+                csv_chunks = read_download(download, chunk_size=chunk_size)
+            # Tell the time spent downloading and decompressing apart from
+            # the time spent by the consumer on the chunks.
+            started = time.time()
+            parsing = 0
             try:
-                async with aiofiles.open(file_path, 'wb') as destination:
-                    async with file_csv_gz['Body'] as source:
-                        while 'there are chunks to read':
-                            gzip_chunk = await source.read(chunk_size)
-                            if not gzip_chunk:
-                                break  # End of response.
-                            await destination.write(gzip_chunk)
-                size = os.stat(file_path).st_size
-                logger.info(f'Downloaded {key} to {file_path} ({size} bytes)')
-            except ClientPayloadError:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                raise
-
-        # Now we expect the file to exist locally. Let's read it.
-        gzip = zlib.decompressobj(zlib.MAX_WBITS | 16)
-        async with aiofiles.open(file_path, 'rb') as stream:
-            while 'there are chunks to read':
-                gzip_chunk = await stream.read(chunk_size)
-                if not gzip_chunk:
-                    break  # End of response.
-                csv_chunk = gzip.decompress(gzip_chunk)
-                if csv_chunk:
-                    # If the received doesn't have enough data to complete
-                    # at least one block, the decompressor returns an
-                    # empty string.
-                    # A later chunk added to the compressor will then
-                    # complete the block, it'll be decompressed and we
-                    # get data then.
-                    # Thanks Martijn Pieters http://bit.ly/2vbgQ3x
+                async for csv_chunk in csv_chunks:
+                    yielded = time.time()
                     yield csv_chunk
+                    parsing += time.time() - yielded
+            finally:
+                await csv_chunks.aclose()
+            elapsed = time.time() - started
+            metrics.timing(
+                's3_inventory_to_kinto_download_wait',
+                (elapsed - parsing) * 1000
+            )
+            metrics.timing('s3_inventory_to_kinto_parse', parsing * 1000)
+    finally:
+        # Cancel the downloads started ahead.
+        await entries.aclose()
+
+
+async def inventory_to_records(
+    loop,
+    s3_client,
+    fetcher,
+    inventory,
+    shares,
+    min_last_modified=None,
+):
+    """
+    Yield the records of the last manifest of this inventory.
+    :param fetcher: ``MetadataFetcher`` used for this inventory, which
+    gets its share of the concurrent requests from ``shares``.
+    """
+    tags = [f'inventory:{inventory}']
+    started = time.time()
+    shares.join(inventory, fetcher)
+    try:
+        files_stream = list_manifest_entries(loop, s3_client, inventory)
+        if INVENTORY_WORKERS:
+            # Parse the CSV files in a pool of processes, and fetch
+            # the metadata of the records in the event loop.
+            files = download_files(loop, s3_client, files_stream)
+            records_stream = fetch_records(
+                loop,
+                parse_inventory_files(
+                    loop,
+                    files,
+                    workers=INVENTORY_WORKERS,
+                    min_last_modified=min_last_modified,
+                ),
+                skip_incomplete=True,
+                fetcher=fetcher,
+                with_hash=True,
+            )
+        else:
+            csv_stream = download_csv(loop, s3_client, files_stream)
+            records_stream = csv_to_records(
+                loop,
+                csv_stream,
+                skip_incomplete=True,
+                min_last_modified=min_last_modified,
+                fetcher=fetcher,
+                with_hash=True,
+            )
+        async for record in records_stream:
+            metrics.incr('s3_inventory_to_kinto_records', tags=tags)
+            yield record
+    finally:
+        shares.leave(inventory)
+    elapsed = time.time() - started
+    metrics.timing(
+        's3_inventory_to_kinto_inventory', elapsed * 1000, tags=tags
+    )
+    logger.info(f'Processed inventory {inventory} in {elapsed:.0f} seconds')
 
 
 async def main(loop, inventories=INVENTORIES):
@@ -296,31 +602,36 @@ async def main(loop, inventories=INVENTORIES):
             tzinfo=datetime.timezone.utc
         )
 
-    # Fetch all existing records as a big dict from kinto
-    existing = fetch_existing(kinto_client)
-
     # Download CSVs, deduce records and push to Kinto.
+    # The inventories are processed at the same time, and share the S3
+    # client, the archives session, the metadata cache, and the publisher.
     session = aiobotocore.get_session(loop=loop)
     boto_config = botocore.config.Config(signature_version=botocore.UNSIGNED)
     async with session.create_client(
         's3', region_name=REGION_NAME, config=boto_config
     ) as client:
-        for inventory in inventories:
-            files_stream = list_manifest_entries(loop, client, inventory)
-            csv_stream = download_csv(loop, client, files_stream)
-            records_stream = csv_to_records(
-                loop,
-                csv_stream,
-                skip_incomplete=True,
-                min_last_modified=min_last_modified,
-            )
-            await to_kinto_main(
-                loop,
-                records_stream,
-                kinto_client,
-                existing=existing,
-                skip_existing=False
-            )
+        # Fetch all existing records in the records index.
+        with metadata_cache(), fetch_existing(kinto_client) as existing:
+            async with create_session(loop) as archive_session:
+                shares = Shares()
+                records_stream = merge_streams([
+                    inventory_to_records(
+                        loop,
+                        client,
+                        MetadataFetcher(archive_session),
+                        inventory,
+                        shares,
+                        min_last_modified=min_last_modified,
+                    )
+                    for inventory in inventories
+                ])
+                await to_kinto_main(
+                    loop,
+                    records_stream,
+                    kinto_client,
+                    existing=existing,
+                    skip_existing=False
+                )
 
 
 @metrics.timer_decorator('s3_inventory_to_kinto_run')
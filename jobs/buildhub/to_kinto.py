@@ -24,30 +24,44 @@ It is meant to be combined with other commands that output records to stdout :)
 import asyncio
 import async_timeout
 import concurrent.futures
-import copy
-import hashlib
 import json
 import logging
 import os
+import queue
 import sys
+import threading
 from urllib.parse import urlparse
 
 from kinto_http import cli_utils
 from decouple import config
 
-from buildhub.utils import stream_as_generator
+from buildhub.utils import (
+    hash_record, stream_as_generator
+)
 from buildhub.configure_markus import get_metrics
+from buildhub.http_session import create_session
+from buildhub.kinto_publisher import BatchPublisher
+from buildhub.records_index import RecordsIndex
 
 
 DEFAULT_SERVER = 'http://localhost:8888/v1'
 DEFAULT_BUCKET = 'default'
 DEFAULT_COLLECTION = 'cid'
-NB_THREADS = 3
 NB_RETRY_REQUEST = 3
 WAIT_TIMEOUT = 5
 BATCH_MAX_REQUESTS = config('BATCH_MAX_REQUESTS', default=9999, cast=int)
+RECORDS_INDEX_FILENAME = '.records-index-{server}-{bucket}-{collection}.bin'
+# Former JSON dump of the records, imported in the index if found.
 PREVIOUS_DUMP_FILENAME = '.records-hashes-{server}-{bucket}-{collection}.json'
 CACHE_FOLDER = config('CACHE_FOLDER', default='.')
+# When there is no previous run, all the records are fetched in pages of
+# this size, by that many threads.
+FETCH_EXISTING_PAGE_SIZE = config(
+    'FETCH_EXISTING_PAGE_SIZE', default=10000, cast=int
+)
+FETCH_EXISTING_PARALLEL = config(
+    'FETCH_EXISTING_PARALLEL', default=4, cast=int
+)
 
 logger = logging.getLogger(__name__)
 metrics = get_metrics('buildhub')
@@ -55,52 +69,209 @@ metrics = get_metrics('buildhub')
 done = object()
 
 
-def hash_record(record):
-    """Return a hash string (based of MD5) that is 32 characters long.
+class _Partition:
+    """Records with ``after < last_modified < before``."""
+    def __init__(self, after, before):
+        self.after = after
+        self.before = before
+        # How long a period the last full page spanned, if any.
+        self.page_span = None
 
-    This function does *not mutate* the record but needs to make a copy of
-    the record (and mutate that) so it's less performant.
+    def remaining_pages(self):
+        """How many pages are left after the one being fetched, estimated
+        from the last one.
+        """
+        if not self.page_span:
+            return 0
+        return (self.before - self.after) / self.page_span - 1
+
+
+class _Partitions:
+    """Partitions of the records fetched by ``fetch_all_records``.
+
+    Each partition is fetched page by page, in ascending order. When a
+    thread has no partition left to fetch, it takes the second half of the
+    one with the most pages left, so that the threads stay busy even if
+    most of the records were modified within a short period.
     """
-    return hash_record_mutate(copy.deepcopy(record))
+    def __init__(self, after, before, count):
+        self.condition = threading.Condition()
+        step = max(1, (before - after) // count)
+        bounds = list(range(after, before, step))[:count] + [before]
+        self.pending = [
+            # The bound between two partitions belongs to the second one.
+            _Partition(start - 1 if start > after else start, end)
+            for start, end in zip(bounds, bounds[1:])
+        ]
+        self.running = []
+        self.closed = False
+
+    def take(self):
+        """Return a partition to fetch, or None when there is nothing left.
+        """
+        with self.condition:
+            while True:
+                if self.closed:
+                    return None
+                if self.pending:
+                    partition = self.pending.pop(0)
+                    break
+                if not self.running:
+                    return None
+                largest = max(
+                    self.running, key=lambda p: p.remaining_pages()
+                )
+                if largest.remaining_pages() >= 2:
+                    # Leave the page being fetched to its thread.
+                    start = largest.after + largest.page_span
+                    middle = (start + largest.before) // 2
+                    partition = _Partition(middle - 1, largest.before)
+                    largest.before = middle
+                    break
+                # Wait until a partition can be split or is finished.
+                self.condition.wait()
+            self.running.append(partition)
+            return partition
+
+    def advance(self, partition, records, more):
+        """Return the records of a page that are still part of this
+        partition (it may have been split meanwhile), and whether it was
+        fetched completely.
+        """
+        with self.condition:
+            kept = [
+                r for r in records if r['last_modified'] < partition.before
+            ]
+            if kept:
+                last_modified = kept[-1]['last_modified']
+                if more:
+                    partition.page_span = last_modified - partition.after
+                partition.after = last_modified
+            finished = (
+                not more or
+                len(kept) < len(records) or
+                partition.after >= partition.before - 1
+            )
+            if finished:
+                self.running.remove(partition)
+            self.condition.notify_all()
+            return kept, finished
 
+    def close(self):
+        """Stop handing out partitions, e.g. after an error."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
 
-def hash_record_mutate(record):
-    """Return a hash string (based of MD5) that is 32 characters long.
 
-    NOTE! For performance, this function *will mutate* the record object.
-    Yeah, that sucks but it's more performant than having to clone a copy
-    when you have to do it 1 million of these records.
+def fetch_all_records(
+    client,
+    page_size=FETCH_EXISTING_PAGE_SIZE,
+    parallel=FETCH_EXISTING_PARALLEL,
+):
+    """Yield the pages of all the records of the collection.
+
+    The collection is split in ranges of ``last_modified``, which are
+    fetched concurrently by ``parallel`` threads. Instead of following the
+    ``Next-Page`` links, every page starts after the last timestamp of the
+    previous one, since they are unique within a collection. At most
+    ``2 * parallel`` pages are fetched ahead of the consumer.
     """
-    record.pop('last_modified', None)
-    record.pop('schema', None)
-    return hashlib.md5(
-       json.dumps(record, sort_keys=True).encode('utf-8')
-    ).hexdigest()
+    session = client.session
+    endpoint = client.get_endpoint('records')
+
+    def request(**params):
+        body, headers = session.request('get', endpoint, params=params)
+        return body['data'], headers
+
+    oldest, headers = request(_sort='last_modified', _limit=1)
+    if not oldest:
+        return
+    # The timestamp of the collection is the highest of its records.
+    newest = int(headers['ETag'].strip('"'))
+    partitions = _Partitions(
+        oldest[0]['last_modified'] - 1, newest + 1, parallel
+    )
+
+    pages = queue.Queue(maxsize=2 * parallel)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def work():
+        try:
+            partition = partitions.take()
+            while partition is not None:
+                finished = False
+                while not finished:
+                    records, headers = request(
+                        gt_last_modified=partition.after,
+                        lt_last_modified=partition.before,
+                        _sort='last_modified',
+                        _limit=page_size,
+                    )
+                    records, finished = partitions.advance(
+                        partition, records, bool(headers.get('Next-Page'))
+                    )
+                    if not put(records):
+                        return
+                partition = partitions.take()
+            put(done)
+        except Exception as e:
+            partitions.close()
+            put(e)
+
+    with concurrent.futures.ThreadPoolExecutor(parallel) as executor:
+        for _ in range(parallel):
+            executor.submit(work)
+        try:
+            remaining = parallel
+            while remaining:
+                page = pages.get()
+                if page is done:
+                    remaining -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield page
+        finally:
+            stop.set()
+            partitions.close()
 
 
 @metrics.timer_decorator('to_kinto_fetch_existing')
 def fetch_existing(
     client,
-    cache_file=PREVIOUS_DUMP_FILENAME
+    cache_file=RECORDS_INDEX_FILENAME,
+    previous_dump_file=PREVIOUS_DUMP_FILENAME,
 ):
-    """Fetch all records since last run. A JSON file on disk is used to store
-    records from previous run.
+    """Fetch all records since last run. A ``RecordsIndex`` on disk is used
+    to store records from previous run.
     """
-    cache_file = os.path.join(CACHE_FOLDER, cache_file.format(
-        server=urlparse(client.session.server_url).hostname,
-        bucket=client._bucket_name,
-        collection=client._collection_name))
+    def cache_path(filename):
+        return os.path.join(CACHE_FOLDER, filename.format(
+            server=urlparse(client.session.server_url).hostname,
+            bucket=client._bucket_name,
+            collection=client._collection_name))
+
+    records = RecordsIndex(cache_path(cache_file))
+    previous_dump_file = cache_path(previous_dump_file)
+    if not len(records) and os.path.exists(previous_dump_file):
+        logger.info(f'Import {previous_dump_file} in the records index')
+        with open(previous_dump_file) as f:
+            records.import_dict(json.load(f))
+        os.remove(previous_dump_file)
 
-    records = {}
     previous_run_etag = None
-
-    if os.path.exists(cache_file):
-        with open(cache_file) as f:
-            records = json.load(f)
-            highest_timestamp = max(
-                [r[0] for r in records.values()]
-            )
-            previous_run_etag = '"%s"' % highest_timestamp
+    if records.high_water:
+        previous_run_etag = '"%s"' % records.high_water
 
     # The reason we can't use client.get_records() is because it is not
     # an iterator and if the Kinto database has 1M objects we'll end up
@@ -115,81 +286,24 @@ def fetch_existing(
             pages=float('inf')
         )]
     else:
-        def new_records_iterator():
-            params = {'_since': None}
-            endpoint = client.get_endpoint('records')
-            while True:
-                record_resp, headers = client.session.request(
-                    'get',
-                    endpoint,
-                    params=params
-                )
-                yield record_resp['data']
-                try:
-                    endpoint = headers['Next-Page']
-                    if not endpoint:
-                        raise KeyError('exists but empty value')
-                except KeyError:
-                    break
-                params.pop('_since', None)
-
-        new_records_batches = new_records_iterator()
+        new_records_batches = fetch_all_records(client)
 
     count_new_records = 0
     for new_records in new_records_batches:
         for record in new_records:
             count_new_records += 1
-            records[record['id']] = [
+            records.add(
+                record['id'],
                 record['last_modified'],
-                hash_record_mutate(record)
-            ]
+                hash_record(record)
+            )
 
     metrics.gauge('to_kinto_fetched_new_records', count_new_records)
 
-    # Atomic write.
-    if records:
-        tmpfilename = cache_file + '.tmp'
-        with open(tmpfilename, 'w') as f:
-            json.dump(records, f, sort_keys=True, indent=2)
-        os.rename(tmpfilename, cache_file)
-
+    records.flush()
     return records
 
 
-@metrics.timer_decorator('to_kinto_publish_records')
-def publish_records(client, records):
-    """Synchronuous function that pushes records on Kinto in batch.
-    """
-    with client.batch() as batch:
-        for record in records:
-            if 'id' in record['data']:
-                metrics.incr('to_kinto_update_record')
-                batch.update_record(**record)
-            else:
-                metrics.incr('to_kinto_create_record')
-                batch.create_record(**record)
-    results = batch.results()
-
-    # Batch don't fail with 4XX errors. Make sure we output a comprehensive
-    # error here when we encounter them.
-    error_msgs = []
-    for result in results:
-        error_status = result.get('code')
-        if error_status == 412:
-            error_msg = ("Record '{details[existing][id]}' already exists: "
-                         '{details[existing]}').format_map(result)
-            error_msgs.append(error_msg)
-        elif error_status == 400:
-            error_msg = 'Invalid record: {}'.format(result)
-            error_msgs.append(error_msg)
-        elif error_status is not None:
-            error_msgs.append('Error: {}'.format(result))
-    if error_msgs:
-        raise ValueError('\n'.join(error_msgs))
-
-    return results
-
-
 async def produce(loop, records, queue):
     """Reads an asynchronous generator of records and puts them into the queue.
     """
@@ -203,7 +317,7 @@ async def produce(loop, records, queue):
     await queue.put(done)
 
 
-async def consume(loop, queue, executor, client, existing):
+async def consume(loop, queue, publisher, existing):
     """Store grabbed releases from the archives website in Kinto.
     """
     def markdone(queue, n):
@@ -216,40 +330,60 @@ async def consume(loop, queue, executor, client, existing):
         return done
 
     def record_unchanged(record):
-        return (
-            record['id'] in existing and
-            existing.get(record['id']) == hash_record(record)
-        )
-
-    info = client.server_info()
-    ideal_batch_size = min(
-        BATCH_MAX_REQUESTS,
-        info['settings']['batch_max_requests']
-    )
+        # The hash may have been computed along with the record.
+        record_hash = record.pop('hash', None) or hash_record(record['data'])
+        # Existing records are ``[last_modified, hash]``.
+        known = existing.get(record['data'].get('id'))
+        return known is not None and known[1] == record_hash
+
+    # The record that didn't fit in the previous batch.
+    carried = None
+    producer_done = False
 
     while 'consumer is not cancelled':
         # Consume records from queue, and batch operations.
         # But don't wait too much if there's not enough records
         # to fill a batch.
+        # The publisher adapts the number of records per batch to how
+        # fast the server processes them.
         batch = []
+        subrequests = []
+        # Counting a separator for every record, to keep it simple.
+        size = publisher.payload_size([])
+        if carried is not None:
+            batch.append(carried[0])
+            subrequests.append(carried[1])
+            size += len(carried[1]) + 2
+            carried = None
         try:
             with async_timeout.timeout(WAIT_TIMEOUT):
-                while len(batch) < ideal_batch_size:
+                while len(batch) < publisher.batch_size:
+                    if producer_done and batch:
+                        # Only the carried record is left.
+                        break
                     record = await queue.get()
                     # Producer is done, don't wait for items to come in.
                     if record is done:
                         queue.task_done()
+                        producer_done = True
                         break
                     # Check if known and hasn't changed.
-                    if record_unchanged(record['data']):
+                    if record_unchanged(record):
                         logger.debug(
-                            f"Skip unchanged record {record['id']}"
+                            f"Skip unchanged record {record['data']['id']}"
                         )
                         queue.task_done()
                         continue
 
-                    # Add record to current batch, and wait for more.
+                    # Add record to current batch, and wait for more,
+                    # unless the batch request would be too large.
+                    subrequest = publisher.encode(record)
+                    size += len(subrequest) + 2
+                    if batch and size > publisher.max_bytes:
+                        carried = (record, subrequest)
+                        break
                     batch.append(record)
+                    subrequests.append(subrequest)
 
         except asyncio.TimeoutError:
             if batch:
@@ -259,13 +393,11 @@ async def consume(loop, queue, executor, client, existing):
             else:
                 logger.debug('Waiting for records in the queue.')
 
-        # We have a batch of records, let's publish them using
-        # parallel workers.
+        # We have a batch of records, let's publish it while the next one
+        # is filled, up to a few batches at a time.
         # When done, mark queue items as done.
         if batch:
-            task = loop.run_in_executor(
-                executor, publish_records, client, batch
-            )
+            task = await publisher.submit(subrequests)
             task.add_done_callback(markdone(queue, len(batch)))
 
 
@@ -282,24 +414,37 @@ async def main(
     skip_existing=True,
     existing=None,
 ):
-    existing = existing or {}  # Because it can't be a mutable default argument
+    if existing is None:
+        existing = {}  # Because it can't be a mutable default argument
     if skip_existing:
         # Fetch the list of records to skip records that exist
         # and haven't changed.
         existing = fetch_existing(client)
 
-    # Start a producer and a consumer with threaded kinto requests.
-    queue = asyncio.Queue()
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=NB_THREADS)
-    # Schedule the consumer
-    consumer_coro = consume(loop, queue, executor, client, existing)
-    consumer = asyncio.ensure_future(consumer_coro)
-    # Run the producer and wait for completion
-    await produce(loop, stdin_generator, queue)
-    # Wait until the consumer is done consuming everything.
-    await queue.join()
-    # The consumer is still awaiting for the producer, cancel it.
-    consumer.cancel()
+    try:
+        # Start a producer and a consumer with batch requests sent from the
+        # event loop.
+        queue = asyncio.Queue()
+        async with create_session(loop) as session:
+            info = client.server_info()
+            max_batch_size = min(
+                BATCH_MAX_REQUESTS,
+                info['settings']['batch_max_requests']
+            )
+            publisher = BatchPublisher(client, session, max_batch_size)
+            # Schedule the consumer
+            consumer_coro = consume(loop, queue, publisher, existing)
+            consumer = asyncio.ensure_future(consumer_coro)
+            # Run the producer and wait for completion
+            await produce(loop, stdin_generator, queue)
+            # Wait until the consumer is done consuming everything.
+            await queue.join()
+            # The consumer is still awaiting for the producer, cancel it.
+            consumer.cancel()
+    finally:
+        if skip_existing:
+            # Release the records index.
+            existing.close()
 
 
 def run():
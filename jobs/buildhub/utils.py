@@ -4,6 +4,9 @@
 
 import asyncio
 import datetime
+import functools
+import hashlib
+import json
 import os.path
 import re
 
@@ -23,6 +26,11 @@ KNOWN_MIMETYPES = {
     'exe': 'application/msdos-windows',
     }
 
+# Fields set by the server, which are not part of the record content.
+_UNHASHED_FIELDS = ('last_modified', 'schema')
+# Same output as ``json.dumps(record, sort_keys=True)``.
+_canonical_json = json.JSONEncoder(sort_keys=True).encode
+
 
 def key_to_archive_url(key):
     # If the key (e.g.
@@ -151,7 +159,7 @@ def build_record_id(record):
 
 
 # Compile these regexes once per module to speed up their use inside
-# the is_build_url() function.
+# the KeyClassifier methods.
 
 _build_url_exclude_names_regex = re.compile(
     '.+(tinderbox|try-builds|partner-repacks|latest|contrib|/0\.|'
@@ -164,6 +172,144 @@ _build_url_exclude_suffixes_regex = re.compile(
     '.+(sdk|tests|crashreporter|stub|gtk2.+xft|source|asan)'
 )
 
+_nightly_metadata_exclude_regex = re.compile(
+    '.+(latest-mozilla-central|test_packages|mozinfo)'
+)
+
+_rc_version_regex = re.compile('/candidates/(.+)-candidates')
+
+
+class KeyClassifier:
+    """Tell what kind of file an archive URL points to.
+
+    The regular expressions are compiled once per product (and per
+    candidate version for RC metadata) instead of on every call, which
+    matters when classifying the millions of keys of an S3 inventory.
+    """
+    IGNORE = None
+    BUILD = 'build'
+    RC_METADATA = 'rc-metadata'
+    NIGHTLY_METADATA = 'nightly-metadata'
+
+    def __init__(self, products=ALL_PRODUCTS):
+        self.products = frozenset(products)
+        self._build_regexes = {}
+        self._nightly_regexes = {}
+        self._rc_regexes = {}
+        # Warm up the tables for the products we know about.
+        for product in self.products:
+            self._build_regex(product, windows=False)
+            self._build_regex(product, windows=True)
+            self._nightly_regex(product)
+
+    def _build_regex(self, product, windows):
+        try:
+            return self._build_regexes[(product, windows)]
+        except KeyError:
+            pass
+        extensions = FILE_EXTENSIONS
+        # Only .exe for Windows.
+        if windows:
+            extensions = [x for x in extensions if x != 'zip']
+        name = product
+        if name == 'devedition':
+            name = 'firefox'
+        if name == 'mobile':
+            name = 'fennec'
+        regex = re.compile('{}-(.+)({})$'.format(name, '|'.join(extensions)))
+        self._build_regexes[(product, windows)] = regex
+        return regex
+
+    def _nightly_regex(self, product):
+        try:
+            return self._nightly_regexes[product]
+        except KeyError:
+            pass
+        name = product
+        if name == 'mobile':
+            name = 'fennec'
+        # Note: devedition has no nightly.
+        regex = re.compile(r'.+/{}-(.*)\.(.*)\.(.*)\.json$'.format(name))
+        self._nightly_regexes[product] = regex
+        return regex
+
+    def _rc_regex(self, product, version):
+        try:
+            return self._rc_regexes[(product, version)]
+        except KeyError:
+            pass
+        name = product
+        if name == 'mobile':
+            name = 'fennec'
+        if name == 'devedition':
+            name = 'firefox'
+        if name == 'fennec':  # fennec-56.0b1.en-US.android-arm.json
+            regex = re.compile(
+                r'.+/{}-{}\.([^\.]+)\.([^\.]+)\.json$'.format(name, version)
+            )
+        else:  # firefox-56.0b1.json
+            regex = re.compile(r'.+/{}-{}\.json$'.format(name, version))
+        self._rc_regexes[(product, version)] = regex
+        return regex
+
+    def classify(self, product, url):
+        """Return one of ``BUILD``, ``RC_METADATA``, ``NIGHTLY_METADATA``
+        or ``IGNORE`` for the specified URL.
+        """
+        if product not in self.products:
+            return self.IGNORE
+        # Build archives never end with .json, and metadata always do.
+        if url.endswith('.json'):
+            if self.is_rc_build_metadata(product, url):
+                return self.RC_METADATA
+            if self.is_nightly_build_metadata(product, url):
+                return self.NIGHTLY_METADATA
+            return self.IGNORE
+        if self.is_build_url(product, url):
+            return self.BUILD
+        return self.IGNORE
+
+    def is_build_url(self, product, url):
+        if (
+            'nightly' in url and
+            'mozilla-central' not in url and
+            'comm-central' not in url
+        ):
+            return False
+
+        if _build_url_exclude_names_regex.match(url):
+            return False
+
+        filename = os.path.basename(url)
+        match_filename = filename.replace(' ', '-').lower()
+        if _build_url_exclude_suffixes_regex.match(match_filename):
+            return False
+
+        regex = self._build_regex(product, windows='win' in url)
+        return regex.match(match_filename)
+
+    def is_nightly_build_metadata(self, product, url):
+        if 'nightly' not in url:
+            return False
+        if 'mozilla-central' not in url:
+            # pub/mobile/nightly/2017/08/2017-08-01-15-03-46-date-android-api-15/...
+            return False
+        # Exlude alias folder, and other metadata.
+        if _nightly_metadata_exclude_regex.match(url):
+            return False
+        return bool(self._nightly_regex(product).match(url))
+
+    def is_rc_build_metadata(self, product, url):
+        m = _rc_version_regex.search(url)
+        if not m:
+            return False
+        version = m.group(1)
+        return bool(self._rc_regex(product, version).match(url))
+
+
+# Used by the module level helpers below.
+_key_classifier = KeyClassifier()
+
 
 def is_build_url(product, url):
     """
@@ -185,34 +331,7 @@ def is_build_url(product, url):
           fennec-57.0a1.hi-IN.android-arm.apk
     - firefox/nightly/2017/08/2017-08-25-10-01-26-mozilla-central-l10n/Firefox Installer.fr.exe
     """  # noqa
-    if (
-        'nightly' in url and
-        'mozilla-central' not in url and
-        'comm-central' not in url
-    ):
-        return False
-
-    if _build_url_exclude_names_regex.match(url):
-        return False
-
-    extensions = FILE_EXTENSIONS
-    # Only .exe for Windows.
-    if 'win' in url:
-        extensions = [x for x in extensions if x != 'zip']
-
-    if product == 'devedition':
-        product = 'firefox'
-    if product == 'mobile':
-        product = 'fennec'
-    filename = os.path.basename(url)
-    match_filename = filename.replace(' ', '-').lower()
-    if _build_url_exclude_suffixes_regex.match(match_filename):
-        return False
-
-    re_filename = re.compile(
-        '{}-(.+)({})$'.format(product, '|'.join(extensions))
-    )
-    return re_filename.match(match_filename)
+    return _key_classifier.is_build_url(product, url)
 
 
 def is_release_build_metadata(product, version, filename):
@@ -224,43 +343,20 @@ def is_release_build_metadata(product, version, filename):
     """
     if product == 'devedition':
         product = 'firefox'
-    re_metadata = re.compile('{}-{}(.*).json'.format(product, version))
-    return bool(re_metadata.match(filename))
+    return bool(_release_metadata_regex(product, version).match(filename))
+
+
+@functools.lru_cache(maxsize=1024)
+def _release_metadata_regex(product, version):
+    return re.compile('{}-{}(.*).json'.format(product, version))
 
 
 def is_nightly_build_metadata(product, url):
-    if 'nightly' not in url:
-        return False
-    if 'nightly' in url and 'mozilla-central' not in url:
-        # pub/mobile/nightly/2017/08/2017-08-01-15-03-46-date-android-api-15/...
-        return False
-    if product == 'mobile':
-        product = 'fennec'
-    # Exlude alias folder, and other metadata.
-    re_exclude = re.compile('.+(latest-mozilla-central|test_packages|mozinfo)')
-    if re_exclude.match(url):
-        return False
-    # Note: devedition has no nightly.
-    re_metadata = re.compile('.+/{}-(.*)\.(.*)\.(.*)\.json$'.format(product))
-    return bool(re_metadata.match(url))
+    return _key_classifier.is_nightly_build_metadata(product, url)
 
 
 def is_rc_build_metadata(product, url):
-    if product == 'mobile':
-        product = 'fennec'
-    if product == 'devedition':
-        product = 'firefox'
-    m = re.search('/candidates/(.+)-candidates', url)
-    if not m:
-        return False
-    version = m.group(1)
-    if product == 'fennec':  # fennec-56.0b1.en-US.android-arm.json
-        re_metadata = re.compile(
-            '.+/{}-{}\.([^\.]+)\.([^\.]+)\.json$'.format(product, version)
-        )
-    else:  # firefox-56.0b1.json
-        re_metadata = re.compile('.+/{}-{}\.json$'.format(product, version))
-    return bool(re_metadata.match(url))
+    return _key_classifier.is_rc_build_metadata(product, url)
 
 
 def guess_mimetype(url):
@@ -278,17 +374,22 @@ def chunked(iterable, size):
 
 async def split_lines(stream):
     """Split the chunks of bytes on new lines.
+
+    Yields lists of lines as ``bytes``, without the new line characters.
+    Nothing is decoded here, consumers only decode the lines they need.
     """
-    leftover = ''
+    # Everything after the last \n of a chunk belongs to the next line.
+    leftover = bytearray()
     async for chunk in stream:
-        chunk_str = chunk.decode('utf-8')
-        chunk_str = leftover + chunk_str
-        chunk_str = chunk_str.lstrip('\n')
-        lines = chunk_str.split('\n')
-        # Everything after \n belongs to the next line.
-        leftover = lines.pop()
+        lines = chunk.split(b'\n')
+        last = lines.pop()
         if lines:
+            if leftover:
+                leftover += lines[0]
+                lines[0] = bytes(leftover)
+                del leftover[:]
             yield lines
+        leftover += last
 
 
 async def stream_as_generator(loop, stream):
@@ -303,7 +404,204 @@ async def stream_as_generator(loop, stream):
         yield line
 
 
+async def merge_streams(streams, maxsize=100):
+    """Iterate several async iterables concurrently, and yield their items
+    as they come.
+
+    The first error raised by one of them stops the others.
+    """
+    queue = asyncio.Queue(maxsize=maxsize)
+    finished = object()
+
+    async def pump(stream):
+        try:
+            async for item in stream:
+                await queue.put((item, None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await queue.put((None, e))
+        else:
+            await queue.put((finished, None))
+        finally:
+            if hasattr(stream, 'aclose'):
+                await stream.aclose()
+
+    pumps = [asyncio.ensure_future(pump(stream)) for stream in streams]
+    try:
+        remaining = len(pumps)
+        while remaining:
+            item, error = await queue.get()
+            if error is not None:
+                raise error
+            if item is finished:
+                remaining -= 1
+                continue
+            yield item
+    finally:
+        for task in pumps:
+            task.cancel()
+        await asyncio.gather(*pumps, return_exceptions=True)
+
+
+# Substrings of an archive URL that change the way it is parsed. When the
+# filename contains none of them, the folder alone decides the layout.
+_LAYOUT_KEYWORDS = (
+    'nightly', 'candidates', 'funnelcake', 'aurora', 'devedition', 'old-id',
+)
+# Hundreds of locales and platforms share the same folder, and the
+# inventory is sorted by key, so a small cache goes a long way.
+_FOLDER_LAYOUT_CACHE_SIZE = 4096
+
+
 def record_from_url(url):
+    """Extract infos from URL and return a record.
+
+    What can be deduced from the folder (product, version, platform,
+    locale, channel...) is parsed once per folder and cached, only the
+    filename is parsed for every URL. The result is the same as
+    ``_parse_record_from_url()``.
+    """
+    folder, _, filename = url.rpartition('/')
+    layout = None
+    if not any(keyword in filename for keyword in _LAYOUT_KEYWORDS):
+        layout = _folder_layout(folder)
+    if layout is None:
+        return _parse_record_from_url(url)
+
+    product, version, platform, os_, locale, channel, record_id = layout
+
+    if version is None:
+        # Nightly and old release URLs have their version in the filename.
+        # https://archive.mozilla.org/pub/firefox/nightly/2017/05/
+        # 2017-05-15-10-02-38-mozilla-central/firefox-55.0a1.en-US.linux-x86_64.tar.bz2
+        filename_parts = filename.replace(' ', '-').lower().split('.')
+        major_version = filename_parts[0].split('-')[1]
+        version = '{}.{}'.format(major_version, filename_parts[1])
+        locale = filename_parts[2]
+        filename_platform = filename_parts[3]
+        if platform is None:
+            platform = filename_platform
+        platform, os_, locale, channel = _normalize_target(
+            url, version, platform, locale
+        )
+
+    record = {
+        'source': {
+            'product': product,
+        },
+        'target': {
+            'platform': platform,
+            'os': os_,
+            'locale': locale,
+            'version': version,
+            'channel': channel,
+        },
+        'download': {
+            'url': url,
+            'mimetype': guess_mimetype(url),
+        }
+    }
+
+    record['id'] = record_id or build_record_id(record)
+    return record
+
+
+@functools.lru_cache(maxsize=_FOLDER_LAYOUT_CACHE_SIZE)
+def _folder_layout(folder):
+    """Return a ``(product, version, platform, os, locale, channel, id)``
+    tuple with what can be deduced from the folder of an archive URL.
+
+    Version, locale and channel are ``None`` when they are read from the
+    filename. ``None`` is returned when the folder does not match any
+    known layout, or when the filename takes part in it.
+    """
+    url_parts = folder.replace(' ', '-').lower().split('/')
+    # The filename would be the next part.
+    nb_parts = len(url_parts) + 1
+
+    if nb_parts < 6:
+        return None
+    product = url_parts[4]
+    if product == 'mobile':
+        product = 'fennec'
+
+    # Nightly URL
+    if 'nightly' in folder:
+        if nb_parts < 10:
+            return None
+        platform = None
+        if 'android-api' in url_parts[8]:
+            platform = '-'.join(url_parts[8].split('-')[8:11])
+        return (product, None, platform, None, None, None, None)
+
+    # Candidates URL
+    elif 'candidates' in folder:
+        if nb_parts < 11:
+            return None
+        version = url_parts[6].strip('-candidates')
+        candidate_number = url_parts[7].strip('build')
+        version = '{}rc{}'.format(version, candidate_number)
+        platform = url_parts[8]
+        locale = url_parts[9]
+        if 'funnelcake' in platform:
+            if nb_parts < 12:
+                return None
+            version = '{}-{}'.format(version, platform)
+            platform = url_parts[9]
+            locale = url_parts[10]
+
+    # Old release url
+    elif nb_parts < 9:
+        return (product, None, None, None, None, None, None)
+
+    # Some funnelcakes
+    elif 'funnelcake' in folder and nb_parts == 11:
+        version = url_parts[6]
+        locale = url_parts[9]
+        platform = url_parts[8]
+
+    # Beta, Release or ESR URL
+    else:
+        if nb_parts < 10:
+            return None
+        version = url_parts[6]
+        locale = url_parts[8]
+        platform = url_parts[7]
+
+    platform, os_, locale, channel = _normalize_target(
+        folder, version, platform, locale
+    )
+    record = {
+        'source': {'product': product},
+        'target': {
+            'version': version,
+            'platform': platform,
+            'locale': locale,
+            'channel': channel,
+        },
+    }
+    return (
+        product, version, platform, os_, locale, channel,
+        build_record_id(record),
+    )
+
+
+def _normalize_target(url, version, platform, locale):
+    if platform.startswith('mac'):
+        platform = platform.replace('mac', 'macosx')
+
+    channel = guess_channel(url, version)
+
+    if '-' in locale:
+        locale_parts = locale.split('-')
+        locale_parts[1] = locale_parts[1].upper()
+        locale = '-'.join(locale_parts)  # fr-FR, ja-JP-mac
+
+    return platform, normalized_platform(platform), locale, channel
+
+
+def _parse_record_from_url(url):
     # Extract infos from URL and return a record.
 
     # Get rid of spaces and capitalized names (eg. 'Firefox Setup.exe')
@@ -419,6 +717,22 @@ def check_record(record):
         raise ValueError(f"Suspicious version '{version}': {record}")
 
 
+def hash_record(record):
+    """Return the MD5 hash of the record, without the fields set by the
+    server (e.g. ``last_modified``).
+
+    The record is neither copied nor mutated: only the top-level fields are
+    filtered, and the JSON is encoded at once, which is much faster than
+    feeding it to the hash piece by piece.
+    """
+    if any(field in record for field in _UNHASHED_FIELDS):
+        record = {
+            field: value for field, value in record.items()
+            if field not in _UNHASHED_FIELDS
+        }
+    return hashlib.md5(_canonical_json(record).encode('utf-8')).hexdigest()
+
+
 def merge_metadata(record, metadata):
     if metadata is None:
         return record
@@ -25,6 +25,7 @@ ENTRY_POINTS = {
         'to-kinto = buildhub.to_kinto:run',
         'inventory-to-records = buildhub.inventory_to_records:run',
         'latest-inventory-to-kinto = buildhub.s3_inventory_to_kinto:run',
+        'metadata-cache = buildhub.metadata_store:run',
     ],
 }
 
@@ -0,0 +1,27 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+from unittest import mock
+
+import pytest
+
+from buildhub import inventory_to_records
+from buildhub.circuit_breaker import CircuitBreaker, RetryBudget
+from buildhub.concurrency import AdaptiveLimiter
+
+
+@pytest.fixture(autouse=True)
+def request_controls():
+    """The failures of a test don't open the circuit breaker (or spend the
+    retry budget) of the following ones.
+    """
+    with mock.patch.multiple(
+        inventory_to_records,
+        _request_limiter=AdaptiveLimiter(
+            inventory_to_records.NB_PARALLEL_REQUESTS
+        ),
+        _circuit_breaker=CircuitBreaker(),
+        _retry_budget=RetryBudget(),
+    ):
+        yield
@@ -0,0 +1,134 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+import time
+
+import aiohttp
+import asynctest
+import pytest
+from markus import INCR
+from markus.testing import MetricsMock
+
+from buildhub.circuit_breaker import (
+    CircuitBreaker, CircuitOpenError, RetryBudget
+)
+
+
+def server_error():
+    return aiohttp.ClientResponseError(None, (), code=503)
+
+
+def not_found():
+    return aiohttp.ClientResponseError(None, (), code=404)
+
+
+@pytest.fixture
+def breaker():
+    return CircuitBreaker(
+        error_rate=0.5, window=10, min_requests=4, open_seconds=0.05
+    )
+
+
+def test_opens_once_error_rate_is_reached(breaker):
+    for exception in (None, server_error(), None):
+        breaker.check()
+        breaker.record(exception)
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.check()
+    breaker.record(server_error())
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+
+def test_not_found_is_not_a_failure(breaker):
+    for _ in range(10):
+        breaker.check()
+        breaker.record(not_found())
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_failures_are_counted_in_a_window(breaker):
+    for _ in range(8):
+        breaker.record(None)
+    breaker.record(server_error())
+    breaker.record(server_error())
+    assert breaker.state == CircuitBreaker.CLOSED
+    for _ in range(3):
+        breaker.record(server_error())
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def open_breaker(breaker):
+    for _ in range(4):
+        breaker.record(asyncio.TimeoutError())
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_half_opens_for_a_single_probe(breaker):
+    open_breaker(breaker)
+    time.sleep(0.05)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.check()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    breaker.record(None, probe=True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert not breaker.check()
+
+
+def test_failed_probe_opens_again(breaker):
+    open_breaker(breaker)
+    time.sleep(0.05)
+    breaker.record(server_error(), probe=breaker.check())
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_cancelled_probe_lets_another_one_through(breaker):
+    open_breaker(breaker)
+    time.sleep(0.05)
+    breaker.record(asyncio.CancelledError(), probe=breaker.check())
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.check()
+
+
+def test_metrics(breaker):
+    with MetricsMock() as mm:
+        open_breaker(breaker)
+        with pytest.raises(CircuitOpenError):
+            breaker.check()
+        assert mm.has_record(INCR, 'buildhub.circuit_breaker_opened', 1)
+        assert mm.has_record(INCR, 'buildhub.circuit_breaker_rejected', 1)
+
+
+class CallTest(asynctest.TestCase):
+    async def test_records_outcome(self):
+        breaker = CircuitBreaker(min_requests=1, open_seconds=60)
+        with pytest.raises(aiohttp.ClientResponseError):
+            async with breaker.call():
+                raise server_error()
+        with pytest.raises(CircuitOpenError):
+            async with breaker.call():
+                pass
+
+    async def test_wait_until_half_open(self):
+        breaker = CircuitBreaker(min_requests=1, open_seconds=0.05)
+        breaker.record(server_error())
+        await breaker.wait()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        async with breaker.call():
+            pass
+        assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_retry_budget():
+    budget = RetryBudget(ratio=0.5, reserve=1)
+    assert budget.can_retry()
+    budget.withdraw()
+    assert not budget.can_retry()
+    budget.deposit()
+    assert not budget.can_retry()
+    budget.deposit()
+    assert budget.can_retry()
@@ -0,0 +1,251 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+
+import aiohttp
+import asynctest
+import pytest
+from markus import GAUGE, INCR
+from markus.testing import MetricsMock
+
+from buildhub.concurrency import (
+    AdaptiveLimiter, Shares, overload_reason, parse_weights
+)
+
+
+def response_error(code):
+    return aiohttp.ClientResponseError(None, (), code=code)
+
+
+@pytest.mark.parametrize('exception,expected', [
+    (asyncio.TimeoutError(), 'timeout'),
+    (response_error(429), '429'),
+    (response_error(503), '503'),
+    (response_error(404), None),
+    (aiohttp.ClientConnectionError(), 'connection'),
+    (ValueError(), None),
+    (None, None),
+])
+def test_overload_reason(exception, expected):
+    assert overload_reason(exception) == expected
+
+
+def test_limit_is_raised_while_latency_is_flat():
+    limiter = AdaptiveLimiter(4, maximum=10)
+    for _ in range(5):
+        limiter.succeeded(0.1, saturated=True)
+    assert int(limiter.limit) == 5
+    # Not raised when it isn't reached.
+    limiter.succeeded(0.1, saturated=False)
+    assert int(limiter.limit) == 5
+
+
+def test_limit_is_not_raised_when_latency_grows():
+    limiter = AdaptiveLimiter(4, latency_tolerance=2)
+    limiter.succeeded(0.1, saturated=True)
+    limit = limiter.limit
+    for _ in range(20):
+        limiter.succeeded(1, saturated=True)
+    assert limiter.limit < limit + 2
+
+
+def test_limit_is_cut_once_per_epoch():
+    limiter = AdaptiveLimiter(8)
+    limiter.overloaded(0, '503')
+    assert limiter.limit == 4
+    # Requests started before the cut.
+    limiter.overloaded(0, '503')
+    assert limiter.limit == 4
+    limiter.overloaded(1, 'timeout')
+    assert limiter.limit == 2
+
+
+def test_limit_stays_within_bounds():
+    limiter = AdaptiveLimiter(2, minimum=2, maximum=3)
+    limiter.overloaded(0, '503')
+    assert limiter.limit == 2
+    for _ in range(20):
+        limiter.succeeded(0.1, saturated=True)
+    assert limiter.limit == 3
+
+
+def test_limit_metrics():
+    limiter = AdaptiveLimiter(8)
+    with MetricsMock() as mm:
+        limiter.overloaded(0, '429')
+        assert mm.has_record(GAUGE, 'buildhub.http_concurrency_limit', 4)
+        assert mm.filter_records(
+            INCR, 'buildhub.http_concurrency_overload', tags=['reason:429']
+        )
+
+
+def test_limit_metrics_name():
+    limiter = AdaptiveLimiter(8, metric='publish')
+    with MetricsMock() as mm:
+        assert limiter.overloaded(0, '503')
+        # Only once for the requests started before the cut.
+        assert not limiter.overloaded(0, '503')
+        assert mm.has_record(GAUGE, 'buildhub.publish_limit', 4)
+        assert len(mm.filter_records(INCR, 'buildhub.publish_overload')) == 2
+
+
+class Consumer:
+    concurrency = None
+
+
+def test_parse_weights():
+    assert parse_weights(['firefox:3', ' archive', 'b:0.5']) == {
+        'firefox': 3, 'archive': 1, 'b': 0.5
+    }
+    with pytest.raises(ValueError):
+        parse_weights(['firefox:0'])
+
+
+def test_shares_follow_weights():
+    shares = Shares(16, ['firefox:3'])
+    firefox, archive = Consumer(), Consumer()
+    shares.join('firefox', firefox)
+    assert firefox.concurrency == 16
+    with MetricsMock() as mm:
+        shares.join('archive', archive)
+        assert mm.has_record(
+            GAUGE, 'buildhub.inventory_concurrency_share', 4,
+            tags=['inventory:archive']
+        )
+    assert (firefox.concurrency, archive.concurrency) == (12, 4)
+    # The share of a consumer that is done goes to the others.
+    shares.leave('firefox')
+    assert archive.concurrency == 16
+
+
+def test_shares_are_at_least_one():
+    shares = Shares(2, {'a': 10})
+    a, b = Consumer(), Consumer()
+    shares.join('a', a)
+    shares.join('b', b)
+    assert (a.concurrency, b.concurrency) == (2, 1)
+
+
+class SlotTest(asynctest.TestCase):
+    async def test_requests_wait_for_a_slot(self):
+        limiter = AdaptiveLimiter(2)
+        running = []
+        max_running = 0
+
+        async def request():
+            nonlocal max_running
+            async with limiter.slot():
+                running.append(1)
+                max_running = max(max_running, len(running))
+                await asyncio.sleep(0.01)
+                running.pop()
+
+        await asyncio.gather(*[request() for _ in range(6)])
+        assert max_running == 2
+        assert limiter.in_flight == 0
+
+    async def test_failures_cut_the_limit(self):
+        limiter = AdaptiveLimiter(4)
+        with pytest.raises(aiohttp.ClientResponseError):
+            async with limiter.slot():
+                raise response_error(503)
+        assert limiter.limit == 2
+        assert limiter.in_flight == 0
+
+    async def test_cancelled_waiters_free_their_turn(self):
+        limiter = AdaptiveLimiter(1)
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        limiter.release()
+        assert limiter.in_flight == 0
+        assert await limiter.acquire() == (0, True)
+
+
+class SimulationTest(asynctest.TestCase):
+    """Requests to a local server that answers in 10ms up to ``CAPACITY``
+    concurrent requests, slows down quickly beyond, and answers 503 when twice
+    overloaded.
+    """
+    CAPACITY = 8
+
+    async def setUp(self):
+        self.active = 0
+        self.max_active = 0
+        self.overloaded = 0
+        self.unavailable_above = 2 * self.CAPACITY
+
+        async def handle(reader, writer):
+            try:
+                while True:
+                    await reader.readuntil(b'\r\n\r\n')
+                    self.active += 1
+                    self.max_active = max(self.max_active, self.active)
+                    if self.active > self.unavailable_above:
+                        self.overloaded += 1
+                        status = b'503 Service Unavailable'
+                    else:
+                        status = b'200 OK'
+                    delay = 0.01 * max(1, self.active / self.CAPACITY) ** 2
+                    await asyncio.sleep(delay)
+                    self.active -= 1
+                    writer.write(
+                        b'HTTP/1.1 ' + status + b'\r\n'
+                        b'Content-Length: 2\r\n\r\n{}'
+                    )
+            except (asyncio.IncompleteReadError, ConnectionError):
+                writer.close()
+
+        self.server = await asyncio.start_server(
+            handle, '127.0.0.1', 0, loop=self.loop
+        )
+        port = self.server.sockets[0].getsockname()[1]
+        self.url = 'http://127.0.0.1:{}/'.format(port)
+
+    async def tearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def simulate(self, limiter, nb_requests, nb_workers=64):
+        limits = []
+        remaining = nb_requests
+
+        async def worker(session):
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                try:
+                    async with limiter.slot():
+                        async with session.get(self.url) as response:
+                            response.raise_for_status()
+                            await response.read()
+                except aiohttp.ClientResponseError:
+                    pass
+                limits.append(limiter.limit)
+
+        connector = aiohttp.TCPConnector(limit=0, loop=self.loop)
+        async with aiohttp.ClientSession(
+            connector=connector, loop=self.loop
+        ) as session:
+            await asyncio.gather(*[worker(session) for _ in range(nb_workers)])
+        return limits
+
+    async def test_limit_grows_up_to_the_server_capacity(self):
+        limiter = AdaptiveLimiter(2, maximum=64)
+        limits = await self.simulate(limiter, 600)
+        assert max(limits) > self.CAPACITY
+        # Backs off before the server is overloaded for long.
+        assert limiter.limit <= 2 * self.CAPACITY
+        assert self.overloaded < 600 * 0.05
+        assert limiter.in_flight == 0
+
+    async def test_limit_backs_off_when_overloaded(self):
+        self.unavailable_above = 0
+        limiter = AdaptiveLimiter(32, maximum=64)
+        with MetricsMock() as mm:
+            await self.simulate(limiter, 100)
+        assert limiter.limit == limiter.minimum
+        assert mm.has_record(GAUGE, 'buildhub.http_concurrency_limit', 1)
@@ -0,0 +1,125 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import glob
+import hashlib
+import os
+import time
+
+import pytest
+from markus.testing import MetricsMock
+
+from buildhub.download_cache import DownloadCache, ChecksumError
+
+
+def entry(content):
+    return {
+        'key': 'data/a.csv.gz',
+        'size': len(content),
+        'MD5checksum': hashlib.md5(content).hexdigest(),
+    }
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return DownloadCache(str(tmpdir), max_bytes=100, max_age=3600)
+
+
+def store(cache, content, last_use=None):
+    files = entry(content)
+    with cache.download(files) as destination:
+        destination.write(content)
+    if last_use is not None:
+        os.utime(destination.path, (last_use, last_use))
+    return destination.path
+
+
+def test_miss_and_hit(cache):
+    files = entry(b'abc')
+    with MetricsMock() as metrics_mock:
+        assert cache.get(files) is None
+        store(cache, b'abc')
+        assert cache.get(files) == cache.path(files)
+    assert metrics_mock.has_record(
+        'incr', stat='buildhub.download_cache_miss', value=1
+    )
+    assert metrics_mock.has_record(
+        'incr', stat='buildhub.download_cache_hit', value=1
+    )
+    assert metrics_mock.has_record(
+        'incr', stat='buildhub.download_cache_bytes_saved', value=3
+    )
+
+
+def test_download_is_moved_in_place(cache):
+    files = entry(b'abc')
+    with cache.download(files) as destination:
+        destination.write(b'a')
+        assert not os.path.exists(cache.path(files))
+        destination.write(b'bc')
+    with open(cache.path(files), 'rb') as f:
+        assert f.read() == b'abc'
+    assert glob.glob(os.path.join(cache.directory, '*.part')) == []
+
+
+def test_corrupted_download_is_not_kept(cache):
+    files = entry(b'abc')
+    with MetricsMock() as metrics_mock:
+        with pytest.raises(ChecksumError):
+            with cache.download(files) as destination:
+                destination.write(b'ab')
+    assert metrics_mock.has_record(
+        'incr', stat='buildhub.download_cache_corrupted', value=1
+    )
+    assert os.listdir(cache.directory) == []
+
+
+def test_interrupted_download_is_not_kept(cache):
+    files = entry(b'abc')
+    with pytest.raises(ConnectionError):
+        with cache.download(files) as destination:
+            destination.write(b'abc')
+            raise ConnectionError()
+    assert os.listdir(cache.directory) == []
+
+
+def test_least_recently_used_files_are_evicted(cache):
+    now = time.time()
+    oldest = store(cache, b'a' * 40, last_use=now - 30)
+    old = store(cache, b'b' * 40, last_use=now - 20)
+    # Used recently.
+    cache.get(entry(b'a' * 40))
+    with MetricsMock() as metrics_mock:
+        new = store(cache, b'c' * 40)
+    assert os.path.exists(oldest)
+    assert not os.path.exists(old)
+    assert os.path.exists(new)
+    assert metrics_mock.has_record(
+        'incr', stat='buildhub.download_cache_evicted', value=1
+    )
+    assert metrics_mock.has_record(
+        'incr', stat='buildhub.download_cache_evicted_bytes', value=40
+    )
+    assert metrics_mock.has_record(
+        'gauge', stat='buildhub.download_cache_size', value=80
+    )
+
+
+def test_new_download_is_kept_even_if_too_big(cache):
+    file_path = store(cache, b'a' * 200)
+    assert os.path.exists(file_path)
+
+
+def test_clean(cache):
+    now = time.time()
+    old = store(cache, b'a', last_use=now - 7200)
+    recent = store(cache, b'b', last_use=now - 60)
+    partial = os.path.join(cache.directory, 'abc-123.part')
+    with open(partial, 'wb') as f:
+        f.write(b'a')
+    cache.clean()
+    assert sorted(os.listdir(cache.directory)) == [
+        os.path.basename(recent)
+    ]
+    assert not os.path.exists(old)
@@ -0,0 +1,103 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+
+import asynctest
+import pytest
+from markus import INCR
+from markus.testing import MetricsMock
+
+from buildhub.hedging import Hedger, percentile
+
+
+@pytest.mark.parametrize('p,expected', [
+    (50, 5),
+    (90, 9),
+    (99, 10),
+    (100, 10),
+    (0, 1),
+])
+def test_percentile(p, expected):
+    assert percentile(range(10, 0, -1), p) == expected
+
+
+def test_no_delay_without_enough_samples():
+    hedger = Hedger(enabled=True, min_samples=3)
+    hedger._latencies.extend([0.1, 0.2])
+    assert hedger.delay() is None
+    hedger._latencies.append(0.3)
+    assert hedger.delay() == 0.3
+
+
+def test_observe():
+    hedger = Hedger(enabled=True, min_samples=1)
+    hedger.observe(0.2)
+    assert hedger.delay() == 0.2
+    hedger = Hedger(enabled=False, min_samples=1)
+    hedger.observe(0.2)
+    assert hedger.delay() is None
+
+
+class HedgerTest(asynctest.TestCase):
+    async def setUp(self):
+        self.hedger = Hedger(
+            enabled=True, percentile=50, max_rate=1, min_samples=2
+        )
+        self.hedger._latencies.extend([0.01, 0.01])
+        self.started = []
+        self.cancelled = []
+
+    def request(self, *latencies):
+        """Make requests that take these latencies (or raise them)."""
+        latencies = list(latencies)
+
+        async def request():
+            number = len(self.started)
+            self.started.append(number)
+            latency = latencies.pop(0)
+            try:
+                if isinstance(latency, Exception):
+                    await asyncio.sleep(0.02)
+                    raise latency
+                await asyncio.sleep(latency)
+            except asyncio.CancelledError:
+                self.cancelled.append(number)
+                raise
+            return number
+
+        return request
+
+    async def test_fast_requests_are_not_hedged(self):
+        assert await self.hedger.run(self.request(0.001)) == 0
+        assert self.started == [0]
+        assert self.hedger.hedged == 0
+
+    async def test_first_response_wins(self):
+        with MetricsMock() as mm:
+            result = await self.hedger.run(self.request(1, 0.001))
+            assert mm.has_record(INCR, 'buildhub.http_hedge_sent', 1)
+            assert mm.has_record(INCR, 'buildhub.http_hedge_won', 1)
+        assert result == 1
+        await asyncio.sleep(0)
+        assert self.cancelled == [0]
+
+    async def test_failed_request_waits_for_the_other(self):
+        result = await self.hedger.run(self.request(ValueError(), 0.05))
+        assert result == 1
+        with pytest.raises(ValueError):
+            await self.hedger.run(self.request(ValueError(), ValueError()))
+
+    async def test_hedge_rate_is_capped(self):
+        self.hedger.max_rate = 0.5
+        for _ in range(4):
+            await self.hedger.run(self.request(0.03, 0.001))
+        # Every other request.
+        assert self.hedger.hedged == 2
+        assert len(self.started) == 6
+
+    async def test_disabled(self):
+        self.hedger.enabled = False
+        assert await self.hedger.run(self.request(0.03, 0.001)) == 0
+        assert self.hedger.requests == 0
@@ -0,0 +1,85 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import pytest
+
+from buildhub.http_cache import HTTPCache, CachedResponse
+from buildhub.metadata_store import MetadataStore, STORE_FILENAME
+from buildhub.utils import ARCHIVE_URL
+
+
+@pytest.fixture
+def cache(tmpdir):
+    store = MetadataStore(str(tmpdir.join(STORE_FILENAME)))
+    cache = HTTPCache()
+    cache.attach(store)
+    yield cache
+    store.close()
+
+
+@pytest.mark.parametrize('url', [
+    'pub/firefox/nightly/2017/06/2017-06-16-03-02-07-mozilla-central/'
+    'firefox-56.0a1.en-US.win32.json',
+    'pub/firefox/candidates/54.0-candidates/build3/win64/en-US/'
+    'firefox-54.0.json',
+    'pub/devedition/candidates/56.0b1-candidates/build5/mac/en-US/'
+    'firefox-56.0b1.json',
+])
+def test_immutable_urls(url):
+    assert not HTTPCache().cacheable(ARCHIVE_URL + url)
+
+
+@pytest.mark.parametrize('url', [
+    'pub/firefox/candidates/',
+    'pub/firefox/candidates/54.0-candidates/',
+    'pub/firefox/candidates/54.0-candidates/build3/win64/en-US/',
+    'pub/firefox/nightly/2017/06/',
+])
+def test_revalidated_urls(url):
+    assert HTTPCache().cacheable(ARCHIVE_URL + url)
+
+
+def test_nothing_is_cached_without_store():
+    cache = HTTPCache()
+    url = ARCHIVE_URL + 'pub/firefox/candidates/'
+    cache.put(url, {'ETag': '"abc"'}, {'prefixes': []}, 10)
+    assert cache.get(url) is None
+
+
+def test_put_and_get(cache):
+    url = ARCHIVE_URL + 'pub/firefox/candidates/'
+    headers = {'ETag': '"abc"', 'Last-Modified': 'Wed, 21 Oct 2015 07:28:00'}
+    cache.put(url, headers, {'prefixes': []}, 10)
+    assert cache.get(url) == CachedResponse(
+        '"abc"', 'Wed, 21 Oct 2015 07:28:00', '{"prefixes": []}', 10
+    )
+
+
+def test_responses_without_validators_are_not_cached(cache):
+    url = ARCHIVE_URL + 'pub/firefox/candidates/'
+    cache.put(url, {}, {'prefixes': []}, 10)
+    assert cache.get(url) is None
+
+
+def test_immutable_responses_are_not_cached(cache):
+    # Their content is kept by the metadata cache.
+    url = (
+        ARCHIVE_URL + 'pub/firefox/candidates/54.0-candidates/build3/win64/'
+        'en-US/firefox-54.0.json'
+    )
+    cache.put(url, {'ETag': '"abc"'}, {'buildid': '1'}, 10)
+    assert cache.get(url) is None
+
+
+@pytest.mark.parametrize('etag,last_modified,expected', [
+    ('"abc"', None, {'If-None-Match': '"abc"'}),
+    (None, 'Wed, 21 Oct 2015', {'If-Modified-Since': 'Wed, 21 Oct 2015'}),
+    ('"abc"', 'Wed, 21 Oct 2015', {
+        'If-None-Match': '"abc"',
+        'If-Modified-Since': 'Wed, 21 Oct 2015',
+    }),
+])
+def test_conditional_headers(etag, last_modified, expected):
+    cached = CachedResponse(etag, last_modified, '{}', 2)
+    assert HTTPCache.conditional_headers(cached) == expected
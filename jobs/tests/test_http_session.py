@@ -0,0 +1,79 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+
+import asynctest
+import pytest
+from markus import GAUGE, INCR, TIMING
+from markus.testing import MetricsMock
+
+from buildhub import http_session
+
+
+RESPONSE = (
+    b'HTTP/1.1 200 OK\r\n'
+    b'Content-Type: application/json\r\n'
+    b'Content-Length: 2\r\n'
+    b'\r\n{}'
+)
+
+
+class CreateSessionTest(asynctest.TestCase):
+    async def setUp(self):
+        self.requests = []
+
+        async def handle(reader, writer):
+            try:
+                while True:
+                    request = await reader.readuntil(b'\r\n\r\n')
+                    self.requests.append(request)
+                    writer.write(RESPONSE)
+            except asyncio.IncompleteReadError:
+                writer.close()
+
+        self.server = await asyncio.start_server(
+            handle, '127.0.0.1', 0, loop=self.loop
+        )
+        port = self.server.sockets[0].getsockname()[1]
+        self.url = 'http://127.0.0.1:{}/pub/'.format(port)
+
+    async def tearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def test_session_settings(self):
+        async with http_session.create_session(self.loop) as session:
+            connector = session.connector
+            assert connector.limit_per_host == http_session.HTTP_LIMIT_PER_HOST
+            assert connector.use_dns_cache
+            assert session._read_timeout == http_session.TIMEOUT_SECONDS
+
+    async def test_connections_are_reused(self):
+        with MetricsMock() as mm:
+            async with http_session.create_session(self.loop) as session:
+                for _ in range(3):
+                    async with session.get(self.url) as response:
+                        assert await response.json() == {}
+                connector = session.connector
+                assert connector.acquired == 3
+                assert connector.created == 1
+                assert connector.reuse_ratio == pytest.approx(2 / 3)
+
+            assert len(mm.filter_records(
+                INCR, 'buildhub.http_connection_acquired'
+            )) == 3
+            assert len(mm.filter_records(
+                INCR, 'buildhub.http_connection_created'
+            )) == 1
+            assert mm.has_record(TIMING, 'buildhub.http_connection_connect')
+            assert mm.has_record(
+                GAUGE, 'buildhub.http_connection_reuse_ratio', 1 - 1 / 3
+            )
+
+    async def test_user_agent(self):
+        async with http_session.create_session(self.loop) as session:
+            async with session.get(self.url) as response:
+                await response.read()
+        assert b'User-Agent: BuildHub;' in self.requests[0]
@@ -5,17 +5,34 @@
 import asyncio
 import datetime
 import json
+import os
+import time
 from unittest import mock
 
 import pytest
 import aiohttp
 import asynctest
 from aioresponses import aioresponses
+from markus import GAUGE, INCR
+from markus.testing import MetricsMock
 
 from buildhub import inventory_to_records, utils
+from buildhub.circuit_breaker import CircuitOpenError, RetryBudget
+from buildhub.concurrency import AdaptiveLimiter
+from buildhub.hedging import Hedger
+from buildhub.metadata_store import MetadataStore, STORE_FILENAME
 from buildhub.utils import ARCHIVE_URL  # shortcut
 
 
+def set_candidates_build_folders(product, build_folders):
+    for version, build_folder in build_folders.items():
+        key = '{}/{}'.format(product, version)
+        inventory_to_records._candidates_build_folder[key] = {
+            'build_folder': build_folder,
+            'refresh_after': None,
+        }
+
+
 class LongResponse:
     def raise_for_status(self):
         pass
@@ -36,6 +53,89 @@ class LongResponse:
         return await asyncio.sleep(10000)
 
 
+class FastResponse(LongResponse):
+    headers = {}
+
+    async def json(self):
+        return {'foo': 'bar'}
+
+    async def read(self):
+        return b'{"foo": "bar"}'
+
+
+class ReadCSV(asynctest.TestCase):
+    async def setUp(self):
+        async def stream():
+            yield b'"bucket","pub/firefox/a.exe","12","2017-06-11T12:2'
+            yield b'0:10.2Z","f1aa"\n\n"bucket","pub/firefox/b.zip","3'
+            yield b'4","2017-06-12T12:20:10.2Z","f1ab"\n'
+
+        self.stream = stream()
+
+    async def test_yields_dicts(self):
+        rows = [row async for row in inventory_to_records.read_csv(
+            self.stream
+        )]
+        assert [dict(row) for row in rows] == [
+            {
+                'Bucket': 'bucket',
+                'Key': 'pub/firefox/a.exe',
+                'Size': '12',
+                'LastModifiedDate': '2017-06-11T12:20:10.2Z',
+                'md5': 'f1aa',
+            },
+            {
+                'Bucket': 'bucket',
+                'Key': 'pub/firefox/b.zip',
+                'Size': '34',
+                'LastModifiedDate': '2017-06-12T12:20:10.2Z',
+                'md5': 'f1ab',
+            },
+        ]
+
+    async def test_yields_projected_tuples(self):
+        rows = [row async for row in inventory_to_records.read_csv(
+            self.stream,
+            columns=('Key', 'LastModifiedDate'),
+        )]
+        assert rows == [
+            ('pub/firefox/a.exe', '2017-06-11T12:20:10.2Z'),
+            ('pub/firefox/b.zip', '2017-06-12T12:20:10.2Z'),
+        ]
+
+    async def test_yields_single_column_tuples(self):
+        rows = [row async for row in inventory_to_records.read_csv(
+            self.stream,
+            columns=('Size',),
+        )]
+        assert rows == [('12',), ('34',)]
+
+
+@pytest.mark.parametrize('min_last_modified,expected', [
+    (
+        datetime.datetime(
+            2017, 6, 11, 12, 20, 10, 300000, tzinfo=datetime.timezone.utc
+        ),
+        '2017-06-11T12:20:10',
+    ),
+    (
+        datetime.datetime(
+            2017, 6, 11, 14, 20, 10,
+            tzinfo=datetime.timezone(datetime.timedelta(hours=2))
+        ),
+        '2017-06-11T12:20:10',
+    ),
+])
+def test_last_modified_watermark(min_last_modified, expected):
+    watermark = inventory_to_records.last_modified_watermark(
+        min_last_modified
+    )
+    assert watermark == expected
+    # Entries of the same second are not filtered by the watermark.
+    assert not '2017-06-11T12:20:10.2Z' < watermark
+    assert '2017-06-11T12:20:09.9Z' < watermark
+
+
 class FetchJsonTest(asynctest.TestCase):
     url = 'http://test.example.com'
     data = {'foo': 'bar'}
@@ -63,6 +163,47 @@ class FetchJsonTest(asynctest.TestCase):
             )
         assert received == self.data
 
+    async def test_concurrent_calls_share_one_request(self):
+        with aioresponses() as m:
+            m.get(self.url, payload=self.data)
+            with MetricsMock() as mm:
+                received = await asyncio.gather(*[
+                    inventory_to_records.fetch_json(self.session, self.url)
+                    for _ in range(3)
+                ])
+                coalesced = mm.filter_records(
+                    INCR, 'buildhub.inventory_to_records_fetch_coalesced'
+                )
+                assert len(coalesced) == 2
+        assert received == [self.data] * 3
+        assert not inventory_to_records._in_flight_fetches
+
+    async def test_successive_calls_are_not_shared(self):
+        with aioresponses() as m:
+            m.get(self.url, payload=self.data)
+            m.get(self.url, payload={'foo': 'baz'})
+            first = await inventory_to_records.fetch_json(
+                self.session,
+                self.url
+            )
+            second = await inventory_to_records.fetch_json(
+                self.session,
+                self.url
+            )
+        assert first == self.data
+        assert second == {'foo': 'baz'}
+
+    async def test_concurrent_calls_share_errors(self):
+        with aioresponses() as m:
+            m.get(self.url, status=404)
+            futures = [
+                inventory_to_records.fetch_json(self.session, self.url)
+                for _ in range(2)
+            ]
+            results = await asyncio.gather(*futures, return_exceptions=True)
+        for result in results:
+            assert isinstance(result, inventory_to_records.JSONFileNotFound)
+
     async def test_raises_timeout_response(self):
         with asynctest.patch.object(self.session, 'get', LongResponse):
             with self.assertRaises(asyncio.TimeoutError):
@@ -72,6 +213,77 @@ class FetchJsonTest(asynctest.TestCase):
                     0.1
                 )
 
+    async def test_server_errors_cut_the_concurrency_limit(self):
+        limiter = AdaptiveLimiter(8)
+        with mock.patch.object(
+            inventory_to_records, '_request_limiter', limiter
+        ):
+            with aioresponses() as m:
+                m.get(self.url, status=503)
+                m.get(self.url, payload=self.data)
+                received = await inventory_to_records.fetch_json(
+                    self.session,
+                    self.url
+                )
+        assert received == self.data
+        assert limiter.limit == 4
+        assert limiter.in_flight == 0
+
+    async def test_fails_fast_when_circuit_breaker_is_open(self):
+        breaker = inventory_to_records._circuit_breaker
+        for _ in range(breaker.min_requests):
+            breaker.record(asyncio.TimeoutError())
+        with aioresponses() as m:
+            with self.assertRaises(CircuitOpenError):
+                await inventory_to_records.fetch_json(self.session, self.url)
+            assert not m.requests
+
+    async def test_gives_up_when_retry_budget_is_spent(self):
+        budget = RetryBudget(ratio=0, reserve=0)
+        with mock.patch.object(
+            inventory_to_records, '_retry_budget', budget
+        ):
+            with aioresponses() as m:
+                m.get(self.url, status=503)
+                m.get(self.url, payload=self.data)
+                with self.assertRaises(aiohttp.ClientResponseError):
+                    await inventory_to_records.fetch_json(
+                        self.session,
+                        self.url
+                    )
+        assert budget.requests == 1
+        assert budget.retries == 0
+
+    async def test_hedges_slow_requests(self):
+        hedger = Hedger(enabled=True, max_rate=1, min_samples=1)
+        hedger._latencies.append(0.01)
+        responses = [LongResponse, FastResponse]
+
+        def get(*args, **kwargs):
+            return responses.pop(0)(*args, **kwargs)
+
+        with mock.patch.object(inventory_to_records, '_hedger', hedger):
+            with asynctest.patch.object(self.session, 'get', get):
+                received = await inventory_to_records.fetch_json(
+                    self.session,
+                    self.url
+                )
+        assert received == self.data
+        assert hedger.hedged == 1
+
+    async def test_hedge_latency_excludes_the_wait_for_a_slot(self):
+        hedger = Hedger(enabled=True)
+        limiter = AdaptiveLimiter(1, maximum=1)
+        await limiter.acquire()
+        self.loop.call_later(0.1, limiter.release)
+        with mock.patch.multiple(
+            inventory_to_records, _hedger=hedger, _request_limiter=limiter
+        ):
+            with asynctest.patch.object(self.session, 'get', FastResponse):
+                await inventory_to_records.fetch_json(self.session, self.url)
+        latency, = hedger._latencies
+        assert latency < 0.1
+
     async def test_retries_when_status_is_not_found(self):
         with aioresponses() as m:
             headers = {'Content-Type': 'text/html'}
@@ -189,6 +401,70 @@ class FetchJsonTest(asynctest.TestCase):
                 await inventory_to_records.fetch_json(self.session, self.url)
 
 
+class FetchJsonCacheTest(asynctest.TestCase):
+    url = utils.ARCHIVE_URL + 'pub/firefox/candidates/'
+    data = {'prefixes': ['54.0-candidates/'], 'files': []}
+
+    @pytest.fixture(autouse=True)
+    def init_store(self, tmpdir):
+        self.store = MetadataStore(str(tmpdir.join(STORE_FILENAME)))
+        inventory_to_records._http_cache.attach(self.store)
+        yield
+        inventory_to_records._http_cache.detach()
+        self.store.close()
+
+    async def setUp(self):
+        self.session = aiohttp.ClientSession(loop=self.loop)
+        self.addCleanup(self.session.close)
+
+    async def test_revalidates_with_etag(self):
+        with aioresponses() as m, MetricsMock() as mm:
+            m.get(self.url, payload=self.data, headers={'ETag': '"abc"'})
+            m.get(self.url, status=304)
+            first = await inventory_to_records.fetch_json(
+                self.session,
+                self.url
+            )
+            second = await inventory_to_records.fetch_json(
+                self.session,
+                self.url
+            )
+            calls = m.requests[('GET', self.url)]
+            assert 'If-None-Match' not in calls[0].kwargs['headers']
+            assert calls[0].kwargs['headers']['Cache'] == 'no-cache'
+            assert calls[1].kwargs['headers']['If-None-Match'] == '"abc"'
+            assert 'Cache' not in calls[1].kwargs['headers']
+            assert mm.has_record(INCR, 'buildhub.http_cache_miss', 1)
+            assert mm.has_record(INCR, 'buildhub.http_cache_revalidated', 1)
+            assert mm.has_record(INCR, 'buildhub.http_cache_bytes_saved')
+        assert first == second == self.data
+        # Callers get their own copy.
+        assert first is not second
+
+    async def test_modified_responses_are_updated(self):
+        with aioresponses() as m:
+            m.get(self.url, payload=self.data, headers={'ETag': '"abc"'})
+            m.get(self.url, payload={'prefixes': []}, headers={'ETag': '"d"'})
+            await inventory_to_records.fetch_json(self.session, self.url)
+            received = await inventory_to_records.fetch_json(
+                self.session,
+                self.url
+            )
+        assert received == {'prefixes': []}
+        assert inventory_to_records._http_cache.get(self.url).etag == '"d"'
+
+    async def test_immutable_responses_are_not_cached(self):
+        url = (
+            utils.ARCHIVE_URL + 'pub/firefox/candidates/54.0-candidates/'
+            'build3/win64/en-US/firefox-54.0.json'
+        )
+        with aioresponses() as m, MetricsMock() as mm:
+            m.get(url, payload={'buildid': '20170512'}, headers={'ETag': '"a"'})
+            await inventory_to_records.fetch_json(self.session, url)
+            assert not mm.filter_records(INCR, 'buildhub.http_cache_miss')
+        assert inventory_to_records._http_cache.get(url) is None
+
+
 class FetchListingTest(asynctest.TestCase):
     url = 'http://test.example.com'
 
@@ -228,6 +504,19 @@ class FetchListingTest(asynctest.TestCase):
                     self.url
                 )
 
+    async def test_overload_errors_are_not_wrapped(self):
+        budget = RetryBudget(ratio=0, reserve=0)
+        with mock.patch.object(
+            inventory_to_records, '_retry_budget', budget
+        ):
+            with aioresponses() as m:
+                m.get(self.url, status=503)
+                with self.assertRaises(aiohttp.ClientResponseError):
+                    await inventory_to_records.fetch_listing(
+                        self.session,
+                        self.url
+                    )
+
     async def test_jsonnotfound_exception(self):
         with aioresponses() as m:
             m.get(self.url, status=404)
@@ -317,6 +606,31 @@ class FetchNightlyMetadata(asynctest.TestCase):
             )
         assert received is None
 
+    async def test_remembers_missing_metadata_of_en_us(self):
+        record = {
+            'id': 'a',
+            'download': {'url': 'http://archive.org/firefox.fr.win32.exe'}
+        }
+        with aioresponses() as m:
+            m.get('http://archive.org/firefox.en-US.win32.json', status=404)
+            m.get('http://archive.org/firefox.en-US.win32.txt', status=404)
+            received = await inventory_to_records.fetch_nightly_metadata(
+                self.session,
+                record
+            )
+            assert received is None
+            assert sum(len(calls) for calls in m.requests.values()) == 2
+
+            record['download']['url'] = record['download']['url'].replace(
+                '.fr.', '.it.'
+            )
+            received = await inventory_to_records.fetch_nightly_metadata(
+                self.session,
+                record
+            )
+            assert received is None
+            assert sum(len(calls) for calls in m.requests.values()) == 2
+
     async def test_fetch_nightly_metadata_from_installer_url(self):
         record = {'id': 'a', 'download': {
             'url': 'http://server.org/firefox.fr.win64.installer.exe'}}
@@ -519,11 +833,11 @@ class FetchReleaseMetadata(asynctest.TestCase):
         self.session = aiohttp.ClientSession(loop=self.loop)
         self.addCleanup(self.session.close)
 
-        inventory_to_records._candidates_build_folder['firefox'] = {
+        set_candidates_build_folders('firefox', {
             '54.0': 'build3/',
             '57.0b4': 'build1/',
             '47.0.1': 'build1/',
-        }
+        })
         self.record = {
             'source': {'product': 'firefox'},
             'target': {
@@ -538,23 +852,33 @@ class FetchReleaseMetadata(asynctest.TestCase):
         inventory_to_records._release_metadata.clear()
 
     async def test_fetch_release_metadata_unknown_version(self):
-        result = await inventory_to_records.fetch_release_metadata(
-            self.session,
-            {
-                'source': {'product': 'firefox'},
-                'target': {'version': '1.0', 'platform': 'p'}
-            }
-        )
+        with aioresponses() as m:
+            m.get(
+                utils.ARCHIVE_URL + 'pub/firefox/candidates/1.0-candidates/',
+                status=404
+            )
+            result = await inventory_to_records.fetch_release_metadata(
+                self.session,
+                {
+                    'source': {'product': 'firefox'},
+                    'target': {'version': '1.0', 'platform': 'p'}
+                }
+            )
         assert result is None
 
     async def test_fetch_release_metadata_update_release(self):
-        result = await inventory_to_records.fetch_release_metadata(
-            self.session,
-            {
-                'source': {'product': 'firefox'},
-                'target': {'version': '1.0', 'platform': 'p'}
-            }
-        )
+        with aioresponses() as m:
+            m.get(
+                utils.ARCHIVE_URL + 'pub/firefox/candidates/1.0-candidates/',
+                status=404
+            )
+            result = await inventory_to_records.fetch_release_metadata(
+                self.session,
+                {
+                    'source': {'product': 'firefox'},
+                    'target': {'version': '1.0', 'platform': 'p'}
+                }
+            )
         assert result is None
 
     async def test_fetch_release_metadata_for_partial_update(self):
@@ -574,6 +898,7 @@ class FetchReleaseMetadata(asynctest.TestCase):
                     {'name': 'SHA512SUMS'},
                 ]
             })
+            m.get(build_folder + 'win64/en-US/', status=404)
             received = await inventory_to_records.fetch_release_metadata(
                 self.session,
                 record
@@ -605,7 +930,9 @@ class FetchReleaseMetadata(asynctest.TestCase):
                 headers=headers
             )
 
-            with self.assertRaises(ValueError):
+            with mock.patch.object(
+                inventory_to_records, '_retry_budget', RetryBudget(0, 0)
+            ), self.assertRaises(ValueError):
                 await inventory_to_records.fetch_release_metadata(
                     self.session,
                     self.record
@@ -750,9 +1077,9 @@ class FetchReleaseMetadata(asynctest.TestCase):
 
     async def test_fetch_metadata_from_sha1(self):
         # /pub/firefox/releases/45.3.0esr/win64-sha1/fy-NL/Firefox%20Setup%2045.3.0esr.exe
-        inventory_to_records._candidates_build_folder['firefox'] = {
+        set_candidates_build_folders('firefox', {
             '45.3.0esr': 'build3/'
-        }
+        })
         record = {
             'source': {'product': 'firefox'},
             'target': {
@@ -785,7 +1112,9 @@ class FetchReleaseMetadata(asynctest.TestCase):
             assert received == {'buildid': '20170512', 'buildnumber': 3}
 
 
-class ScanCandidates(asynctest.TestCase):
+class FetchLatestBuildFolder(asynctest.TestCase):
+    candidates_url = utils.ARCHIVE_URL + 'pub/firefox/candidates/'
+
     async def setUp(self):
         self.session = aiohttp.ClientSession(loop=self.loop)
         self.addCleanup(self.session.close)
@@ -793,28 +1122,19 @@ class ScanCandidates(asynctest.TestCase):
     def tearDown(self):
         inventory_to_records._candidates_build_folder.clear()
 
-    async def test_scan_candidates_does_nothing_if_already_done(self):
-        inventory_to_records._candidates_build_folder['firefox'] = {}
-        await inventory_to_records.scan_candidates(self.session, 'firefox')
+    async def fetch(self, version, recent=False):
+        return await inventory_to_records.fetch_latest_build_folder(
+            self.session, 'firefox', version, recent=recent
+        )
+
+    async def test_does_nothing_if_already_known(self):
+        set_candidates_build_folders('firefox', {'54.0': 'build3/'})
+        with aioresponses():
+            assert await self.fetch('54.0') == 'build3/'
 
-    async def test_scan_candidates(self):
+    async def test_fetch_latest_build_folder(self):
         with aioresponses() as m:
-            candidates_listing = utils.ARCHIVE_URL + 'pub/firefox/candidates/'
-            m.get(candidates_listing, payload={
-                'prefixes': [
-                    '54.0-candidates/',
-                    '52.0.2esr-candidates/',
-                    'archived/'
-                ], 'files': []
-            })
-            m.get(candidates_listing + '52.0.2esr-candidates/', payload={
-                'prefixes': [
-                    'build1/',
-                    'build2/',
-                    'build3/',
-                ], 'files': []
-            })
-            m.get(candidates_listing + '54.0-candidates/', payload={
+            m.get(self.candidates_url + '54.0-candidates/', payload={
                 'prefixes': [
                     'build11/',
                     'build9/',
@@ -822,14 +1142,324 @@ class ScanCandidates(asynctest.TestCase):
                     'pop/',
                 ], 'files': []
             })
-            await inventory_to_records.scan_candidates(self.session, 'firefox')
+            assert await self.fetch('54.0') == 'build11/'
+            # Only the versions that are looked up are listed.
+            assert list(m.requests) == [
+                ('GET', self.candidates_url + '54.0-candidates/')
+            ]
 
-            assert inventory_to_records._candidates_build_folder == {
-                'firefox': {
-                    '54.0': 'build11/',
-                    '52.0.2esr': 'build3/',
-                }
-            }
+        assert inventory_to_records._candidates_build_folder[
+            'firefox/54.0'
+        ] == {'build_folder': 'build11/', 'refresh_after': None}
+        # Now known.
+        assert await self.fetch('54.0') == 'build11/'
+
+    async def test_version_not_in_candidates(self):
+        with aioresponses() as m:
+            m.get(self.candidates_url + '1.0-candidates/', status=404)
+            assert await self.fetch('1.0') is None
+            # Not fetched again.
+            assert await self.fetch('1.0') is None
+
+    async def test_listing_errors_are_not_kept(self):
+        listing = self.candidates_url + '1.0-candidates/'
+        with aioresponses() as m:
+            m.get(listing, body='<html></html>')
+            m.get(listing, payload={'prefixes': ['build1/'], 'files': []})
+            assert await self.fetch('1.0') is None
+            assert 'firefox/1.0' not in (
+                inventory_to_records._candidates_build_folder
+            )
+            # Listed next time.
+            assert await self.fetch('1.0') == 'build1/'
+
+    async def test_overload_errors_are_raised(self):
+        budget = RetryBudget(ratio=0, reserve=0)
+        with mock.patch.object(
+            inventory_to_records, '_retry_budget', budget
+        ):
+            with aioresponses() as m:
+                m.get(self.candidates_url + '1.0-candidates/', status=503)
+                with self.assertRaises(aiohttp.ClientResponseError):
+                    await self.fetch('1.0')
+        assert 'firefox/1.0' not in (
+            inventory_to_records._candidates_build_folder
+        )
+
+    async def test_connection_errors_are_raised(self):
+        with aioresponses() as m:
+            m.get(
+                self.candidates_url + '1.0-candidates/',
+                exception=aiohttp.ServerDisconnectedError()
+            )
+            with self.assertRaises(aiohttp.ServerDisconnectedError):
+                await self.fetch('1.0')
+        assert 'firefox/1.0' not in (
+            inventory_to_records._candidates_build_folder
+        )
+
+    async def test_mobile_candidates_are_fennec(self):
+        with aioresponses() as m:
+            m.get(
+                utils.ARCHIVE_URL + 'pub/mobile/candidates/57.0-candidates/',
+                payload={'prefixes': ['build1/'], 'files': []}
+            )
+            received = await inventory_to_records.fetch_latest_build_folder(
+                self.session, 'mobile', '57.0'
+            )
+        assert received == 'build1/'
+
+    async def test_recent_versions_are_refreshed(self):
+        listing = self.candidates_url + '58.0-candidates/'
+        with aioresponses() as m:
+            m.get(listing, payload={'prefixes': ['build1/'], 'files': []})
+            m.get(listing, payload={
+                'prefixes': ['build1/', 'build2/'], 'files': []
+            })
+            assert await self.fetch('58.0', recent=True) == 'build1/'
+            assert await self.fetch('58.0', recent=True) == 'build1/'
+            with mock.patch('buildhub.inventory_to_records.time') as mocked:
+                mocked.time.return_value = time.time() + 3600
+                assert await self.fetch('58.0', recent=True) == 'build2/'
+
+
+@pytest.mark.parametrize('days,expected', [
+    (None, True),
+    (1, True),
+    (6, True),
+    (8, False),
+    (400, False),
+])
+def test_is_recent(days, expected):
+    record = {'download': {}}
+    if days is not None:
+        date = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+        record['download']['date'] = date.strftime(utils.DATETIME_FORMAT)
+    assert inventory_to_records.is_recent(record) is expected
+
+
+class MetadataFetcherTest(asynctest.TestCase):
+    async def setUp(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        # Record #0 is the slowest to be fetched.
+        async def fake_fetch_metadata(session, record):
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(0.05 if record['id'] == 0 else 0.001)
+            self.in_flight -= 1
+            return {'id': record['id']}
+
+        patch = mock.patch(
+            'buildhub.inventory_to_records.fetch_metadata',
+            fake_fetch_metadata
+        )
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    async def _fetch_all(self, fetcher, count=10):
+        fetched = []
+        for i in range(count):
+            fetched.extend(await fetcher.submit({'id': i}))
+        fetched.extend(await fetcher.drain())
+        for record, metadata in fetched:
+            assert record['id'] == metadata['id']
+        return [record['id'] for record, _ in fetched]
+
+    async def test_ordered(self):
+        fetcher = inventory_to_records.MetadataFetcher(
+            None, concurrency=3, ordered=True, max_pending=100
+        )
+        ids = await self._fetch_all(fetcher)
+        assert ids == list(range(10))
+        assert self.max_in_flight == 3
+
+    async def test_unordered(self):
+        fetcher = inventory_to_records.MetadataFetcher(
+            None, concurrency=3, ordered=False
+        )
+        ids = await self._fetch_all(fetcher)
+        assert sorted(ids) == list(range(10))
+        # The slow one doesn't hold the others back.
+        assert ids[-1] == 0
+        assert self.max_in_flight == 3
+
+    async def test_ordered_holds_back_max_pending(self):
+        fetcher = inventory_to_records.MetadataFetcher(
+            None, concurrency=3, ordered=True, max_pending=4
+        )
+        await fetcher.submit({'id': 0})
+        for i in range(1, 4):
+            assert await fetcher.submit({'id': i}) == []
+        # The next one has to wait for the slow one.
+        fetched = await fetcher.submit({'id': 4})
+        assert [record['id'] for record, _ in fetched] == [0, 1, 2, 3]
+        await fetcher.drain()
+
+    async def test_max_pending_follows_concurrency(self):
+        fetcher = inventory_to_records.MetadataFetcher(None, concurrency=3)
+        assert fetcher.max_pending == 12
+        # e.g. its share of the requests changes.
+        fetcher.concurrency = 10
+        assert fetcher.max_pending == 40
+        fetcher = inventory_to_records.MetadataFetcher(
+            None, concurrency=3, max_pending=5
+        )
+        fetcher.concurrency = 10
+        assert fetcher.max_pending == 5
+
+    async def test_metrics_gauges(self):
+        fetcher = inventory_to_records.MetadataFetcher(
+            None, concurrency=3, ordered=True
+        )
+        with MetricsMock() as mm:
+            await self._fetch_all(fetcher, count=4)
+            assert mm.has_record(
+                GAUGE, 'buildhub.inventory_to_records_fetch_in_flight', 3
+            )
+            assert mm.has_record(
+                GAUGE, 'buildhub.inventory_to_records_fetch_queue_depth', 0
+            )
+
+    async def test_deferred_records_are_fetched_again(self):
+        attempts = []
+
+        async def fetch_metadata(session, record):
+            attempts.append(record['id'])
+            if record['id'] % 2 and attempts.count(record['id']) == 1:
+                raise CircuitOpenError()
+            return {'id': record['id']}
+
+        fetcher = inventory_to_records.MetadataFetcher(None, concurrency=3)
+        with mock.patch(
+            'buildhub.inventory_to_records.fetch_metadata', fetch_metadata
+        ):
+            ids = await self._fetch_all(fetcher, count=6)
+        # Deferred records come last.
+        assert ids == [0, 2, 4, 1, 3, 5]
+        assert len(attempts) == 9
+        assert not fetcher.deferred
+
+    async def test_deferred_records_are_given_up(self):
+        async def fetch_metadata(session, record):
+            raise asyncio.TimeoutError()
+
+        fetcher = inventory_to_records.MetadataFetcher(None, concurrency=3)
+        with mock.patch(
+            'buildhub.inventory_to_records.fetch_metadata', fetch_metadata
+        ):
+            await fetcher.submit({'id': 0})
+            assert await fetcher.drain(rounds=2) == [({'id': 0}, None)]
+        assert not fetcher.deferred
+
+
+class MetadataFetcherOverloadTest(asynctest.TestCase):
+    nightly_url = 'http://server.org/firefox.en-US.win32.json'
+
+    async def setUp(self):
+        self.session = aiohttp.ClientSession(loop=self.loop)
+        self.addCleanup(self.session.close)
+        # No retries left.
+        patch = mock.patch.object(
+            inventory_to_records, '_retry_budget', RetryBudget(0, 0)
+        )
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        inventory_to_records._nightly_metadata.clear()
+        inventory_to_records._release_metadata.clear()
+        inventory_to_records._rc_metadata.clear()
+        inventory_to_records._candidates_build_folder.clear()
+
+    async def test_overloaded_nightly_records_are_deferred(self):
+        record = {
+            'id': 'a',
+            'target': {'channel': 'nightly', 'version': '57.0a1'},
+            'download': {'url': 'http://server.org/firefox.fr.win32.exe'},
+        }
+        fetcher = inventory_to_records.MetadataFetcher(self.session)
+        with aioresponses() as m:
+            m.get(self.nightly_url, status=503)
+            await fetcher.submit(record)
+            assert await fetcher.drain(rounds=0) == [(record, None)]
+            # Not recorded as missing.
+            assert 'http://server.org/firefox.en-US.win32.exe' not in (
+                inventory_to_records._nightly_metadata
+            )
+
+            m.get(self.nightly_url, status=503)
+            m.get(self.nightly_url, payload={'buildid': '20170512'})
+            await fetcher.submit(record)
+            assert await fetcher.drain(rounds=1) == [
+                (record, {'buildid': '20170512'})
+            ]
+
+    async def test_overloaded_release_records_are_deferred(self):
+        set_candidates_build_folders('firefox', {'54.0': 'build3/'})
+        record = {
+            'id': 'b',
+            'source': {'product': 'firefox'},
+            'target': {
+                'channel': 'release', 'version': '54.0', 'platform': 'win64'
+            },
+            'download': {'date': '2017-06-01T00:00:00Z'},
+        }
+        url = (
+            utils.ARCHIVE_URL +
+            'pub/firefox/candidates/54.0-candidates/build3/win64/en-US/'
+        )
+        fetcher = inventory_to_records.MetadataFetcher(self.session)
+        with aioresponses() as m:
+            m.get(url, status=502)
+            await fetcher.submit(record)
+            assert await fetcher.drain(rounds=0) == [(record, None)]
+        assert url not in inventory_to_records._release_metadata
+
+    async def test_dropped_connections_defer_records(self):
+        set_candidates_build_folders('firefox', {'54.0': 'build3/'})
+        release = {
+            'id': 'b',
+            'source': {'product': 'firefox'},
+            'target': {
+                'channel': 'release', 'version': '54.0', 'platform': 'win64'
+            },
+            'download': {'date': '2017-06-01T00:00:00Z'},
+        }
+        release_url = (
+            utils.ARCHIVE_URL +
+            'pub/firefox/candidates/54.0-candidates/build3/win64/en-US/'
+        )
+        rc_url = (
+            utils.ARCHIVE_URL +
+            'pub/firefox/candidates/55.0rc1-candidates/build1/win64/en-US/'
+        )
+        rc = {
+            'id': 'c',
+            'source': {'product': 'firefox'},
+            'target': {'channel': 'release', 'version': '55.0rc1'},
+            'download': {'url': rc_url + 'firefox-55.0.zip'},
+        }
+        fetcher = inventory_to_records.MetadataFetcher(self.session)
+        with aioresponses() as m:
+            m.get(
+                release_url,
+                exception=aiohttp.ServerDisconnectedError()
+            )
+            m.get(
+                rc_url + 'firefox-55.0.json',
+                exception=aiohttp.ServerDisconnectedError()
+            )
+            await fetcher.submit(release)
+            await fetcher.submit(rc)
+            assert await fetcher.drain(rounds=0) == [
+                (release, None), (rc, None)
+            ]
+        assert release_url not in inventory_to_records._release_metadata
+        assert rc_url + 'firefox-55.0.zip' not in (
+            inventory_to_records._rc_metadata
+        )
 
 
 class CSVToRecords(asynctest.TestCase):
@@ -1011,6 +1641,66 @@ class CSVToRecords(asynctest.TestCase):
             }
         }]
 
+    async def test_csv_to_records_with_hash(self):
+        output = inventory_to_records.csv_to_records(
+            self.loop,
+            self.stdin,
+            cache_folder=self.cache_folder,
+            with_hash=True,
+        )
+        records = [r async for r in output]
+        assert records[0]['hash'] == utils.hash_record(records[0]['data'])
+
+    async def test_csv_to_records_stores_metadata(self):
+        inventory_to_records._release_metadata.clear()
+        output = inventory_to_records.csv_to_records(
+            self.loop,
+            self.stdin,
+            cache_folder=self.cache_folder,
+        )
+        records = [r async for r in output]
+        assert len(records) == 1
+
+        url = (
+            f'{ARCHIVE_URL}pub/firefox/candidates/51.0-candidates/build2/'
+            'win64/en-US/'
+        )
+        store = MetadataStore(os.path.join(self.cache_folder, STORE_FILENAME))
+        found, metadata = store.get('release', url)
+        candidates = store.get('candidates', 'firefox/51.0')
+        store.close()
+        assert found
+        assert metadata['buildid'] == '20170118123726'
+        assert metadata['buildnumber'] == 2
+        # Released long ago, won't be refreshed.
+        assert candidates == (
+            True, {'build_folder': 'build2/', 'refresh_after': None}
+        )
+        # The store is only used during the run.
+        assert inventory_to_records._release_metadata.store is None
+
+    async def test_csv_to_records_imports_json_cache(self):
+        legacy_cache_file = os.path.join(
+            self.cache_folder,
+            '.metadata-{}.json'.format(inventory_to_records.__version__)
+        )
+        with open(legacy_cache_file, 'w') as f:
+            json.dump({'rc': {}, 'release': {}, 'nightly': {
+                'http://a': {'buildid': '1'}
+            }}, f)
+        output = inventory_to_records.csv_to_records(
+            self.loop,
+            self.stdin,
+            cache_folder=self.cache_folder,
+        )
+        records = [r async for r in output]
+        assert len(records) == 1
+
+        assert not os.path.exists(legacy_cache_file)
+        store = MetadataStore(os.path.join(self.cache_folder, STORE_FILENAME))
+        assert store.get('nightly', 'http://a') == (True, {'buildid': '1'})
+        store.close()
+
     async def test_csv_to_records_ancient_entries_skipped(self):
 
         today = datetime.datetime.utcnow()
@@ -1030,6 +1720,32 @@ class CSVToRecords(asynctest.TestCase):
 
         assert len(records) == 0
 
+    async def _records_modified_since(self, microsecond):
+        # The release entry was modified at 2017-06-11T12:20:10.2Z
+        min_last_modified = datetime.datetime(
+            2017, 6, 11, 12, 20, 10, microsecond,
+            tzinfo=datetime.timezone.utc
+        )
+        output = inventory_to_records.csv_to_records(
+            self.loop,
+            self.stdin,
+            skip_incomplete=False,
+            min_last_modified=min_last_modified,
+            cache_folder=self.cache_folder,
+        )
+        records = []
+        async for r in output:
+            records.append(r)
+        return records
+
+    async def test_csv_to_records_same_second_kept_if_later(self):
+        records = await self._records_modified_since(100000)
+        assert len(records) == 2
+
+    async def test_csv_to_records_same_second_skipped_if_earlier(self):
+        records = await self._records_modified_since(300000)
+        assert len(records) == 1
+
     async def test_csv_to_records_keep_incomplete(self):
         output = inventory_to_records.csv_to_records(
             self.loop,
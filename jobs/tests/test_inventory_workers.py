@@ -0,0 +1,139 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+import datetime
+import gzip
+import multiprocessing
+import os
+import tempfile
+
+import asynctest
+import pytest
+from markus.testing import MetricsMock
+
+from buildhub.inventory_workers import (
+    parse_inventory_file, parse_inventory_files
+)
+
+
+CSV_INPUT = (
+    'net-mozaws-delivery-firefox,pub/firefox/releases/51.0/win64/'
+    'fy-NL/Firefox Setup 51.0.exe,67842,2017-06-11T12:20:10.2Z,'
+    'f1aa742ef0973db098947bd6d875f193\n'
+    '\n'
+    'net-mozaws-delivery-firefox,pub/firefox/nightly/2017/06/'
+    '2017-06-16-03-02-07-mozilla-central-l10n/firefox-56.0a1'
+    '.ach.win32.installer.exe,45678,2017-06-16T03:02:07.0Z,'
+    'f1aa742ef0973db098947bd6d875f193\n'
+    'net-mozaws-delivery-firefox,pub/firefox/nightly/2017/06/'
+    '2017-06-16-03-02-07-mozilla-central-l10n/firefox-56.0a1'
+    '.ach.win32.zip,45678,2017-06-16T03:02:07.0Z,'
+    'f1aa742ef0973db098947bd6d875f193\n'
+    'net-mozaws-delivery-firefox,pub/firefox/releases/51.0/'
+    'SHA512SUMS,45678,2017-06-16T03:02:07.0Z,'
+    'f1aa742ef0973db098947bd6d875f193\n'
+)
+
+
+def write_inventory(folder, name, content=CSV_INPUT):
+    file_path = os.path.join(folder, name)
+    with gzip.open(file_path, 'wt') as f:
+        f.write(content)
+    return file_path
+
+
+@pytest.fixture
+def inventory_file(tmpdir):
+    return write_inventory(str(tmpdir), 'a.csv.gz')
+
+
+def test_parse_inventory_file(inventory_file):
+    records = list(parse_inventory_file(inventory_file))
+    assert [r['id'] for r in records] == [
+        'firefox_51-0_win64_fy-nl',
+        'firefox_nightly_2017-06-16-03-02-07_56-0a1_win32_ach',
+    ]
+    assert records[0]['download']['size'] == 67842
+    assert records[0]['download']['date'] == '2017-06-11T12:20:10Z'
+
+
+def test_parse_inventory_file_skips_old_entries(inventory_file):
+    min_last_modified = datetime.datetime(
+        2017, 6, 12, tzinfo=datetime.timezone.utc
+    )
+    records = list(parse_inventory_file(inventory_file, min_last_modified))
+    assert len(records) == 1
+
+
+class ParseInventoryFilesTest(asynctest.TestCase):
+    async def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    async def paths(self, *names):
+        for name in names:
+            yield write_inventory(self.tmpdir.name, name)
+
+    async def test_records_of_all_files(self):
+        records = [
+            record async for record in parse_inventory_files(
+                self.loop,
+                self.paths('a.csv.gz', 'b.csv.gz', 'c.csv.gz'),
+                workers=2,
+                batch_size=2,
+            )
+        ]
+        assert len(records) == 6
+        assert sorted(r['id'] for r in records)[0] == (
+            'firefox_51-0_win64_fy-nl'
+        )
+
+    async def test_parse_times_are_reported(self):
+        with MetricsMock() as metrics_mock:
+            [
+                record async for record in parse_inventory_files(
+                    self.loop, self.paths('a.csv.gz', 'b.csv.gz'), workers=2
+                )
+            ]
+        records = metrics_mock.filter_records(
+            'timing', stat='buildhub.s3_inventory_to_kinto_parse'
+        )
+        assert len(records) == 2
+
+    async def test_no_files(self):
+        records = [
+            record async for record in parse_inventory_files(
+                self.loop, self.paths(), workers=2
+            )
+        ]
+        assert records == []
+
+    async def test_parse_errors_are_raised(self):
+        file_path = os.path.join(self.tmpdir.name, 'broken.csv.gz')
+        with open(file_path, 'wb') as f:
+            f.write(b'not gzip')
+
+        async def paths():
+            yield file_path
+
+        with pytest.raises(RuntimeError) as exc_info:
+            [r async for r in parse_inventory_files(self.loop, paths(), 1)]
+        assert 'broken.csv.gz' in str(exc_info.value)
+
+    async def test_dead_workers_are_reported(self):
+        never = asyncio.Event()
+
+        async def paths():
+            yield write_inventory(self.tmpdir.name, 'a.csv.gz')
+            # More files may come.
+            await never.wait()
+
+        records = parse_inventory_files(self.loop, paths(), workers=1)
+        await records.__anext__()
+        for process in multiprocessing.active_children():
+            process.terminate()
+        with pytest.raises(RuntimeError) as exc_info:
+            [r async for r in records]
+        assert 'died' in str(exc_info.value)
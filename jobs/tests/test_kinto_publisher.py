@@ -0,0 +1,238 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+import json
+import time
+
+import aiohttp
+import asynctest
+import kinto_http
+import pytest
+from aioresponses import aioresponses
+from kinto_http.exceptions import KintoException
+from markus import GAUGE, INCR
+from markus.testing import MetricsMock
+
+from buildhub.kinto_publisher import BatchPublisher
+
+
+BATCH_URL = 'http://kinto/v1/batch'
+
+
+def ok(*bodies):
+    return {
+        'responses': [{'status': 200, 'body': body} for body in bodies]
+    }
+
+
+class BatchPublisherTest(asynctest.TestCase):
+    async def setUp(self):
+        self.client = kinto_http.Client(
+            server_url='http://kinto/v1',
+            auth=('user', 'pass'),
+            bucket='build-hub',
+            collection='releases',
+            retry=1,
+        )
+        self.session = aiohttp.ClientSession(loop=self.loop)
+        self.addCleanup(self.session.close)
+        self.publisher = BatchPublisher(self.client, self.session, 100)
+        self.mocked = aioresponses()
+        self.mocked.start()
+        self.addCleanup(self.mocked.stop)
+
+    def sent(self):
+        calls = self.mocked.requests[('POST', BATCH_URL)]
+        return [call.kwargs for call in calls]
+
+    async def publish(self, *records):
+        return await self.publisher.publish([
+            self.publisher.encode(record) for record in records
+        ])
+
+    async def test_records_are_sent_in_one_batch(self):
+        self.mocked.post(BATCH_URL, payload=ok({'data': 'a'}, {'data': 'b'}))
+        results = await self.publish(
+            {'data': {'id': 'a'}},
+            {'data': {'id': 'b', 'last_modified': 42}},
+        )
+        assert results == [{'data': 'a'}, {'data': 'b'}]
+        sent, = self.sent()
+        assert sent['headers']['Authorization'].startswith('Basic ')
+        assert len(sent['data']) == self.publisher.payload_size([
+            self.publisher.encode({'data': {'id': 'a'}}),
+            self.publisher.encode({'data': {'id': 'b', 'last_modified': 42}}),
+        ])
+        assert json.loads(sent['data']) == {'requests': [
+            {
+                'method': 'PUT',
+                'path': '/buckets/build-hub/collections/releases/records/a',
+                'body': {'data': {'id': 'a'}},
+            },
+            {
+                'method': 'PUT',
+                'path': '/buckets/build-hub/collections/releases/records/b',
+                'body': {'data': {'id': 'b', 'last_modified': 42}},
+                'headers': {'If-Match': '"42"'},
+            },
+        ]}
+
+    async def test_records_without_id_are_created(self):
+        self.mocked.post(BATCH_URL, payload=ok({'data': 'a'}))
+        await self.publish(
+            {'data': {'title': 'a'}, 'permissions': {'read': ['system']}},
+        )
+        request, = json.loads(self.sent()[0]['data'])['requests']
+        assert request['headers'] == {'If-None-Match': '*'}
+        assert request['body']['permissions'] == {'read': ['system']}
+
+    async def test_client_errors_are_reported(self):
+        self.mocked.post(BATCH_URL, payload={'responses': [
+            {'status': 200, 'body': {'data': 'a'}},
+            {'status': 400, 'body': {'code': 400, 'message': 'Bad'}},
+        ]})
+        with pytest.raises(ValueError) as exc_info:
+            await self.publish({'data': {'id': 'a'}}, {'data': {'id': 'b'}})
+        assert 'Invalid record' in str(exc_info.value)
+
+    async def test_server_errors_raise(self):
+        self.mocked.post(BATCH_URL, payload={'responses': [
+            {'status': 503, 'body': {'code': 503}},
+        ]})
+        with pytest.raises(KintoException) as exc_info:
+            await self.publish({'data': {'id': 'a'}})
+        assert exc_info.value.request['path'].endswith('/records/a')
+
+    async def test_failed_batch_requests_are_retried(self):
+        self.mocked.post(
+            BATCH_URL, status=503, headers={'Retry-After': '0'}
+        )
+        self.mocked.post(BATCH_URL, payload=ok({'data': 'a'}))
+        results = await self.publish({'data': {'id': 'a'}})
+        assert results == [{'data': 'a'}]
+
+        self.mocked.post(BATCH_URL, status=503)
+        self.mocked.post(BATCH_URL, status=503)
+        with pytest.raises(KintoException):
+            await self.publish({'data': {'id': 'a'}})
+        assert self.publisher.limiter.in_flight == 0
+
+    async def test_batches_in_flight_are_limited(self):
+        publisher = BatchPublisher(
+            self.client, self.session, 100, parallel=2, max_parallel=2
+        )
+        release = asyncio.Event()
+        sent = []
+
+        async def publish(subrequests, epoch, saturated):
+            sent.append(subrequests)
+            await release.wait()
+            publisher.limiter.release()
+
+        publisher._publish = publish
+        await publisher.submit(['a'])
+        await publisher.submit(['b'])
+        third = asyncio.ensure_future(publisher.submit(['c']))
+        await asyncio.sleep(0.01)
+        assert not third.done()
+        release.set()
+        await third
+        await asyncio.sleep(0)
+        assert sent == [['a'], ['b'], ['c']]
+
+    async def test_conflicting_records_are_sent_again(self):
+        self.mocked.post(BATCH_URL, payload={'responses': [
+            {'status': 200, 'body': {'data': 'a'}},
+            {'status': 409, 'body': {'code': 409, 'message': 'Retry'}},
+        ]})
+        self.mocked.post(BATCH_URL, payload=ok({'data': 'b'}))
+        results = await self.publish(
+            {'data': {'id': 'a'}}, {'data': {'id': 'b'}}
+        )
+        assert results == [{'data': 'a'}, {'data': 'b'}]
+        first, second = self.sent()
+        request, = json.loads(second['data'])['requests']
+        assert request['path'].endswith('/records/b')
+
+    async def test_batch_size_follows_target_latency(self):
+        publisher = BatchPublisher(
+            self.client, self.session, 100, target_seconds=1
+        )
+        assert publisher.batch_size == 100
+        with MetricsMock() as mm:
+            # 10 records per second: halved at most at once.
+            publisher._succeeded(100, 10, saturated=False)
+            assert publisher.batch_size == 50
+            assert mm.has_record(
+                GAUGE, 'buildhub.to_kinto_publish_batch_size', 50
+            )
+        publisher._succeeded(50, 5, saturated=False)
+        publisher._succeeded(25, 2.5, saturated=False)
+        assert publisher.batch_size == 12
+        publisher._succeeded(12, 1.2, saturated=False)
+        assert publisher.batch_size == 10
+        # Faster: doubled at most at once, and never above the maximum.
+        publisher._succeeded(10, 0.1, saturated=False)
+        assert publisher.batch_size == 20
+        for _ in range(5):
+            publisher._succeeded(10, 0.01, saturated=False)
+        assert publisher.batch_size == 100
+
+    async def test_overload_cuts_batch_size_and_parallelism(self):
+        publisher = BatchPublisher(
+            self.client, self.session, 100, parallel=4, target_seconds=60
+        )
+        self.mocked.post(BATCH_URL, status=429)
+        self.mocked.post(BATCH_URL, payload=ok({'data': 'a'}))
+        with MetricsMock() as mm:
+            await publisher.publish([
+                publisher.encode({'data': {'id': 'a'}})
+            ])
+            assert mm.filter_records(
+                INCR, 'buildhub.to_kinto_publish_parallel_overload',
+                tags=['reason:429']
+            )
+        assert publisher.limiter.limit == 2
+        # Cut, then allowed to grow again from a fast answer.
+        assert publisher.batch_size == 100
+
+        publisher = BatchPublisher(self.client, self.session, 100)
+        publisher._overloaded(0, 'timeout')
+        publisher._overloaded(0, 'timeout')
+        # Once for all the batches sent before the first cut.
+        assert publisher.batch_size == 50
+
+    async def test_backoff_header_pauses_publishing(self):
+        self.mocked.post(
+            BATCH_URL, payload=ok({'data': 'a'}), headers={'Backoff': '30'}
+        )
+        with MetricsMock() as mm:
+            await self.publish({'data': {'id': 'a'}})
+            assert mm.filter_records(
+                INCR, 'buildhub.to_kinto_publish_pause',
+                tags=['reason:backoff']
+            )
+            assert mm.has_record(
+                GAUGE, 'buildhub.to_kinto_publish_pause_seconds', 30
+            )
+        assert self.publisher._paused_until > time.monotonic() + 29
+
+    async def test_publishing_waits_for_the_pause(self):
+        self.mocked.post(BATCH_URL, payload=ok({'data': 'a'}))
+        self.publisher.pause(0.1, 'backoff')
+        # A shorter pause doesn't shorten it.
+        self.publisher.pause(0.01, 'retry-after')
+        started = time.monotonic()
+        await self.publish({'data': {'id': 'a'}})
+        assert time.monotonic() - started >= 0.1
+
+    async def test_retry_after_pauses_publishing(self):
+        self.client.session.retry_after = None
+        publisher = BatchPublisher(self.client, self.session, 100)
+        publisher.pause = pause = asynctest.Mock()
+        self.mocked.post(BATCH_URL, status=503, headers={'Retry-After': '2'})
+        self.mocked.post(BATCH_URL, payload=ok({'data': 'a'}))
+        await publisher.publish([publisher.encode({'data': {'id': 'a'}})])
+        pause.assert_called_once_with(2, 'retry-after')
@@ -0,0 +1,231 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import os
+from unittest import mock
+
+import pytest
+from markus import INCR
+from markus.testing import MetricsMock
+
+from buildhub import metadata_store
+from buildhub.metadata_store import (
+    MetadataCache, MetadataStore, import_json_cache, STORE_FILENAME
+)
+
+
+@pytest.fixture
+def store_path(tmpdir):
+    return str(tmpdir.join(STORE_FILENAME))
+
+
+@pytest.fixture
+def store(store_path):
+    store = MetadataStore(store_path)
+    yield store
+    store.close()
+
+
+def test_get_missing(store):
+    assert store.get('nightly', 'http://a') == (False, None)
+
+
+def test_put_and_get(store):
+    store.put('nightly', 'http://a', {'buildid': '1'})
+    store.put('nightly', 'http://b', None)
+    assert store.get('nightly', 'http://a') == (True, {'buildid': '1'})
+    assert store.get('nightly', 'http://b') == (True, None)
+    assert store.get('release', 'http://a') == (False, None)
+
+
+def test_writes_are_kept_without_close(store_path):
+    store = MetadataStore(store_path)
+    store.put('rc', 'http://a', {'buildid': '1'})
+    # Like when the run crashes.
+    other = MetadataStore(store_path)
+    assert other.get('rc', 'http://a') == (True, {'buildid': '1'})
+    other.close()
+    store.close()
+
+
+def test_other_schema_versions_are_ignored(store):
+    store.put('nightly', 'http://a', {'buildid': '1'})
+    versions = dict(metadata_store.SCHEMA_VERSIONS, nightly=2)
+    with mock.patch.object(metadata_store, 'SCHEMA_VERSIONS', versions):
+        assert store.get('nightly', 'http://a') == (False, None)
+        assert store.stats()['obsolete'] == 1
+        store.compact()
+        assert store.stats()['obsolete'] == 0
+    assert store.get('nightly', 'http://a') == (False, None)
+
+
+def test_stats(store):
+    store.put_many('nightly', [('http://a', {}), ('http://b', {})])
+    store.put('release', 'http://c', None)
+    stats = store.stats()
+    assert stats['entries'] == {'nightly': 2, 'release': 1}
+    assert stats['obsolete'] == 0
+    assert stats['size'] > 0
+
+
+def test_compact_reclaims_space(store):
+    store.put_many('nightly', [
+        ('http://{}'.format(i), {'buildid': 'x' * 100}) for i in range(1000)
+    ])
+    store.compact()
+    size = store.stats()['size']
+    for i in range(1000):
+        store.delete('nightly', 'http://{}'.format(i))
+    store.compact()
+    assert store.stats()['size'] < size
+
+
+def test_cache_without_store():
+    cache = MetadataCache('nightly')
+    assert 'http://a' not in cache
+    cache['http://a'] = {}
+    assert 'http://a' in cache
+    assert cache['http://a'] == {}
+
+
+def test_cache_reads_store_lazily(store):
+    store.put('nightly', 'http://a', {'buildid': '1'})
+    cache = MetadataCache('nightly')
+    cache.attach(store)
+    assert len(cache) == 0
+    assert cache['http://a'] == {'buildid': '1'}
+    assert 'http://b' not in cache
+    assert len(cache) == 1
+
+
+def test_cache_writes_through(store):
+    cache = MetadataCache('release')
+    cache.attach(store)
+    cache['http://a'] = {'buildid': '1'}
+    assert store.get('release', 'http://a') == (True, {'buildid': '1'})
+    cache.clear()
+    assert store.get('release', 'http://a') == (True, {'buildid': '1'})
+    del cache['http://a']
+    assert store.get('release', 'http://a') == (False, None)
+
+
+def test_import_json_cache(store, tmpdir):
+    filename = str(tmpdir.join('.metadata-1.4.1.json'))
+    with open(filename, 'w') as f:
+        json.dump({
+            'rc': {'http://a': {'buildid': '1'}},
+            'release': {'http://b': None},
+            'nightly': {},
+        }, f)
+    import_json_cache(store, filename)
+    assert not os.path.exists(filename)
+    assert store.get('rc', 'http://a') == (True, {'buildid': '1'})
+    # Missing metadata is fetched again.
+    assert store.get('release', 'http://b') == (False, None)
+    assert store.get_miss('release', 'http://b') is None
+
+
+def test_main_stats(store, tmpdir, capsys):
+    store.put('nightly', 'http://a', {})
+    metadata_store.main(['stats', '--cache-folder', str(tmpdir)])
+    out, _ = capsys.readouterr()
+    assert 'nightly: 1 entries' in out
+    assert 'obsolete: 0 entries' in out
+    assert 'missing: 0 entries' in out
+    assert 'HTTP responses: 0' in out
+
+
+def test_main_compact(store, tmpdir, capsys):
+    metadata_store.main(['compact', '--cache-folder', str(tmpdir)])
+    out, _ = capsys.readouterr()
+    assert out.startswith('Compacted ')
+
+
+def test_main_missing_store(tmpdir):
+    with pytest.raises(SystemExit):
+        metadata_store.main(['stats', '--cache-folder', str(tmpdir)])
+
+
+@pytest.fixture
+def now():
+    with mock.patch.object(metadata_store, 'time') as mocked:
+        mocked.time.return_value = 1000000
+        yield mocked.time
+
+
+@pytest.mark.parametrize('failures,expected_hours', [
+    (1, 6),
+    (2, 12),
+    (3, 24),
+    (8, 720),
+    (100, 720),
+])
+def test_missing_metadata_ttl(failures, expected_hours):
+    assert metadata_store.missing_metadata_ttl(failures) == (
+        expected_hours * 3600
+    )
+
+
+def test_missing_metadata_expires(now):
+    cache = MetadataCache('nightly')
+    cache['http://a'] = None
+    assert cache.lookup('http://a') == (True, None)
+    now.return_value += 6 * 3600 - 1
+    assert cache.lookup('http://a') == (True, None)
+    now.return_value += 1
+    assert cache.lookup('http://a') == (False, None)
+    assert 'http://a' not in cache
+
+
+def test_missing_metadata_backs_off(now):
+    cache = MetadataCache('nightly')
+    cache['http://a'] = None
+    now.return_value += 6 * 3600
+    cache['http://a'] = None
+    now.return_value += 6 * 3600
+    assert cache.lookup('http://a') == (True, None)
+    now.return_value += 6 * 3600
+    assert cache.lookup('http://a') == (False, None)
+
+
+def test_found_metadata_forgets_misses(store, now):
+    cache = MetadataCache('nightly')
+    cache.attach(store)
+    cache['http://a'] = None
+    assert store.get_miss('nightly', 'http://a') == (1, 1000000 + 6 * 3600)
+    now.return_value += 6 * 3600
+    cache['http://a'] = {'buildid': '1'}
+    assert store.get_miss('nightly', 'http://a') is None
+    assert cache.lookup('http://a') == (True, {'buildid': '1'})
+
+
+def test_misses_are_read_from_store(store, now):
+    store.put_miss('rc', 'http://a', 3, 1000000 + 1)
+    cache = MetadataCache('rc')
+    cache.attach(store)
+    assert cache.lookup('http://a') == (True, None)
+    now.return_value += 1
+    assert cache.lookup('http://a') == (False, None)
+    cache['http://a'] = None
+    assert store.get_miss('rc', 'http://a') == (4, 1000001 + 48 * 3600)
+    assert store.stats()['missing'] == 1
+
+
+def test_lookup_metrics():
+    cache = MetadataCache('release')
+    cache['http://a'] = {}
+    cache['http://b'] = None
+    with MetricsMock() as mm:
+        cache.lookup('http://a')
+        cache.lookup('http://b')
+        cache.lookup('http://c')
+        cache.lookup('http://c')
+        for status, count in (('hit', 1), ('negative_hit', 1), ('miss', 2)):
+            records = mm.filter_records(
+                INCR,
+                'buildhub.metadata_cache_{}'.format(status),
+                tags=['namespace:release']
+            )
+            assert len(records) == count
@@ -0,0 +1,156 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+
+import pytest
+
+from buildhub.records_index import (
+    ENTRIES_OFFSET, ENTRY, RecordsIndex, id_digest
+)
+
+
+def record_hash(n):
+    return '%032x' % n
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('records.bin'))
+
+
+def test_add_and_get(path):
+    index = RecordsIndex(path)
+    assert len(index) == 0
+    assert index.get('a') is None
+    assert index.get(None) is None
+    index.add('a', 1, record_hash(1))
+    index.add('b', 2, record_hash(2))
+    assert len(index) == 2
+    assert index.get('a') == (1, record_hash(1))
+    assert index['b'] == (2, record_hash(2))
+    assert 'b' in index
+    assert 'c' not in index
+    with pytest.raises(KeyError):
+        index['c']
+    assert index.high_water == 2
+
+
+def test_journal_is_kept_until_merged(path):
+    index = RecordsIndex(path)
+    index.add('a', 1, record_hash(1))
+    index.flush()
+    assert not os.path.exists(path)
+
+    index = RecordsIndex(path)
+    assert index.get('a') == (1, record_hash(1))
+    assert index.high_water == 1
+
+
+def test_merge(path):
+    index = RecordsIndex(path)
+    for n in range(100):
+        index.add(str(n), n, record_hash(n))
+    index.merge()
+    assert os.path.getsize(path) == ENTRIES_OFFSET + 100 * ENTRY.size
+    assert os.path.getsize(index.journal_path) == 0
+
+    # Replace some of them.
+    index.add('10', 200, record_hash(200))
+    index.add('new', 150, record_hash(150))
+    assert len(index) == 101
+    index.merge()
+    index.close()
+
+    index = RecordsIndex(path)
+    assert len(index) == 101
+    assert index.high_water == 200
+    for n in range(100):
+        if n != 10:
+            assert index.get(str(n)) == (n, record_hash(n))
+    assert index.get('10') == (200, record_hash(200))
+    assert index.get('new') == (150, record_hash(150))
+    with open(path, 'rb') as f:
+        f.seek(ENTRIES_OFFSET)
+        keys = [digest for digest, _, _ in ENTRY.iter_unpack(f.read())]
+    assert keys == sorted(keys)
+
+
+def test_journal_is_merged_once_it_grows(path):
+    index = RecordsIndex(path, journal_merge_min=10)
+    for n in range(9):
+        index.add(str(n), n, record_hash(n))
+    index.flush()
+    assert not os.path.exists(path)
+    index.add('9', 9, record_hash(9))
+    assert os.path.getsize(path) == ENTRIES_OFFSET + 10 * ENTRY.size
+    # Not until the journal has as many entries as the index.
+    for n in range(10, 19):
+        index.add(str(n), n, record_hash(n))
+    assert os.path.getsize(path) == ENTRIES_OFFSET + 10 * ENTRY.size
+    index.add('19', 19, record_hash(19))
+    assert os.path.getsize(path) == ENTRIES_OFFSET + 20 * ENTRY.size
+
+
+def test_truncated_journal_entry_is_ignored(path):
+    index = RecordsIndex(path)
+    index.add('a', 1, record_hash(1))
+    index.add('b', 2, record_hash(2))
+    index.close()
+    with open(index.journal_path, 'r+b') as f:
+        f.truncate(ENTRY.size + 5)
+
+    index = RecordsIndex(path)
+    assert len(index) == 1
+    assert index.get('a') == (1, record_hash(1))
+    assert index.get('b') is None
+
+
+def test_invalid_index_is_ignored(path):
+    with open(path, 'wb') as f:
+        f.write(b'{"a": [1, "abc"]}')
+    index = RecordsIndex(path)
+    assert len(index) == 0
+    index.add('a', 1, record_hash(1))
+    index.merge()
+    assert RecordsIndex(path).get('a') == (1, record_hash(1))
+
+
+def test_import_dict(path):
+    index = RecordsIndex(path)
+    index.import_dict({
+        'a': [3, record_hash(3)],
+        'b': [5, record_hash(5)],
+    })
+    assert os.path.getsize(path) == ENTRIES_OFFSET + 2 * ENTRY.size
+    assert index.high_water == 5
+    assert index.get('b') == (5, record_hash(5))
+
+
+def test_entries_with_the_same_prefix(path):
+    # Ids whose digest starts with the same 2 bytes as 'a'.
+    prefix = id_digest('a')[:2]
+    ids = ['a']
+    n = 0
+    while len(ids) < 5:
+        n += 1
+        if id_digest(str(n))[:2] == prefix:
+            ids.append(str(n))
+    index = RecordsIndex(path)
+    # Some of them are not in the index.
+    for i, record_id in enumerate(ids[::2]):
+        index.add(record_id, i, record_hash(i))
+    index.merge()
+    for i, record_id in enumerate(ids[::2]):
+        assert index.get(record_id) == (i, record_hash(i))
+    for record_id in ids[1::2]:
+        assert index.get(record_id) is None
+
+
+def test_context_manager_closes_the_files(path):
+    with RecordsIndex(path) as index:
+        index.add('a', 1, record_hash(1))
+        index.merge()
+    assert index._journal_file.closed
+    assert index._data is None
@@ -2,12 +2,25 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
+import asyncio
 import base64
+import gzip
+import hashlib
 import json
+import os
+import tempfile
 
 import asynctest
+import pytest
+from aiohttp.client_exceptions import ClientPayloadError
+from markus.testing import MetricsMock
 
-from buildhub.s3_inventory_to_kinto import list_manifest_entries, download_csv
+from buildhub.download_cache import ChecksumError
+from buildhub.concurrency import Shares
+from buildhub.s3_inventory_to_kinto import (
+    list_manifest_entries, download_csv, download_files, inventory_to_records
+)
+from buildhub.utils import merge_streams
 
 
 class ListManifest(asynctest.TestCase):
@@ -97,7 +110,7 @@ class DownloadCSV(asynctest.TestCase):
             yield {
                 'key': 'key-1',
                 'size': 123456,
-                'MD5checksum': 'deadbeef0123',
+                'MD5checksum': '0d072b798c263bc5f9fa6800a2e2a40f',
             }
 
         files = files_iterator()
@@ -105,3 +118,298 @@ class DownloadCSV(asynctest.TestCase):
         async for r in download_csv(self.loop, self.client, files):
             results.append(r)
         assert results == [b"1;2;3;4\n5;6"]
+
+
+class DownloadFiles(asynctest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.requested = []
+
+        class FakeStream:
+            def __init__(self, key):
+                self.key = key
+
+            async def __aenter__(self):
+                self.content = [self.key.encode(), None]
+                return self
+
+            async def __aexit__(self, *args):
+                return self
+
+            async def read(self, size):
+                await asyncio.sleep(0)
+                return self.content.pop(0)
+
+        requested = self.requested
+
+        class FakeClient:
+            async def get_object(self, Bucket, Key):
+                requested.append(Key)
+                return {'Body': FakeStream(Key)}
+
+        self.client = FakeClient()
+
+    async def files(self, count, size=10):
+        for i in range(count):
+            yield {
+                'key': 'key-{}'.format(i),
+                'size': size,
+                'MD5checksum': self.checksum(i),
+            }
+
+    @staticmethod
+    def checksum(i):
+        return hashlib.md5('public/key-{}'.format(i).encode()).hexdigest()
+
+    def file_path(self, i):
+        return os.path.join(self.tmpdir.name, self.checksum(i) + '.csv.gz')
+
+    def download_files(self, files, **kwargs):
+        return download_files(
+            self.loop,
+            self.client,
+            files,
+            download_directory=self.tmpdir.name,
+            **kwargs
+        )
+
+    async def test_next_files_are_downloaded_while_reading(self):
+        paths = self.download_files(self.files(5), prefetch=2)
+        first = await paths.__anext__()
+        assert first == self.file_path(0)
+        assert self.requested == [
+            'public/key-0', 'public/key-1', 'public/key-2'
+        ]
+        rest = [path async for path in paths]
+        assert rest == [self.file_path(i) for i in range(1, 5)]
+        assert len(self.requested) == 5
+
+    async def test_prefetch_is_bounded_by_size(self):
+        paths = self.download_files(
+            self.files(3, size=100), prefetch=2, max_bytes=150
+        )
+        await paths.__anext__()
+        assert self.requested == ['public/key-0']
+        await paths.__anext__()
+        assert self.requested == ['public/key-0', 'public/key-1']
+        await paths.aclose()
+
+    async def test_no_prefetch(self):
+        paths = self.download_files(self.files(3), prefetch=0)
+        await paths.__anext__()
+        assert self.requested == ['public/key-0']
+        await paths.aclose()
+
+    async def test_downloaded_files_are_reused(self):
+        file_path = self.file_path(0)
+        with open(file_path, 'wb') as f:
+            f.write(b'public/key-0')
+        paths = [path async for path in self.download_files(self.files(2))]
+        assert paths[0] == file_path
+        assert self.requested == ['public/key-1']
+
+    async def test_wait_times_are_reported(self):
+        with MetricsMock() as metrics_mock:
+            [path async for path in self.download_files(self.files(2))]
+        records = metrics_mock.filter_records(
+            'timing', stat='buildhub.s3_inventory_to_kinto_download_wait'
+        )
+        assert len(records) == 2
+        # Parsed by the workers, which report it.
+        assert not metrics_mock.filter_records(
+            'timing', stat='buildhub.s3_inventory_to_kinto_parse'
+        )
+
+
+class StreamCSV(asynctest.TestCase):
+    @staticmethod
+    def csv(i):
+        return b''.join(b'%d line %d\n' % (i, j) for j in range(10000))
+
+    def content(self, i):
+        return self.contents[i]
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.requested = []
+        self.failing = False
+
+        self.contents = [gzip.compress(self.csv(i)) for i in range(3)]
+        test = self
+
+        class FakeStream:
+            def __init__(self, content):
+                self.size = len(content)
+                self.content = content
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *args):
+                pass
+
+            async def read(self, size):
+                await asyncio.sleep(0)
+                if test.failing and len(self.content) < self.size:
+                    raise ClientPayloadError('Connection reset')
+                chunk, self.content = self.content[:size], self.content[size:]
+                return chunk
+
+        class FakeClient:
+            async def get_object(self, Bucket, Key):
+                test.requested.append(Key)
+                i = int(Key.rsplit('-', 1)[1])
+                return {'Body': FakeStream(test.content(i))}
+
+        self.client = FakeClient()
+
+    async def files(self, count):
+        for i in range(count):
+            yield {
+                'key': 'key-{}'.format(i),
+                'size': 10,
+                'MD5checksum': self.checksum(i),
+            }
+
+    def download_csv(self, files, **kwargs):
+        return download_csv(
+            self.loop,
+            self.client,
+            files,
+            chunk_size=1024,
+            download_directory=self.tmpdir.name,
+            **kwargs
+        )
+
+    def checksum(self, i):
+        return hashlib.md5(self.content(i)).hexdigest()
+
+    def file_path(self, i):
+        return os.path.join(self.tmpdir.name, self.checksum(i) + '.csv.gz')
+
+    async def test_chunks_are_decompressed_and_written(self):
+        chunks = [
+            chunk async for chunk in self.download_csv(
+                self.files(3), prefetch=0
+            )
+        ]
+        assert len(chunks) > 3
+        assert b''.join(chunks) == b''.join(self.csv(i) for i in range(3))
+        for i in range(3):
+            with gzip.open(self.file_path(i)) as f:
+                assert f.read() == self.csv(i)
+
+    async def test_prefetched_files_are_read_from_disk(self):
+        chunks = [
+            chunk async for chunk in self.download_csv(
+                self.files(3), prefetch=2
+            )
+        ]
+        assert b''.join(chunks) == b''.join(self.csv(i) for i in range(3))
+        assert len(self.requested) == 3
+
+    async def test_downloaded_files_are_reused(self):
+        [chunk async for chunk in self.download_csv(self.files(2))]
+        chunks = [chunk async for chunk in self.download_csv(self.files(2))]
+        assert b''.join(chunks) == self.csv(0) + self.csv(1)
+        assert len(self.requested) == 2
+
+    async def test_download_does_not_wait_for_consumer(self):
+        chunks = self.download_csv(self.files(1), prefetch=0)
+        await chunks.__anext__()
+        await asyncio.sleep(0.1)
+        with gzip.open(self.file_path(0)) as f:
+            assert f.read() == self.csv(0)
+        await chunks.aclose()
+
+    async def test_partial_file_is_removed_when_not_consumed(self):
+        chunks = self.download_csv(self.files(1), prefetch=0)
+        await chunks.__anext__()
+        await chunks.aclose()
+        await asyncio.sleep(0)
+        assert os.listdir(self.tmpdir.name) == []
+
+    async def test_partial_file_is_removed_on_error(self):
+        self.failing = True
+        with pytest.raises(ClientPayloadError):
+            [chunk async for chunk in self.download_csv(self.files(1))]
+        assert not os.path.exists(self.file_path(0))
+
+    async def test_corrupted_download_is_not_used(self):
+        files = self.files(1)
+        entry = await files.__anext__()
+        self.contents[0] = self.contents[0][:-10]
+
+        async def truncated():
+            yield entry
+
+        with pytest.raises(ChecksumError):
+            [chunk async for chunk in self.download_csv(truncated())]
+        assert os.listdir(self.tmpdir.name) == []
+
+
+class InventoryToRecords(asynctest.TestCase):
+    def setUp(self):
+        self.fetchers = {}
+
+        async def list_manifest_entries(loop, s3_client, inventory):
+            yield {'key': inventory}
+
+        async def download_csv(loop, s3_client, files_stream):
+            async for files in files_stream:
+                yield files['key']
+
+        async def csv_to_records(loop, csv_stream, fetcher, **kwargs):
+            async for inventory in csv_stream:
+                for i in range(3):
+                    await asyncio.sleep(0.01)
+                    self.fetchers.setdefault(inventory, []).append(
+                        fetcher.concurrency
+                    )
+                    yield {'data': {'id': '{}-{}'.format(inventory, i)}}
+
+        for name, function in (
+            ('list_manifest_entries', list_manifest_entries),
+            ('download_csv', download_csv),
+            ('csv_to_records', csv_to_records),
+        ):
+            patch = asynctest.patch(
+                'buildhub.s3_inventory_to_kinto.' + name, function
+            )
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    class Fetcher:
+        concurrency = None
+
+    async def test_inventories_are_processed_concurrently(self):
+        shares = Shares(8, {'firefox': 3})
+        with MetricsMock() as metrics_mock:
+            records = [
+                record['data']['id'] async for record in merge_streams([
+                    inventory_to_records(
+                        self.loop, None, self.Fetcher(), inventory, shares
+                    )
+                    for inventory in ('firefox', 'archive')
+                ])
+            ]
+        assert records == [
+            'firefox-0', 'archive-0',
+            'firefox-1', 'archive-1',
+            'firefox-2', 'archive-2',
+        ]
+        # Archive gets all the requests once firefox is done.
+        assert self.fetchers == {'firefox': [6, 6, 6], 'archive': [2, 2, 8]}
+        records = metrics_mock.filter_records(
+            'incr',
+            stat='buildhub.s3_inventory_to_kinto_records',
+            tags=['inventory:archive'],
+        )
+        assert len(records) == 3
+        assert metrics_mock.has_record(
+            'timing',
+            stat='buildhub.s3_inventory_to_kinto_inventory',
+            tags=['inventory:firefox'],
+        )
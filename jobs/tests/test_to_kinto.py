@@ -2,13 +2,25 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
+import functools
+import json
+import os
 import unittest
 # Because you can't just import unittest and access 'unittest.mock.MagicMock'
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
+import asynctest
+import kinto_http
 import pytest
+from aioresponses import aioresponses
 
-from buildhub.to_kinto import fetch_existing
+from buildhub import to_kinto
+from buildhub.kinto_publisher import BatchPublisher
+from buildhub.to_kinto import fetch_all_records, fetch_existing, main
+from buildhub.utils import hash_record
+
+
+BATCH_URL = 'http://kinto/v1/batch'
 
 
 class CacheValueTest(unittest.TestCase):
@@ -17,7 +29,8 @@ class CacheValueTest(unittest.TestCase):
     def init_cache_files(self, tmpdir):
         # Use str() on these LocalPath instances to turn them into plain
         # strings since to_kinto.fetch_existing() expects it to be a string.
-        self.cache_file = str(tmpdir.join('cache.json'))
+        self.cache_file = str(tmpdir.join('records.bin'))
+        self.previous_dump_file = str(tmpdir.join('cache.json'))
 
     def test_records_are_not_duplicated(self):
         mocked = MagicMock()
@@ -28,10 +41,13 @@ class CacheValueTest(unittest.TestCase):
             {
                 'data': [{'id': 'a', 'title': 'a', 'last_modified': 1}]
             },
-            {}  # headers
+            {'ETag': '"1"'}  # headers
+        )
+        first = fetch_existing(
+            mocked,
+            cache_file=self.cache_file,
+            previous_dump_file=self.previous_dump_file,
         )
-        first = fetch_existing(mocked, cache_file=self.cache_file)
-        assert isinstance(first, dict)
         assert len(first) == 1
         assert first['a'][0] == 1  # [0] is the last_modified
         first_hash = first['a'][1]  # [1] is the hash string
@@ -41,9 +57,187 @@ class CacheValueTest(unittest.TestCase):
         mocked.get_records.return_value = [
             {'id': 'a', 'title': 'b', 'last_modified': 2}
         ]
-        second = fetch_existing(mocked, cache_file=self.cache_file)
-        assert isinstance(first, dict)
+        second = fetch_existing(
+            mocked,
+            cache_file=self.cache_file,
+            previous_dump_file=self.previous_dump_file,
+        )
+        mocked.get_records.assert_called_with(_since='"1"', pages=float('inf'))
         assert len(second) == 1
         assert second['a'][0] == 2
         second_hash = second['a'][1]
         assert first_hash != second_hash
+
+    def test_previous_dump_is_imported(self):
+        mocked = MagicMock()
+        mocked.session.server_url = 'http://localhost:8888/v1'
+        with open(self.previous_dump_file, 'w') as f:
+            json.dump({'a': [3, 'f' * 32], 'b': [5, 'e' * 32]}, f)
+        mocked.get_records.return_value = []
+
+        records = fetch_existing(
+            mocked,
+            cache_file=self.cache_file,
+            previous_dump_file=self.previous_dump_file,
+        )
+        mocked.get_records.assert_called_with(_since='"5"', pages=float('inf'))
+        assert len(records) == 2
+        assert records['a'] == (3, 'f' * 32)
+        assert not os.path.exists(self.previous_dump_file)
+
+
+class FakeKintoSession:
+    """Lists the records of a collection like Kinto does."""
+    def __init__(self, timestamps, fail_after=None):
+        self.records = [
+            {'id': str(t), 'last_modified': t} for t in timestamps
+        ]
+        self.fail_after = fail_after
+        self.requests = 0
+
+    def request(self, method, endpoint, params):
+        self.requests += 1
+        if self.fail_after is not None and self.requests > self.fail_after:
+            raise ConnectionError('Kinto is gone')
+        records = [
+            r for r in self.records
+            if r['last_modified'] > params.get('gt_last_modified', -1) and
+            r['last_modified'] < params.get('lt_last_modified', 2 ** 64)
+        ]
+        records.sort(
+            key=lambda r: r['last_modified'],
+            reverse=params['_sort'].startswith('-')
+        )
+        limit = params['_limit']
+        headers = {
+            'ETag': '"%s"' % max(
+                [r['last_modified'] for r in self.records], default=0
+            )
+        }
+        if len(records) > limit:
+            headers['Next-Page'] = endpoint + '?_token=abc'
+        return {'data': records[:limit]}, headers
+
+
+class FetchAllRecordsTest(unittest.TestCase):
+    def fetch(self, session, **kwargs):
+        client = MagicMock()
+        client.session = session
+        pages = list(fetch_all_records(client, **kwargs))
+        return [r['last_modified'] for page in pages for r in page]
+
+    def test_all_records_are_fetched_once(self):
+        timestamps = list(range(1000, 3000, 7))
+        for page_size in (1, 10, 1000):
+            for parallel in (1, 3, 8):
+                session = FakeKintoSession(timestamps)
+                fetched = self.fetch(
+                    session, page_size=page_size, parallel=parallel
+                )
+                assert sorted(fetched) == timestamps
+
+    def test_short_periods_are_split(self):
+        # Most of the records were modified at once.
+        timestamps = [1] + list(range(10 ** 9, 10 ** 9 + 500)) + [2 * 10 ** 9]
+        session = FakeKintoSession(timestamps)
+        fetched = self.fetch(session, page_size=10, parallel=4)
+        assert sorted(fetched) == timestamps
+
+    def test_empty_collection(self):
+        session = FakeKintoSession([])
+        assert self.fetch(session) == []
+        assert session.requests == 1
+
+    def test_errors_are_raised(self):
+        session = FakeKintoSession(range(1, 1000), fail_after=10)
+        with pytest.raises(ConnectionError):
+            self.fetch(session, page_size=10, parallel=2)
+
+
+class PublishTest(asynctest.TestCase):
+    def setUp(self):
+        self.client = kinto_http.Client(
+            server_url='http://kinto/v1',
+            auth=('user', 'pass'),
+            bucket='build-hub',
+            collection='releases',
+        )
+        self.client.server_info = MagicMock(return_value={
+            'settings': {'batch_max_requests': 25}
+        })
+        self.mocked = aioresponses()
+        self.mocked.start()
+        self.addCleanup(self.mocked.stop)
+        self.mocked.post(BATCH_URL, payload={'responses': [
+            {'status': 200, 'body': {}} for _ in range(25)
+        ]})
+
+    async def records(self, *records):
+        for record in records:
+            yield record
+
+    def sent(self):
+        calls = self.mocked.requests.get(('POST', BATCH_URL), [])
+        return [json.loads(call.kwargs['data']) for call in calls]
+
+    def published(self):
+        return [
+            request['body']['data']['id']
+            for payload in self.sent()
+            for request in payload['requests']
+        ]
+
+    async def test_unchanged_records_are_skipped(self):
+        existing = {
+            'a': [1, hash_record({'id': 'a', 'title': 'a'})],
+            'b': [2, hash_record({'id': 'b', 'title': 'b'})],
+        }
+        await main(
+            self.loop,
+            self.records(
+                {'data': {'id': 'a', 'title': 'a'}},
+                {'data': {'id': 'b', 'title': 'changed'}},
+                {'data': {'id': 'c', 'title': 'c'}},
+            ),
+            self.client,
+            skip_existing=False,
+            existing=existing,
+        )
+        assert sorted(self.published()) == ['b', 'c']
+
+    async def test_attached_hash_is_used(self):
+        existing = {'a': [1, 'abc']}
+        await main(
+            self.loop,
+            self.records(
+                {'data': {'id': 'a', 'title': 'a'}, 'hash': 'abc'},
+                {'data': {'id': 'b', 'title': 'b'}, 'hash': 'def'},
+            ),
+            self.client,
+            skip_existing=False,
+            existing=existing,
+        )
+        assert self.published() == ['b']
+        # The hash is not sent to the server.
+        request, = self.sent()[0]['requests']
+        assert 'hash' not in request['body']
+
+    async def test_batch_requests_are_kept_under_max_bytes(self):
+        self.mocked.post(BATCH_URL, payload={'responses': [
+            {'status': 200, 'body': {}} for _ in range(25)
+        ]})
+        publisher = functools.partial(BatchPublisher, max_bytes=500)
+        with patch.object(to_kinto, 'BatchPublisher', publisher):
+            await main(
+                self.loop,
+                self.records(
+                    {'data': {'id': 'a', 'title': 'a' * 100}},
+                    {'data': {'id': 'b', 'title': 'b' * 100}},
+                    {'data': {'id': 'c', 'title': 'c' * 100}},
+                ),
+                self.client,
+                skip_existing=False,
+            )
+        first, second = [payload['requests'] for payload in self.sent()]
+        assert [r['body']['data']['id'] for r in first] == ['a', 'b']
+        assert [r['body']['data']['id'] for r in second] == ['c']
@@ -2,6 +2,10 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
+import asyncio
+import hashlib
+import json
+
 import pytest
 
 from buildhub.utils import (
@@ -12,15 +16,21 @@ from buildhub.utils import (
     guess_mimetype,
     guess_channel,
     chunked,
+    split_lines,
     localize_nightly_url,
     normalized_platform,
     localize_release_candidate_url,
     record_from_url,
+    _parse_record_from_url,
     merge_metadata,
+    merge_streams,
+    hash_record,
     check_record,
     is_rc_build_metadata,
     is_nightly_build_metadata,
+    KeyClassifier,
     ARCHIVE_URL,
+    ALL_PRODUCTS,
 )
 
 
@@ -1072,6 +1082,44 @@ def test_wrong_release_url(product, filename):
     assert not is_build_url(product, filename)
 
 
+KEY_CLASSIFIER = KeyClassifier(ALL_PRODUCTS + ('fennec',))
+
+
+@pytest.mark.parametrize('product,filename', RELEASE_FILENAMES)
+def test_classify_build_url(product, filename):
+    kind = KEY_CLASSIFIER.classify(product, filename)
+    assert kind == KeyClassifier.BUILD
+
+
+@pytest.mark.parametrize('product,url', RC_METADATA_FILENAMES)
+def test_classify_rc_build_metadata(product, url):
+    kind = KEY_CLASSIFIER.classify(product, url)
+    assert kind == KeyClassifier.RC_METADATA
+
+
+@pytest.mark.parametrize('product,url', NIGHTLY_METADATA_FILENAMES)
+def test_classify_nightly_build_metadata(product, url):
+    kind = KEY_CLASSIFIER.classify(product, url)
+    assert kind == KeyClassifier.NIGHTLY_METADATA
+
+
+@pytest.mark.parametrize(
+    'product,url',
+    WRONG_RELEASE_FILENAMES +
+    WRONG_NIGHTLY_METADATA_FILENAMES[:1] +
+    WRONG_NIGHTLY_METADATA_FILENAMES[2:] +
+    WRONG_RC_METADATA_FILENAMES
+)
+def test_classify_ignored(product, url):
+    assert KEY_CLASSIFIER.classify(product, url) is KeyClassifier.IGNORE
+
+
+def test_classify_ignores_unknown_products():
+    classifier = KeyClassifier(('thunderbird',))
+    url = 'pub/firefox/releases/52.0b6/linux-x86_64/en-US/firefox-52.0b6.tar.bz2'
+    assert classifier.classify('firefox', url) is KeyClassifier.IGNORE
+
+
 URLS_MIMETYPES = [
     ('firefox-55.0a1.en-US.linux-x86_64.tar.bz2', 'application/x-bzip2'),
     (
@@ -1112,6 +1160,102 @@ def test_chunked(iterable, size, chunks):
     assert list(chunked(iterable, size)) == chunks
 
 
+SPLIT_LINES = [
+    ([b'a,b\nc,d\n'], [[b'a,b', b'c,d']]),
+    ([b'a,', b'b\nc', b',d\n'], [[b'a,b'], [b'c,d']]),
+    ([b'a,b\n', b'\nc,d\ne'], [[b'a,b'], [b'', b'c,d']]),
+    ([b'a', b'', b'b'], []),
+]
+
+
+@pytest.mark.parametrize('chunks,expected', SPLIT_LINES)
+def test_split_lines(chunks, expected):
+    async def stream():
+        for chunk in chunks:
+            yield chunk
+
+    async def collect():
+        return [lines async for lines in split_lines(stream())]
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(collect()) == expected
+    finally:
+        loop.close()
+
+
+RECORD = {
+    'id': 'firefox_55-0a1_linux-x86_64_en-us',
+    'build': {'id': '20170515100238', 'date': '2017-05-15T10:02:38Z'},
+    'target': {'locale': 'en-US', 'version': '55.0a1', 'channel': 'nightly'},
+    'download': {'size': 55876236, 'url': 'https://archive/\u00e9.zip'},
+}
+
+
+def test_hash_record_is_md5_of_canonical_json():
+    expected = hashlib.md5(
+        json.dumps(RECORD, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+    assert hash_record(RECORD) == expected
+
+
+def test_hash_record_ignores_server_fields():
+    record = dict(RECORD, last_modified=1234, schema=5678)
+    assert hash_record(record) == hash_record(RECORD)
+    # The record is not mutated.
+    assert record['last_modified'] == 1234
+    assert hash_record(dict(RECORD, id='other')) != hash_record(RECORD)
+
+
+def test_merge_streams():
+    async def stream(name, delays):
+        for i, delay in enumerate(delays):
+            await asyncio.sleep(delay)
+            yield (name, i)
+
+    async def collect():
+        return [item async for item in merge_streams([
+            stream('a', [0.01, 0.03, 0.03]),
+            stream('b', [0.02, 0.02]),
+        ])]
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(collect()) == [
+            ('a', 0), ('b', 0), ('a', 1), ('b', 1), ('a', 2),
+        ]
+    finally:
+        loop.close()
+
+
+def test_merge_streams_stops_on_error():
+    closed = []
+
+    async def endless():
+        try:
+            while True:
+                await asyncio.sleep(0.01)
+                yield 1
+        finally:
+            closed.append(True)
+
+    async def failing():
+        await asyncio.sleep(0.05)
+        raise ValueError('boom')
+        yield  # pragma: no cover
+
+    async def collect():
+        return [item async for item in merge_streams([endless(), failing()])]
+
+    loop = asyncio.new_event_loop()
+    try:
+        with pytest.raises(ValueError):
+            loop.run_until_complete(collect())
+    finally:
+        loop.close()
+    assert closed == [True]
+
+
 NIGHTLY_URLS = [
     # Mobile ARM not localized
     (f'{ARCHIVE_URL}pub/mobile/nightly/2017/05/2017-05-30-10-01'
@@ -1219,6 +1363,41 @@ def test_record_from_url(record):
     assert from_url == record
 
 
+def _all_fixture_urls():
+    urls = [r['download']['url'] for r in RECORDS]
+    urls += [ARCHIVE_URL + f for _, f in RELEASE_FILENAMES]
+    urls += [ARCHIVE_URL + f for _, f in WRONG_RELEASE_FILENAMES]
+    urls += [u for pair in NIGHTLY_URLS + RC_URLS for u in pair]
+    # Same folders, other files: the folder layout comes from the cache.
+    urls += [
+        url.replace('en-US', 'fr').replace('linux', 'win')
+        for url in urls
+    ]
+    return urls
+
+
+def _parse(parser, url):
+    try:
+        return json.dumps(parser(url))
+    except Exception as e:
+        return type(e)
+
+
+@pytest.mark.parametrize('url', _all_fixture_urls())
+def test_record_from_url_same_as_full_parse(url):
+    expected = _parse(_parse_record_from_url, url)
+    # Twice, the second time with a warm folder cache.
+    assert _parse(record_from_url, url) == expected
+    assert _parse(record_from_url, url) == expected
+
+
+def test_record_from_url_returns_new_records():
+    url = RECORDS[1]['download']['url']
+    first = record_from_url(url)
+    first['target']['channel'] = 'beta'
+    assert record_from_url(url)['target']['channel'] == 'nightly'
+
+
 METADATA_RECORDS = [
     (
         {'source': {'product': 'firefox'}},